@@ -198,6 +198,23 @@ class IMPExMethods {
       throw new SoapFault('2', 'ERROR: ' . $e->getMessage());
     }
 
+    /* Long orbits: the local tools stream them (see getDataPointValue_spacecraft in impex.py) */
+    $model_properties = check_input_ResourceID($ResourceID, $GLOBALS['models'], $GLOBALS['tree_url']);
+    if ($GLOBALS['institute'] === $model_properties['institute'] &&
+	function_exists($GLOBALS['dict_functions'][__FUNCTION__]))
+      {
+	$variables = check_input_Variable($Variable, $model_properties['parameters']);
+	check_input_url($url_XYZ);
+	$IMFClockAngle = check_input_IMFClockAngle($IMFClockAngle);
+	check_input_InterpolationMethod($InterpolationMethod);
+	$OutputFileType = check_input_OutputFileType($OutputFileType);
+	$Parameters = array($ResourceID, $variables,
+			    $url_XYZ, $IMFClockAngle,
+			    $InterpolationMethod,
+			    $OutputFileType, $model_properties);
+	return execute_InternalMethod(__FUNCTION__, $Parameters);
+      }
+
     $url_Param = $this->getDataPointValue($ResourceID, $Variable, $url_XYZ, $IMFClockAngle,
 				   $InterpolationMethod, $OutputFileType);
 
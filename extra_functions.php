@@ -316,10 +316,11 @@ function check_input_OutputFileType($input_OutputFileType){
   else
     {
       $input_OutputFileType = strtolower($input_OutputFileType);
-      if ($input_OutputFileType !== 'votable' AND $input_OutputFileType !== 'netcdf')
+      if ($input_OutputFileType !== 'votable' AND $input_OutputFileType !== 'netcdf'
+	  AND $input_OutputFileType !== 'netcdf4')
 	{
 	  throw new SoapFault('1', 'OutputFileType needs to be one of '.
-			      'the possible values [votable or netcdf]');
+			      'the possible values [votable, netcdf or netcdf4]');
 	}
     }
   return $input_OutputFileType;
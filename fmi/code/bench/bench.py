@@ -0,0 +1,212 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+# Benchmarks of the FMI service methods with synthetic runs and inputs.
+# The hctools binaries are replaced by the stubs in bench/stubs, so it runs
+# offline, and the runs read in-process are in hcpy's own layout (layout =
+# numpy), so the timings are to compare commits, not the real runs.  Each
+# case is timed end to end and per stage (see stages.py) and the results
+# are saved as JSON, to compare them with other commits:
+#
+#    $ python -W ignore fmi/code/bench/bench.py -o before.json
+#    $ python -W ignore fmi/code/bench/bench.py -o after.json --compare before.json
+
+import argparse
+import sys
+import os
+import json
+import shutil
+import tempfile
+import platform
+import datetime
+import subprocess
+import numpy as np
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+code_dir = os.path.dirname(bench_dir)
+root_dir = os.path.dirname(os.path.dirname(code_dir))
+start_dir = os.getcwd()
+# impex reads fmi/code/fmi.cfg from the webservice directory
+os.chdir(root_dir)
+sys.path.insert(0, code_dir)
+sys.path.insert(0, bench_dir)
+
+import impex
+import hccache
+import fixtures
+
+def setup(workdir):
+    '''Points the service to the work directory and the stubs'''
+    outdir = os.path.join(workdir, 'out')
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for option, value in [('diroutput', outdir + os.sep),
+                          ('httpoutput', ''),
+                          ('bindir', os.path.join(bench_dir, 'stubs')),
+                          ('result_cache', '0'),
+                          ('jobdir', os.path.join(workdir, 'jobs'))]:
+        impex.impex_cfg.set('fmi', option, value)
+    impex.stages.logfile = None
+    # The inputs are local files of the work directory
+    impex.urlfetch.fetcher = impex.urlfetch.Fetcher(os.path.join(workdir, 'urlcache'), local_dir=workdir)
+    return outdir
+
+def run(request, cold=False):
+    '''Runs the request and returns its timing (or raises its error)'''
+    if cold:
+        hccache.runs.invalidate()
+    answer = impex.run_request(dict(request, timing=True))
+    if answer.get('error'):
+        raise RuntimeError(answer['error'])
+    return answer['timing']
+
+def cases(workdir, grids, npoints, formats, max_seeds):
+    '''
+    Yields (description, request) for each method, grid, number of
+    points and output format
+    '''
+    # uniform and refined (3 levels) grids read in-process, and the
+    # hctools (stubs) for the rest
+    runs = {'uniform': {}, 'refined': {'levels': 3}, 'hctools': {'native': False}}
+    for grid in grids:
+        for run_kind in ['uniform', 'refined', 'hctools']:
+            run_name = os.path.join(workdir, 'run_{0}_{1}.hc'.format(grid, run_kind))
+            if not os.path.exists(run_name):
+                fixtures.write_hc(run_name, (grid,) * 3, **runs[run_kind])
+            for n in npoints:
+                orbit = os.path.join(workdir, 'orbit_{0}.xml'.format(n))
+                if not os.path.exists(orbit):
+                    impex.points2vot(orbit, fixtures.orbit(n), {'function': 'bench'})
+                amda = os.path.join(workdir, 'amda_{0}.xml'.format(n))
+                if not os.path.exists(amda):
+                    fixtures.write_amda(amda, n)
+                nseeds = min(n, max_seeds)
+                seeds = os.path.join(workdir, 'particles_{0}.xml'.format(nseeds))
+                if not os.path.exists(seeds):
+                    impex.points2vot(seeds, fixtures.particles(nseeds), {'function': 'bench'})
+                side = np.sqrt(n)
+                for output in formats:
+                    info = {'grid': grid, 'run': run_kind, 'points': n, 'format': output}
+                    yield dict(info, method='getDataPointValue'), \
+                        {'function': 'getDataPointValue', 'filename': run_name,
+                         'variables': ['rho', 'Bx', 'By', 'Bz'], 'url_XYZ': orbit,
+                         'order': 'linear', 'OutputFiletype': output}
+                    yield dict(info, method='getDataPointValue', input='amda'), \
+                        {'function': 'getDataPointValue', 'filename': run_name,
+                         'variables': ['rho'], 'url_XYZ': amda,
+                         'order': 'linear', 'OutputFiletype': output}
+                    # The orbits streamed in chunks (spacecraft_chunk), with their Time
+                    for name, url in [('orbit', orbit), ('amda', amda)]:
+                        yield dict(info, method='getDataPointValue_spacecraft', input=name), \
+                            {'function': 'getDataPointValue_spacecraft', 'filename': run_name,
+                             'variables': ['rho', 'Bx', 'By', 'Bz'], 'url_XYZ': url,
+                             'order': 'linear', 'OutputFiletype': output}
+                    yield dict(info, method='getSurface'), \
+                        {'function': 'getSurface', 'filename': run_name,
+                         'variables': ['rho', 'Bx'], 'vector': [0, 0, 1], 'point': [0, 0, 0],
+                         'resolution': (fixtures.box[0, 1] - fixtures.box[0, 0]) / side,
+                         'box_min': list(fixtures.box[:, 0]), 'box_max': list(fixtures.box[:, 1]),
+                         'order': 'linear', 'OutputFiletype': output}
+                    yield dict(info, method='getFieldLine', points=nseeds), \
+                        {'function': 'getFieldLine', 'filename': run_name,
+                         'variables': ['B', 'E'], 'direction': 'Forward',
+                         'stepsize': 5e4, 'maxsteps': 100, 'stop_radius': 0,
+                         'stop_box': list(fixtures.box.flat), 'url_XYZ': seeds,
+                         'OutputFiletype': output}
+                    yield dict(info, method='getParticleTrajectory', points=nseeds), \
+                        {'function': 'getParticleTrajectory', 'filename': run_name,
+                         'properties': {'simul_timestep': 'PT0.01S'},
+                         'direction': 'Forward', 'stepsize': None, 'maxsteps': 100,
+                         'stop_radius': 0, 'stop_box': list(fixtures.box.flat),
+                         'order': 'linear', 'url_XYZ': seeds, 'OutputFiletype': output}
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def _key(case):
+    return tuple(sorted((k, v) for k, v in case.items() if k not in ['wall', 'cpu', 'cpu_children', 'rss_kb', 'rss_delta_kb', 'peak_rss_kb', 'stages', 'error']))
+
+def compare(results, previous):
+    '''Prints the wall time of each case against the previous results'''
+    before = {_key(case): case for case in previous['cases'] if 'wall' in case}
+    print '{0:<60} {1:>10} {2:>10} {3:>7}'.format('case (vs ' + previous.get('commit', '') + ')', 'before', 'now', 'ratio')
+    for case in results['cases']:
+        old = before.get(_key(case))
+        if old is None or 'wall' not in case:
+            continue
+        name = '{method} {grid}^3 {run} {points} {format}'.format(**case)
+        if case.get('input'):
+            name += ' ' + case['input']
+        print '{0:<60} {1:>10.4f} {2:>10.4f} {3:>7.2f}'.format(name, old['wall'], case['wall'],
+                                                                case['wall'] / max(old['wall'], 1e-9))
+
+def main(args):
+    # paths given relative to where it was started
+    for option in ['output', 'compare', 'workdir']:
+        if getattr(args, option):
+            setattr(args, option, os.path.join(start_dir, getattr(args, option)))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='impex_bench_')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    outdir = setup(workdir)
+    results = {'commit': _commit(), 'date': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(), 'numpy': np.__version__,
+               'host': platform.node(), 'repeat': args.repeat, 'cold': args.cold,
+               'cases': []}
+    formats = [f for f in args.formats if f != 'netcdf4' or impex.netCDF4 is not None]
+    methods = args.methods
+    try:
+        for case, request in cases(workdir, args.grids, args.points, formats, args.max_seeds):
+            if methods and case['method'] not in methods:
+                continue
+            try:
+                # The best of the repetitions
+                timings = [run(request, args.cold) for i in range(args.repeat)]
+                timing = min(timings, key=lambda timing: timing['wall'])
+                case.update((k, timing[k]) for k in ['wall', 'cpu', 'cpu_children', 'rss_kb', 'rss_delta_kb', 'stages']
+                            if k in timing)
+            except Exception as e:
+                case['error'] = str(e)[:500]
+            results['cases'].append(case)
+            print >> sys.stderr, case['method'], case['grid'], case['points'], case['format'], \
+                case.get('wall', case.get('error', '')[:80])
+            # the outputs are not needed, just their sizes (in the stages)
+            for name in os.listdir(outdir):
+                os.unlink(os.path.join(outdir, name))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the FMI methods with synthetic runs')
+    parser.add_argument('-o', '--output', default='bench.json',
+                        help='JSON file for the results')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of a previous run to compare with')
+    parser.add_argument('--grids', type=int, nargs='+', default=[16, 64],
+                        help='cells per side of the synthetic runs')
+    parser.add_argument('--points', type=lambda n: int(float(n)), nargs='+', default=[10, 1000, 100000],
+                        help='number of points of the inputs (up to 1e7)')
+    parser.add_argument('--max-seeds', type=int, default=1000,
+                        help='maximum of field lines/particles traced')
+    parser.add_argument('--formats', nargs='+', default=['votable', 'netcdf', 'netcdf4'],
+                        help='output file types')
+    parser.add_argument('--methods', nargs='+', default=None,
+                        help='run just these methods')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repetitions per case (the fastest is kept)')
+    parser.add_argument('--cold', action='store_true',
+                        help='open the simulation file again for every repetition')
+    parser.add_argument('--workdir', default=None,
+                        help='keep the synthetic files in this directory (reused if there)')
+    main(parser.parse_args())
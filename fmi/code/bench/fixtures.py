@@ -0,0 +1,129 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+# Synthetic inputs for the benchmarks: HC simulation files, orbit and
+# particle VOTables and AMDA like tables.
+
+import numpy as np
+import astropy.io.votable as votable
+from astropy.io.votable.tree import VOTableFile, Resource, Table, Field
+
+# Box of the synthetic runs (m), about a Mars radius around the origin
+box = np.array([[-4e6, 4e6], [-4e6, 4e6], [-4e6, 4e6]])
+variables = ['rho', 'rhovx', 'rhovy', 'rhovz', 'Bx', 'By', 'Bz', 'Ex', 'Ey', 'Ez']
+
+def fields(x, y, z):
+    '''
+    Smooth fields at the points: a dipole like B, a radial flow and
+    E = -v x B.  It returns an array (..., len(variables)).
+    '''
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2) + 1e5
+    rho = 1e6 * (1 + 1e6 / r)
+    v = 4e5 * np.array([x, y, z]) / r
+    b = 1e-8 * (1e6 / r) ** 3 * np.array([3 * x * z / r ** 2, 3 * y * z / r ** 2, 3 * z ** 2 / r ** 2 - 1])
+    e = -np.cross(v, b, axis=0)
+    return np.rollaxis(np.concatenate(([rho], rho * v, b, e)), 0, np.ndim(x) + 1)
+
+def write_hc(filename, n=(32, 32, 32), native=True, levels=0, dtype='float32'):
+    '''
+    Writes a grid of n cells with the fields in the layout hcpy reads
+    in-process (see hcpy.HCpy), not the one of the hctools.  With levels > 0
+    the cells close to the planet are refined levels times.  With
+    native=False only the header is written (as a refined run), so it's
+    left to the hctools binaries.
+    '''
+    f = open(filename, 'wb')
+    f.write('# synthetic run for the benchmarks\n')
+    for i, limit in enumerate(['xmin0', 'xmax0', 'xmin1', 'xmax1', 'xmin2', 'xmax2']):
+        f.write('{0} = {1!r}\n'.format(limit, box.flat[i]))
+    if not native:
+        f.write('maxlevel = 1\neoh\n')
+        f.close()
+        return filename
+    f.write('layout = numpy\nn0 = {0}\nn1 = {1}\nn2 = {2}\n'.format(*n))
+    f.write('vars = {0}\ndatatype = {1}\n'.format(','.join(variables), dtype))
+    if levels > 0:
+        cells = refined_cells(n, levels)
+        size = (box[:, 1] - box[:, 0]) / np.array(n) / (2. ** cells[:, :1])
+        centres = box[:, 0] + (cells[:, 1:] + 0.5) * size
+        f.write('maxlevel = {0}\nncells = {1}\neoh\n'.format(levels, len(cells)))
+        f.write(cells.astype(np.int32).tobytes())
+        f.write(fields(*centres.T).astype(dtype).tobytes())
+        f.close()
+        return filename
+    f.write('eoh\n')
+    # A plane at a time (x), so big grids do not need all the memory
+    centres = [box[i, 0] + (np.arange(n[i]) + 0.5) * (box[i, 1] - box[i, 0]) / n[i] for i in range(3)]
+    y, z = np.meshgrid(centres[1], centres[2], indexing='ij')
+    for x in centres[0]:
+        f.write(fields(np.ones_like(y) * x, y, z).astype(dtype).tobytes())
+    f.close()
+    return filename
+
+def refined_cells(n, levels):
+    '''
+    Leaf cells (level, i, j, k) of a grid of n cells where those within
+    half the box of the planet are split, and those within a quarter at
+    the next level and so on.
+    '''
+    i, j, k = np.meshgrid(*[np.arange(side) for side in n], indexing='ij')
+    cells = np.column_stack((np.zeros(i.size, dtype=np.int64), i.ravel(), j.ravel(), k.ravel()))
+    leaves = []
+    children = np.array([[0, (c >> 2) & 1, (c >> 1) & 1, c & 1] for c in range(8)])
+    for level in range(levels):
+        size = (box[:, 1] - box[:, 0]) / np.array(n) / 2. ** level
+        centres = box[:, 0] + (cells[:, 1:] + 0.5) * size
+        split = np.sqrt(np.sum(centres ** 2, axis=1)) < box[0, 1] / 2. ** (level + 1)
+        leaves.append(cells[~split])
+        parents = cells[split] * [1, 2, 2, 2] + [1, 0, 0, 0]
+        cells = (parents[:, np.newaxis, :] + children).reshape(-1, 4)
+    leaves.append(cells)
+    return np.concatenate(leaves)
+
+def orbit(npoints, seed=0):
+    '''
+    Points along an elliptic orbit within the box, with a time per point
+    '''
+    t = np.linspace(0, 2 * np.pi, npoints)
+    radius = 0.9 * box[:, 1]
+    points = {'x': radius[0] * np.cos(t),
+              'y': 0.5 * radius[1] * np.sin(t),
+              'z': 0.3 * radius[2] * np.sin(2 * t)}
+    points['Time'] = np.datetime64('2014-01-01T00:00:00') + \
+                     np.arange(npoints).astype('timedelta64[s]')
+    return points
+
+def particles(npoints, seed=0):
+    '''
+    Protons on the dayside with a velocity towards the planet
+    '''
+    random = np.random.RandomState(seed)
+    points = {'x': random.uniform(0.5, 0.8, npoints) * box[0, 1],
+              'y': random.uniform(-0.5, 0.5, npoints) * box[1, 1],
+              'z': random.uniform(-0.5, 0.5, npoints) * box[2, 1],
+              'vx': -4e5 * np.ones(npoints),
+              'vy': np.zeros(npoints),
+              'vz': np.zeros(npoints),
+              'mass': 1.672621777e-27 * np.ones(npoints),
+              'charge': 1.602176565e-19 * np.ones(npoints)}
+    return points
+
+def write_amda(filename, npoints, planet='Rm'):
+    '''
+    Writes the orbit as AMDA does: Time and the position in planet radii
+    '''
+    radii = {'Rv': 6051e3, 'Rm': 3396e3, 'Re': 6371e3}
+    points = orbit(npoints)
+    vot = VOTableFile()
+    vot.description = 'Generated by CDPP/AMDA'
+    resource = Resource()
+    vot.resources.append(resource)
+    table = Table(vot)
+    resource.tables.append(table)
+    table.fields.extend([Field(vot, name='Time', ID='Time', datatype='char', arraysize='*', ucd='time.epoch'),
+                         Field(vot, name='pos', ID='pos', datatype='float', arraysize='3', unit=planet)])
+    table.create_arrays(npoints)
+    table.array['Time'] = [str(t) for t in points['Time']]
+    table.array['pos'] = np.column_stack([points[ax] for ax in 'xyz']) / radii[planet]
+    vot.to_xml(filename)
+    return filename
@@ -0,0 +1,84 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+# Fixtures shared by the tests (test_*.py next to the modules):
+#
+#    $ cd fmi/code && python -m pytest -q
+
+import numpy as np
+import pytest
+
+box = np.array([[-4., 4.], [-4., 4.], [-4., 4.]])
+
+def write_run(filename, fields, shape=(16, 16, 16), box=box, dtype='float64'):
+    '''
+    Writes a uniform run in the layout hcpy reads in-process (see
+    hcpy.HCpy) with the values of fields(x, y, z) -> {var: values} at the
+    cell centres.
+    '''
+    centres = [box[i, 0] + (np.arange(shape[i]) + 0.5) * (box[i, 1] - box[i, 0]) / shape[i]
+               for i in range(3)]
+    x, y, z = np.meshgrid(*centres, indexing='ij')
+    values = fields(x, y, z)
+    variables = sorted(values.keys())
+    with open(filename, 'wb') as f:
+        for i, limit in enumerate(['xmin0', 'xmax0', 'xmin1', 'xmax1', 'xmin2', 'xmax2']):
+            f.write('{0} = {1!r}\n'.format(limit, box.flat[i]))
+        f.write('layout = numpy\nn0 = {0}\nn1 = {1}\nn2 = {2}\n'.format(*shape))
+        f.write('vars = {0}\ndatatype = {1}\neoh\n'.format(','.join(variables), dtype))
+        f.write(np.stack([values[v] for v in variables], axis=-1).astype(dtype).tobytes())
+    return filename
+
+def refine(cells, split):
+    '''The leaves (level, i, j, k) with those where split(cells) split in 8'''
+    cells = np.asarray(cells)
+    parents = cells[split(cells)] * [1, 2, 2, 2] + [1, 0, 0, 0]
+    children = np.array([[0, (c >> 2) & 1, (c >> 1) & 1, c & 1] for c in range(8)])
+    return np.vstack((cells[~split(cells)], (parents[:, np.newaxis, :] + children).reshape(-1, 4)))
+
+def write_refined(filename, fields, cells, shape=(4, 4, 4), box=box, dtype='float64'):
+    '''
+    Writes a refined run (see hcpy.HCpy) of the leaves cells (level, i, j,
+    k) with the values of fields(x, y, z) -> {var: values} at their centres.
+    '''
+    cells = np.asarray(cells)
+    size = (box[:, 1] - box[:, 0]) / np.array(shape) / (2. ** cells[:, :1])
+    centres = box[:, 0] + (cells[:, 1:] + 0.5) * size
+    values = fields(*centres.T)
+    variables = sorted(values.keys())
+    with open(filename, 'wb') as f:
+        for i, limit in enumerate(['xmin0', 'xmax0', 'xmin1', 'xmax1', 'xmin2', 'xmax2']):
+            f.write('{0} = {1!r}\n'.format(limit, box.flat[i]))
+        f.write('layout = numpy\nn0 = {0}\nn1 = {1}\nn2 = {2}\n'.format(*shape))
+        f.write('maxlevel = {0}\nncells = {1}\n'.format(cells[:, 0].max(), len(cells)))
+        f.write('vars = {0}\ndatatype = {1}\neoh\n'.format(','.join(variables), dtype))
+        f.write(cells.astype(np.int32).tobytes())
+        f.write(np.column_stack([values[v] for v in variables]).astype(dtype).tobytes())
+    return filename
+
+@pytest.fixture
+def make_run(tmpdir):
+    '''make_run(name, fields, ...) writes the run (see write_run) in tmpdir'''
+    return lambda name, fields, **options: write_run(str(tmpdir.join(name)), fields, **options)
+
+@pytest.fixture
+def impex(tmpdir, monkeypatch):
+    '''impex with its output, jobs and caches in tmpdir'''
+    import impex
+    cfg = impex.impex_cfg
+    if not cfg.has_section('fmi'):
+        cfg.add_section('fmi')
+    saved = dict(cfg.items('fmi'))
+    for option, value in [('diroutput', str(tmpdir.mkdir('out')) + '/'),
+                          ('httpoutput', ''),
+                          ('jobdir', str(tmpdir.join('jobs'))),
+                          ('result_cache', '1')]:
+        cfg.set('fmi', option, value)
+    monkeypatch.setattr(impex.stages, 'logfile', None)
+    monkeypatch.setattr(impex.urlfetch, 'fetcher',
+                        impex.urlfetch.Fetcher(str(tmpdir.join('urlcache')), local_dir=str(tmpdir)))
+    yield impex
+    cfg.remove_section('fmi')
+    cfg.add_section('fmi')
+    for option, value in saved.items():
+        cfg.set('fmi', option, value)
@@ -4,9 +4,13 @@ __email__ = "dps.helio-?-gmail.com"
 import argparse
 import sys
 import hcpy
+import hccache
 import numpy as np
 import astropy.io.votable as votable
 
+# Integration methods of Fieldtrack.track_many
+methods = ('midpoint', 'rk4', 'rk45')
+
 def vot2points(filename):
     vot = votable.parse_single_table(filename)
     types = ['x', 'y', 'z']
@@ -60,7 +64,7 @@ class Fieldtrack(object):
 #        hc = hcpy(hcfilename)
 #        self.hc = hc
         try:
-            self.hc = hcpy.HCpy(hcfilename)
+            self.hc = hccache.open_run(hcfilename)
         except:
             print "Unexpected error:", sys.exc_info()[0]
             raise
@@ -68,7 +72,8 @@ class Fieldtrack(object):
         if stop_box is None:
             stop_box = self.hc.box
         try:
-            stop_box = np.array(stop_box).reshape(3,2)
+            # PHP gives the limits as strings (preg_split)
+            stop_box = np.asarray(stop_box, dtype=np.float64).reshape(3,2)
         except ValueError as e:
             print 'stop_box does not have the right dimension ', e
 
@@ -111,6 +116,155 @@ class Fieldtrack(object):
             track_points[n + 1, :] = endpoint
         return track_points[:n + 1,:]
 
+    def track_many(self, points, vectorfield, stepsize=1, maxstep=1,
+                   direction='forward', method='midpoint', linear=False,
+                   tolerance=None, min_stepsize=None, max_stepsize=None):
+        '''
+        Traces all the field lines starting at points (array of shape (n, 3))
+        at once.  Each step interpolates the field for all the lines still
+        being traced in a single call, and the lines that leave the stop_box,
+        go below stop_minradius or find a null field are masked off.
+        It returns a list with the (steps, 3) array of each line; they are
+        views of a single contiguous array.
+
+        method can be 'midpoint' or 'rk4' with a fixed stepsize, or 'rk45'
+        (Dormand-Prince) which adapts the step of each line so the error
+        per step is below tolerance (in the units of the coordinates,
+        stepsize/1000 by default) within [min_stepsize, max_stepsize]
+        (stepsize/1000 and 10*stepsize by default); stepsize is then the
+        first step tried.  maxstep is the maximum of points added per line.
+        The number of field evaluations (per point) is left in self.nevals.
+        '''
+        self.stepsize = stepsize
+        self.maxstep = maxstep
+        self.vectorfield = vectorfield
+        self.nevals = 0
+
+        direction_sign = {'forward': 1., 'backward': -1}
+        steppers = {'midpoint': self._step_midpoint,
+                    'rk4': self._step_rk4,
+                    'rk45': self._step_rk45}
+        if method not in steppers:
+            raise ValueError('Unknown method ' + str(method) + ' (' + ', '.join(methods) + ')')
+        stepper = steppers[method]
+        self.tolerance = tolerance if tolerance is not None else stepsize * 1e-3
+        self.min_stepsize = min_stepsize if min_stepsize is not None else stepsize * 1e-3
+        self.max_stepsize = max_stepsize if max_stepsize is not None else stepsize * 10.
+
+        vectors = [vectorfield+x for x in ['x', 'y', 'z']]
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        nlines = len(points)
+        track_points = np.empty((maxstep + 1, nlines, 3))
+        track_points[0] = points
+        lengths = np.ones(nlines, dtype=np.intp)
+        steps = np.empty(nlines)
+        steps.fill(self.stepsize * direction_sign[direction])
+        first = np.empty((nlines, 3))  # field direction at the last point (if known)
+        first.fill(np.nan)
+        active = np.arange(nlines)
+        # The adaptive method can reject steps, so it tries a few more times
+        for attempt in range(maxstep if method != 'rk45' else 10 * maxstep):
+            if len(active) == 0:
+                break
+            current = track_points[lengths[active] - 1, active]
+            endpoint, ok, accepted, steps[active], first[active] = \
+                stepper(current, steps[active], first[active], vectors, linear)
+            # Just the accepted steps end the lines out of the box, the rejected
+            # ones (rk45) are tried again with the shorter step
+            inside = accepted.copy()
+            inside[accepted] = self._within_many(endpoint[accepted])
+            ok &= ~accepted | inside
+            done = accepted & ok
+            track_points[lengths[active[done]], active[done]] = endpoint[done]
+            lengths[active[done]] += 1
+            active = active[ok & (lengths[active] <= maxstep)]
+
+        # Lines one after the other: (line, step) order for the valid steps
+        valid = np.arange(maxstep + 1)[np.newaxis, :] < lengths[:, np.newaxis]
+        lines = track_points.transpose(1, 0, 2)[valid]
+        return np.split(lines, np.cumsum(lengths)[:-1])
+
+    def _step_midpoint(self, current, step, first, vectors, linear):
+        '''
+        Steppers: they return the new points, mask of the lines that can
+        go on, mask of the accepted steps, next step and the direction
+        of the field at the new points if they know it.
+        '''
+        nofield = np.empty_like(first)
+        nofield.fill(np.nan)
+        # Calculate the Vector direction for half of the step
+        midpoint, ok = self.follow_points(current, current, 0.5 * step[:, np.newaxis], vectors, linear)
+        ok[ok] = self._within_many(midpoint[ok])
+        #  Apply midpoint direction to original point.
+        endpoint, ok_end = self.follow_points(midpoint, current, step[:, np.newaxis], vectors, linear)
+        return endpoint, ok & ok_end, ok & ok_end, step, nofield
+
+    def _step_rk4(self, current, step, first, vectors, linear):
+        nofield = np.empty_like(first)
+        nofield.fill(np.nan)
+        h = step[:, np.newaxis]
+        k1, ok1 = self._direction(current, vectors, linear)
+        k2, ok2 = self._direction(current + 0.5 * h * k1, vectors, linear)
+        k3, ok3 = self._direction(current + 0.5 * h * k2, vectors, linear)
+        k4, ok4 = self._direction(current + h * k3, vectors, linear)
+        ok = ok1 & ok2 & ok3 & ok4
+        endpoint = current + h / 6. * (k1 + 2 * k2 + 2 * k3 + k4)
+        return endpoint, ok, ok, step, nofield
+
+    # Dormand-Prince 5(4) tableau
+    _dp_a = [[],
+             [1/5.],
+             [3/40., 9/40.],
+             [44/45., -56/15., 32/9.],
+             [19372/6561., -25360/2187., 64448/6561., -212/729.],
+             [9017/3168., -355/33., 46732/5247., 49/176., -5103/18656.],
+             [35/384., 0., 500/1113., 125/192., -2187/6784., 11/84.]]
+    _dp_b4 = [5179/57600., 0., 7571/16695., 393/640., -92097/339200., 187/2100., 1/40.]
+
+    def _step_rk45(self, current, step, first, vectors, linear):
+        h = step[:, np.newaxis]
+        k = [first.copy()]
+        # Reuse the last stage of the previous step (first same as last)
+        unknown = np.isnan(k[0][:, 0])
+        ok = np.ones(len(current), dtype=bool)
+        if np.any(unknown):
+            k[0][unknown], ok[unknown] = self._direction(current[unknown], vectors, linear)
+        start = ok.copy()  # the field is defined at the current points
+        for a in self._dp_a[1:]:
+            stage = current + h * sum(aj * kj for aj, kj in zip(a, k) if aj != 0)
+            kn, okn = self._direction(stage, vectors, linear)
+            k.append(kn)
+            ok &= okn
+        endpoint = current + h * sum(aj * kj for aj, kj in zip(self._dp_a[-1], k) if aj != 0)
+        fourth = current + h * sum(bj * kj for bj, kj in zip(self._dp_b4, k) if bj != 0)
+        error = np.sqrt(np.sum((endpoint - fourth) ** 2, axis=1)) / self.tolerance
+        accepted = ok & (error <= 1.)
+        # Next step size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.clip(0.9 * error ** -0.2, 0.2, 5.)
+        factor[~np.isfinite(factor)] = 5.
+        # The field is not defined somewhere within the step (e.g., out of
+        # the simulation box): a shorter one is tried
+        factor[~ok] = 0.2
+        newstep = np.sign(step) * np.clip(np.abs(step) * factor, 0, self.max_stepsize)
+        # Lines that would need steps smaller than the minimum are stopped
+        ok = start & (accepted | (np.abs(newstep) >= self.min_stepsize))
+        last = np.where(accepted[:, np.newaxis], k[-1], first)
+        return endpoint, ok, accepted, newstep, last
+
+    def _direction(self, points, vectors, linear=False):
+        '''
+        Unit vector of the field at points and mask with the points
+        where it is defined (not null nor outside the simulation).
+        '''
+        F = self._field(points, vectors, linear)
+        norm = np.sqrt(np.sum(F ** 2, axis=1))
+        ok = np.isfinite(norm) & (norm != 0)
+        F[ok] /= norm[ok, np.newaxis]
+        F[~ok] = 0
+        return F, ok
+
 
     def follow_point(self, initpoint, point0, stepsize, vectors):
         x = initpoint
@@ -122,6 +276,32 @@ class Fieldtrack(object):
         return point0 + F * stepsize
 
 
+    def follow_points(self, initpoints, points0, stepsize, vectors, linear=False):
+        '''
+        Vectorized follow_point: it moves points0 a step in the direction of
+        the field at initpoints.  It also returns a mask with the points
+        whose field is not null.
+        '''
+        F, ok = self._direction(initpoints, vectors, linear)
+        return points0 + F * stepsize, ok
+
+    def _field(self, points, vectors, linear=False):
+        ''' Interpolates the vector field for an array of points'''
+        if len(points) == 0:
+            return np.empty((0, 3))
+        self.nevals = getattr(self, 'nevals', 0) + len(points)
+        x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        if self.hc.native:
+            values = self.hc.intpol(x, y, z, vectors, linear=linear)
+        else:
+            values = self.hc.hcintpol(list(x), list(y), list(z), vectors, linear=linear)
+        return np.column_stack([np.asarray(values[v], dtype=np.float64) for v in vectors])
+
+    def _within_many(self, points):
+        ''' Vectorized _within, for an array of points'''
+        result = np.all((self.stop_box[:, 0] <= points) & (points <= self.stop_box[:, 1]), axis=1)
+        return result & (np.sqrt(np.sum(points ** 2, axis=1)) >= self.stop_minradius)
+
     def _within(self, points):
         ''' Check whether the point is within boundaries'''
         result = True
@@ -160,8 +340,11 @@ if __name__ == '__main__':
     parser.add_argument('-o','--output', default=None, type=argparse.FileType('w'),
                         help='Output file')
 
-    parser.add_argument('--method', choices=['midpoint'], default='midpoint',
-                        help='Method used to calculate the field line.')
+    parser.add_argument('--method', choices=methods, default='midpoint',
+                        help=('Method used to calculate the field line. rk45 adapts '
+                              'the step size to the tolerance.'))
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='Error allowed per step with the rk45 method (default stepsize/1000)')
 
     parser.add_argument('--direction', choices=['forward','backward'], 
                         default='forward',
@@ -210,14 +393,13 @@ if __name__ == '__main__':
         points = vot2points(args.input)
 
     # Calculate field lines  #TODO: what if multiple vectorfields?
-    fieldlines = []
-    for row in points:
-        fieldlines.append(field.track(row, 
-                                      args.vectorfield,
-                                      args.stepsize,
-                                      args.maxstep,
-                                      args.direction,
-                                      'midpoint'))
+    fieldlines = field.track_many(points,
+                                  args.vectorfield,
+                                  args.stepsize,
+                                  args.maxstep,
+                                  args.direction,
+                                  args.method,
+                                  tolerance=args.tolerance)
 
     # Save in the requested output format
     if args.outformat == 'vot':
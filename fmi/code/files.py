@@ -0,0 +1,30 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import stat
+import errno
+
+def private_dir(path, mode=0o700):
+    '''
+    Creates the directory path (with mode) if it's not there and checks
+    that it's owned by this user and nobody else can write on it, since
+    the files found in it are trusted (queued jobs, cached inputs...) and
+    it's usually in a shared /tmp.  Raises OSError otherwise.
+    '''
+    try:
+        os.makedirs(path, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o002:
+        raise OSError(errno.EPERM, 'Not a directory of this user only', path)
+    return path
+
+def unlink(path):
+    '''Removes path if it's there (another process may have removed it)'''
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
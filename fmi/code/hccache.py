@@ -0,0 +1,64 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+from collections import OrderedDict
+import hcpy
+
+class RunCache(object):
+    '''
+    Least recently used cache of opened simulation runs (hcpy.HCpy objects
+    with their header, box, variables, memory mapped grid and the index of
+    the refined ones) keyed by filename.  The total of bytes mapped is
+    bounded by max_bytes, and a run is opened again when its file changes
+    on disk.
+    '''
+    def __init__(self, max_bytes=8 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.runs = OrderedDict()  # filename: (mtime, size, HCpy)
+
+    def open(self, filename):
+        stat = os.stat(filename)
+        if filename in self.runs:
+            mtime, size, hc = self.runs.pop(filename)
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                self.runs[filename] = (mtime, size, hc)  # most recent at the end
+                return hc
+            hc.close()
+        hc = hcpy.HCpy(filename)
+        if hc.native:
+            hc.load()
+        self.runs[filename] = (stat.st_mtime, stat.st_size, hc)
+        self._evict()
+        return hc
+
+    def __contains__(self, filename):
+        return filename in self.runs
+
+    def resident_bytes(self):
+        return sum(self._nbytes(hc) for mtime, size, hc in self.runs.values())
+
+    def invalidate(self, filename=None):
+        if filename is None:
+            for mtime, size, hc in self.runs.values():
+                hc.close()
+            self.runs.clear()
+        elif filename in self.runs:
+            self.runs.pop(filename)[2].close()
+
+    def _nbytes(self, hc):
+        nbytes = hc.data.nbytes if hc.data is not None else 0
+        if hc.index is not None:
+            nbytes += hc.index.nbytes
+        return nbytes
+
+    def _evict(self):
+        # The run just opened is kept even if it's larger than max_bytes
+        while len(self.runs) > 1 and self.resident_bytes() > self.max_bytes:
+            self.runs.popitem(last=False)[1][2].close()
+
+runs = RunCache()
+
+def open_run(filename):
+    '''Returns the hcpy.HCpy of filename, from the cache if possible'''
+    return runs.open(filename)
@@ -0,0 +1,90 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import numpy as np
+
+def _spread(v):
+    '''Spreads the (up to 21) bits of v so there are two zeros between them'''
+    v = v.astype(np.uint64) & np.uint64(0x1fffff)
+    for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+def morton(i, j, k):
+    '''Morton (Z-order) code of the integer coordinates i, j, k'''
+    return (_spread(i) << np.uint64(2)) | (_spread(j) << np.uint64(1)) | _spread(k)
+
+class BlockIndex(object):
+    '''
+    Index of the leaf cells of a hierarchical cartesian grid.
+    The base grid has shape cells in box, and each refinement level halves
+    the cells; a leaf is given as (level, i, j, k) with the indices at its
+    level.  At the finest level every leaf covers a contiguous range of
+    Morton codes, so the leaves sorted by the code of their lower corner
+    are searched (searchsorted, O(log n)) for a whole array of points.
+    The index can be given already built as its arrays() (e.g., shared
+    by other processes, see shmarrays) instead of the cells.  The cells
+    given are checked to cover the grid once (ValueError otherwise).
+    '''
+    def __init__(self, box, shape, maxlevel, cells=None, arrays=None):
+        self.box = np.asarray(box, dtype=np.float64)
+        self.shape = np.array(shape)
+        self.maxlevel = maxlevel
+        if np.any(self.shape << maxlevel > 2 ** 21):
+            raise ValueError('Too many cells per side for the index')
+        # Cell size at the finest level
+        self.delta = (self.box[:, 1] - self.box[:, 0]) / (self.shape << maxlevel)
+        if arrays is not None:
+            self.codes, self.order, self.level = arrays['codes'], arrays['order'], arrays['level']
+            return
+        cells = np.asarray(cells).reshape(-1, 4)
+        self.level = cells[:, 0].astype(np.intp)
+        if np.any((self.level < 0) | (self.level > maxlevel)):
+            raise ValueError('There are leaf cells with a level out of 0..{0}'.format(maxlevel))
+        if np.any((cells[:, 1:] < 0) | (cells[:, 1:] >= self.shape << self.level[:, np.newaxis])):
+            raise ValueError('There are leaf cells out of the grid')
+        finest = cells[:, 1:].astype(np.int64) << (maxlevel - self.level)[:, np.newaxis]
+        codes = morton(finest[:, 0], finest[:, 1], finest[:, 2])
+        self.order = np.argsort(codes, kind='mergesort')
+        self.codes = codes[self.order]
+        self.check()
+
+    def check(self):
+        '''
+        Raises ValueError unless the leaves cover the grid once: they don't
+        overlap (each one spans a range of codes up to the next one) and
+        their volume is the one of the grid.
+        '''
+        span = np.uint64(1) << (3 * (self.maxlevel - self.level[self.order])).astype(np.uint64)
+        if np.any(self.codes[1:] < self.codes[:-1] + span[:-1]):
+            raise ValueError('There are overlapping leaf cells')
+        if int(span.sum()) != int(np.prod(self.shape)) << (3 * self.maxlevel):
+            raise ValueError('The leaf cells do not cover the grid')
+
+    def arrays(self):
+        return {'codes': self.codes, 'order': self.order, 'level': self.level}
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.order.nbytes + self.level.nbytes
+
+    def finest(self, points):
+        '''Integer coordinates at the finest level (clipped to the grid)'''
+        cells = np.floor((points - self.box[:, 0]) / self.delta).astype(np.int64)
+        return np.clip(cells, 0, (self.shape << self.maxlevel) - 1)
+
+    def find(self, points):
+        '''
+        Returns the leaf (row of cells given) containing each point (n, 3);
+        points outside the box get the nearest leaf.
+        '''
+        cells = self.finest(np.asarray(points, dtype=np.float64).reshape(-1, 3))
+        position = np.searchsorted(self.codes, morton(cells[:, 0], cells[:, 1], cells[:, 2]),
+                                   side='right') - 1
+        return self.order[np.maximum(position, 0)]
+
+    def cell_size(self, leaves):
+        '''Size (n, 3) of the leaves'''
+        return self.delta * (1 << (self.maxlevel - self.level[leaves]))[:, np.newaxis]
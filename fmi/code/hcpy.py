@@ -1,16 +1,227 @@
+import argparse
+import os
+import json
+import tempfile
 import numpy as np
 import subprocess
+import threading
+import hcindex
+import shmarrays
 from itertools import izip
 
+# Variables that hcintpol derives from the ones stored in the file
+# name: (function, [stored variables needed])
+_ratio = lambda a, b: a / b
+_norm = lambda a, b, c: np.sqrt(a ** 2 + b ** 2 + c ** 2)
+derived_variables = {'vx': (_ratio, ['rhovx', 'rho']),
+                     'vy': (_ratio, ['rhovy', 'rho']),
+                     'vz': (_ratio, ['rhovz', 'rho']),
+                     'B':  (_norm, ['Bx', 'By', 'Bz']),
+                     'E':  (_norm, ['Ex', 'Ey', 'Ez'])}
+
+def run_table(cmd, x, y, z, chunksize=65536):
+    '''
+    Runs one of the hctools binaries (cmd as a list of arguments) feeding
+    the x, y, z coordinates to its stdin in chunks, while the table it
+    writes in stdout is read into a preallocated array.  So the memory
+    used does not depend on the text size of the whole request.
+    It returns the dictionary {var(from the # header): array} and stderr.
+    '''
+    x, y, z = [np.asarray(c, dtype=np.float64).ravel() for c in (x, y, z)]
+    npoints = len(x)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def write():
+        try:
+            for start in range(0, npoints, chunksize):
+                end = start + chunksize
+                np.savetxt(proc.stdin, np.column_stack((x[start:end], y[start:end], z[start:end])),
+                           fmt='%e')
+        except IOError:
+            pass  # it stopped reading (e.g., wrong variables)
+        finally:
+            proc.stdin.close()
+    errors = []
+    threads = [threading.Thread(target=write),
+               threading.Thread(target=lambda: errors.append(proc.stderr.read()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    header = []
+    table = None
+    nrows = 0
+    pending = []
+    def flush(table, nrows):
+        block = np.fromstring(''.join(pending), sep=' ').reshape(-1, len(header))
+        if nrows + len(block) > len(table):
+            table = np.resize(table, (max(2 * len(table), nrows + len(block)), len(header)))
+        table[nrows:nrows + len(block)] = block
+        del pending[:]
+        return table, nrows + len(block)
+
+    for line in iter(proc.stdout.readline, ''):
+        if line[0] in '#%':
+            if pending:
+                table, nrows = flush(table, nrows)
+            header = line[1:].split()
+            table = np.empty((max(npoints, 1), len(header)), order='F')
+            nrows = 0
+        elif header and line.strip():
+            pending.append(line)
+            if len(pending) == chunksize:
+                table, nrows = flush(table, nrows)
+    if pending:
+        table, nrows = flush(table, nrows)
+    proc.wait()
+    for thread in threads:
+        thread.join()
+
+    variables_out = {var: table[:nrows, i] for i, var in enumerate(header)}
+    return variables_out, ''.join(errors)
+
+sidecar_version = 1
+
+# 'layout' in the header of the files HCpy reads in-process (see HCpy)
+native_layout = 'numpy'
+
+def sidecar_name(filename):
+    return filename + '.idx.json'
+
+class HCFormatError(ValueError):
+    '''
+    The HC file can't be read in-process (e.g., refined grid without the
+    leaf table, a header without the grid description or a file whose
+    size is not the one its header describes). Use the hcintpol binary
+    instead.
+    '''
+    pass
+
 class HCpy(object):
-    def __init__(self, filename):
+    '''
+    Hybrid code (HC) file.  The layout of the hctools files is not
+    documented, so only the files whose header declares 'layout = numpy'
+    and describes the grid (n0, n1, n2 cells and the stored 'vars',
+    optionally the 'datatype', float32 by default) are interpolated
+    in-process; the rest are left to the hctools binaries.  Their data
+    follow the 'eoh' line as a C ordered array of shape
+    (n0, n1, n2, len(vars)) with the cell centred values, and the size of
+    the file is checked against the header before mapping them.
+
+    Refined grids (maxlevel > 0) of that layout also need 'ncells', the
+    number of leaf cells.  Then the data are an int32 array of shape
+    (ncells, 4) with the (level, i, j, k) of each leaf, the indices at its
+    level (where the grid has n0 * 2**level... cells), followed by the
+    values as an array of shape (ncells, len(vars)).  They are located
+    with hcindex.BlockIndex, which checks that the leaves cover the grid.
+
+    When the sidecar index (see write_sidecar) is fresher than the file,
+    the header, data offset and variables are taken from it, so the file
+    is not read (nor hcintpol run) to open it.
+    '''
+    def __init__(self, filename, sidecar=True):
         self.filename = filename
-        self.header = self._read(filename)
+        self.data = None
+        self.index = None
+        self._shared = None  # shmarrays key of the index
+        self._variables = None
+        sidecar = self._read_sidecar() if sidecar else None
+        if sidecar is not None:
+            self.header = sidecar['header']
+            self.offset = sidecar['offset']
+            self._variables = sidecar['variables']
+        else:
+            self.header = self._read(filename)
         self.hcdict = self._parseheader(self.header)
         limits = ['xmin0','xmax0', 'xmin1', 'xmax1', 'xmin2', 'xmax2']
         self.box = np.array([float(self.hcdict[x]) for x in limits]). \
                    reshape(3,2)
-        self.variables = self._extractvariables(filename)
+        if self.native:
+            self.stored = self.hcdict['vars'].split(',')
+            self._variables = self.stored + \
+                              [v for v, (f, needed) in sorted(derived_variables.items())
+                               if set(needed) <= set(self.stored)]
+
+    @property
+    def variables(self):
+        if self._variables is None:
+            # Just ask hcintpol when needed, it's a process launch
+            self._variables = self._extractvariables(self.filename)
+        return self._variables
+
+    @property
+    def known_variables(self):
+        '''The variables if they are known without running hcintpol, else None'''
+        return self._variables
+
+    @property
+    def native(self):
+        '''Whether the file can be interpolated without hcintpol'''
+        return (self.hcdict.get('layout') == native_layout and
+                all(key in self.hcdict for key in ['n0', 'n1', 'n2', 'vars']) and
+                (not self.refined or 'ncells' in self.hcdict))
+
+    @property
+    def refined(self):
+        return self.maxlevel > 0
+
+    @property
+    def maxlevel(self):
+        return int(self.hcdict.get('maxlevel', 0))
+
+    @property
+    def shape(self):
+        return tuple(int(self.hcdict[n]) for n in ['n0', 'n1', 'n2'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.hcdict.get('datatype', 'float32'))
+
+    def _read_sidecar(self):
+        '''The sidecar index if it's there and describes the file as it is now'''
+        try:
+            with open(sidecar_name(self.filename)) as f:
+                sidecar = json.load(f)
+            stat = os.stat(self.filename)
+        except (IOError, OSError, ValueError):
+            return None
+        if (sidecar.get('version') != sidecar_version or
+            sidecar.get('size') != stat.st_size or sidecar.get('mtime') != stat.st_mtime):
+            return None
+        return sidecar
+
+    def write_sidecar(self):
+        '''
+        Writes the sidecar index, filename.idx.json, with the header, the
+        box, the variables (asking hcintpol if needed), where the data
+        start and the dtype/shape of each block of data.
+        '''
+        if not self.variables:
+            raise HCFormatError('The variables of ' + self.filename + ' are unknown (is hcintpol in the path?)')
+        stat = os.stat(self.filename)
+        sidecar = {'version': sidecar_version,
+                   'size': stat.st_size, 'mtime': stat.st_mtime,
+                   'header': self.header, 'hcdict': self.hcdict,
+                   'box': self.box.tolist(), 'variables': self.variables,
+                   'offset': self.offset, 'blocks': []}
+        if self.native and self.refined:
+            ncells = int(self.hcdict['ncells'])
+            sidecar['blocks'] = [{'name': 'cells', 'offset': self.offset,
+                                  'dtype': 'int32', 'shape': [ncells, 4]},
+                                 {'name': 'values', 'offset': self.offset + ncells * 16,
+                                  'dtype': self.dtype.name, 'shape': [ncells, len(self.stored)]}]
+        elif self.native:
+            sidecar['blocks'] = [{'name': 'values', 'offset': self.offset,
+                                  'dtype': self.dtype.name, 'shape': list(self.shape) + [len(self.stored)]}]
+        name = sidecar_name(self.filename)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(name)), delete=False)
+        json.dump(sidecar, tmp, indent=1, sort_keys=True)
+        tmp.close()
+        os.chmod(tmp.name, 0o644)
+        os.rename(tmp.name, name)
+        return name
 
     def _read(self, filename):
         hcfile = open(filename, 'r')
@@ -19,6 +230,7 @@ class HCpy(object):
         while line != 'eoh\n':
             line = hcfile.readline()
             header.append(line)
+        self.offset = hcfile.tell()  # where the data start
         hcfile.close()
         headernew = [line.rstrip('\n') for line in header]
         return headernew[:-1]
@@ -49,41 +261,193 @@ class HCpy(object):
         x,y,z needs to be a list of numbers, not other type
         variables need to be a list too
         '''
-        cmd = 'hcintpol ' #Note, hcintpol needs to be in the path!
-        if linear:
-            cmd += ' -z '
+        cmd = ['hcintpol'] #Note, hcintpol needs to be in the path!
+        if not linear:
+            cmd += ['-z']
         if variables is not None:
-            cmd += ' -v '+ ','.join(variables)
-        cmd += ' ' + self.filename
-
-        # Coordinates single or multiple values
-        coordinates = ''
-        # check whether a list as input
-        try:
-            for i,j,k in izip(x, y, z):
-                coordinates += '{0:e} {1:e} {2:e}\n'.format(i, j, k)
-        except TypeError:
-            print('inputs x,y and z need to be a list\n')
-        except:
-            print('something went wrong\n')
-            raise
-            
-        # Execute the command
-        hc_in = subprocess.Popen(cmd, shell=True, 
-                                 stdout=subprocess.PIPE, 
-                                 stdin=subprocess.PIPE)
-        interpolatedvalues, error = hc_in.communicate(coordinates)
+            cmd += ['-v', ','.join(variables)]
+        cmd += [self.filename]
 
         # Extract the values as a dictionary {var(x,y,z,rho): [values]}
-        for line in interpolatedvalues.splitlines():
-            if line[0] == '#':
-                variables_list = line[1:].split()
-                variables_out = {var: [] for var in variables_list}
-            if line[0] != '#':
-                values = line.split()
-                for i,var in enumerate(variables_list):
-                    variables_out[var].append(float(values[i]))
+        variables_out, error = run_table(cmd, x, y, z)
+        return variables_out
+
+    def load(self):
+        '''
+        Memory maps the grid, so just the cells used are read from disk.
+        '''
+        if not self.native:
+            raise HCFormatError(self.filename + ' cannot be read in-process')
+        if self.data is None and self.refined:
+            ncells = int(self.hcdict['ncells'])
+            self._check_size(ncells * (16 + len(self.stored) * self.dtype.itemsize))
+            cells = np.memmap(self.filename, dtype=np.int32, mode='r',
+                              offset=self.offset, shape=(ncells, 4))
+            # The index is built once and shared by all the processes
+            # (the grid is already shared: it's mapped from the file)
+            def build():
+                try:
+                    return hcindex.BlockIndex(self.box, self.shape, self.maxlevel, cells).arrays()
+                except ValueError as e:
+                    raise HCFormatError('{0}: {1}'.format(self.filename, e))
+            self._shared = shmarrays.run_key(self.filename)
+            self.index = hcindex.BlockIndex(self.box, self.shape, self.maxlevel,
+                                            arrays=shmarrays.attach(self._shared, build))
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                  offset=self.offset + cells.nbytes,
+                                  shape=(ncells, len(self.stored)))
+        elif self.data is None:
+            self._check_size(np.prod(self.shape) * len(self.stored) * self.dtype.itemsize)
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                  offset=self.offset,
+                                  shape=self.shape + (len(self.stored),))
+        return self.data
+
+    def _check_size(self, nbytes):
+        '''Raises HCFormatError unless the data after the header take nbytes'''
+        size = os.path.getsize(self.filename)
+        if self.offset + nbytes != size:
+            raise HCFormatError('{0} has {1} bytes but its header describes {2}'.format(
+                self.filename, size, self.offset + nbytes))
+
+    def close(self):
+        '''Drops the grid and the shared index (e.g., evicted from hccache)'''
+        if self._shared is not None:
+            shmarrays.release(self._shared)
+            self._shared = None
+        self.data = None
+        self.index = None
 
+    def intpol(self, x, y, z, variables=None, linear=True):
+        '''
+        Vectorized version of hcintpol: x, y, z are arrays of coordinates
+        and it returns a dictionary {var(x,y,z,rho): array of values}.
+        Points outside the simulation box get NaN.
+        '''
+        if variables is None:
+            variables = self.stored
+        unknown = [v for v in variables if v not in self.variables]
+        if unknown:
+            raise KeyError('Unrecognized variable(s): ' + ', '.join(unknown))
+        data = self.load()
+        points = np.column_stack([np.asarray(x, dtype=np.float64).ravel(),
+                                  np.asarray(y, dtype=np.float64).ravel(),
+                                  np.asarray(z, dtype=np.float64).ravel()])
+        shape = np.array(self.shape)
+        delta = (self.box[:, 1] - self.box[:, 0]) / shape
+        outside = np.any((points < self.box[:, 0]) | (points > self.box[:, 1]), axis=1)
+        # position in cell units
+        cells = (points - self.box[:, 0]) / delta
+
+        # Stored variables needed for the ones requested
+        needed = []
+        for var in variables:
+            for v in (derived_variables[var][1] if var not in self.stored else [var]):
+                if v not in needed:
+                    needed.append(v)
+        columns = [self.stored.index(v) for v in needed]
+
+        if self.refined:
+            values = self._intpol_refined(points, columns, linear)
+        elif linear:
+            # Trilinear interpolation between cell centres
+            centres = cells - 0.5
+            index0 = np.clip(np.floor(centres).astype(np.intp), 0, np.maximum(shape - 2, 0))
+            weight = np.clip(centres - index0, 0, 1)
+            values = np.zeros((len(points), len(columns)))
+            for corner in range(8):
+                offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+                index = np.minimum(index0 + offset, shape - 1)
+                w = np.prod(np.where(offset, weight, 1 - weight), axis=1)
+                values += w[:, np.newaxis] * \
+                          data[index[:, 0], index[:, 1], index[:, 2]][:, columns]
+        else:
+            # Nearest grid point
+            index = np.clip(np.floor(cells).astype(np.intp), 0, shape - 1)
+            values = np.asarray(data[index[:, 0], index[:, 1], index[:, 2]][:, columns],
+                                dtype=np.float64)
+        values[outside, :] = np.nan
+
+        stored = {v: values[:, i] for i, v in enumerate(needed)}
+        variables_out = {'x': points[:, 0], 'y': points[:, 1], 'z': points[:, 2]}
+        for var in variables:
+            if var in self.stored:
+                variables_out[var] = stored[var]
+            else:
+                function, args = derived_variables[var]
+                variables_out[var] = function(*[stored[v] for v in args])
         return variables_out
 
-        pass
+    def _intpol_refined(self, points, columns, linear):
+        '''
+        Values of the columns at points in a refined grid.  The linear
+        interpolation is done between the centres of the cells (found with
+        the index) around each point at the size of the cell containing it,
+        so it's the trilinear one where the neighbours have the same level.
+        Where some are leaves of another level (or out of the box) their
+        centres are not the ones assumed, so a linear function is fitted
+        through the centres found instead (weighted as the trilinear
+        corners), which is exact for linear fields.
+        '''
+        index = self.index
+        leaves = index.find(points)
+        if not linear:
+            return np.asarray(self.data[leaves][:, columns], dtype=np.float64)
+        size = index.cell_size(leaves)
+        centres = (points - self.box[:, 0]) / size - 0.5
+        index0 = np.floor(centres)
+        weight = centres - index0
+        values = np.zeros((len(points), len(columns)))
+        corners = []
+        for corner in range(8):
+            offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            w = np.prod(np.where(offset, weight, 1 - weight), axis=1)
+            assumed = self.box[:, 0] + (index0 + offset + 0.5) * size
+            neighbours = np.clip(assumed, self.box[:, 0], self.box[:, 1])
+            found = index.find(neighbours)
+            corner_values = self.data[found][:, columns]
+            values += w[:, np.newaxis] * corner_values
+            corners.append((w, assumed, self._leaf_centre(neighbours, found), corner_values))
+        moved = np.zeros(len(points), dtype=bool)
+        for w, assumed, centre, corner_values in corners:
+            moved |= np.any(np.abs(centre - assumed) > 1e-6 * size, axis=1)
+        if moved.any():
+            values[moved] = self._fit_linear(points[moved], size[moved],
+                                             [(w[moved], centre[moved], corner_values[moved])
+                                              for w, assumed, centre, corner_values in corners])
+        return values
+
+    def _leaf_centre(self, points, leaves):
+        '''Centres of the leaves (containing the points)'''
+        size = self.index.cell_size(leaves)
+        cells = np.floor((points - self.box[:, 0]) / size)
+        cells = np.clip(cells, 0, np.round((self.box[:, 1] - self.box[:, 0]) / size) - 1)
+        return self.box[:, 0] + (cells + 0.5) * size
+
+    @staticmethod
+    def _fit_linear(points, size, corners):
+        '''
+        Value at points of the linear function fitted (weighted least
+        squares) to the values at the centres of the corners [(weight,
+        centre, values)].  The slopes are damped a bit, so along the
+        directions without different centres (e.g. at the faces of the
+        box) it's the weighted mean.
+        '''
+        rows = np.stack([np.column_stack((np.ones(len(points)), (centre - points) / size))
+                         for w, centre, corner_values in corners], axis=1)  # (n, 8, 4)
+        weights = np.stack([w for w, centre, corner_values in corners], axis=1) + 0.05
+        samples = np.stack([corner_values for w, centre, corner_values in corners], axis=1)  # (n, 8, ncolumns)
+        weighted = rows * weights[:, :, np.newaxis]
+        normal = np.einsum('nci,ncj->nij', weighted, rows)
+        normal[:, 1:, 1:] += 1e-9 * np.eye(3)
+        fitted = np.linalg.solve(normal, np.einsum('nci,ncv->niv', weighted, samples))
+        return fitted[:, 0, :]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the sidecar index (<file>.idx.json) of HC files, '
+                                                 'so they are opened without reading them')
+    parser.add_argument('files', nargs='+',
+                        help='HC files (hcintpol needs to be in the path for the non native ones)')
+    args = parser.parse_args()
+    for filename in args.files:
+        print HCpy(filename, sidecar=False).write_sidecar()
@@ -0,0 +1,135 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import numpy as np
+import hccache
+
+def is_series(filename):
+    '''Whether filename is a snapshot series (.series) instead of a run'''
+    return str(filename).endswith('.series')
+
+def _datetime64(time):
+    return np.datetime64(str(time).strip().rstrip('Z').replace(' ', 'T'), 'us')
+
+class Series(object):
+    '''
+    Snapshots of a dynamic run.  The .series file has a line per snapshot
+    with its time (iso8601) and its HC file (relative to the .series file),
+    e.g.:
+        # time                  snapshot
+        2014-01-01T00:00:00     run_0000.hc
+        2014-01-01T00:01:00     run_0060.hc
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        directory = os.path.dirname(os.path.abspath(filename))
+        snapshots = []
+        with open(filename) as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if not line:
+                    continue
+                if len(line) != 2:
+                    raise ValueError('Each line of {0} needs the time and the snapshot'.format(filename))
+                snapshots.append((_datetime64(line[0]), os.path.join(directory, line[1])))
+        if not snapshots:
+            raise ValueError('There are no snapshots in ' + filename)
+        snapshots.sort()
+        self.times = np.array([time for time, name in snapshots])
+        self.filenames = [name for time, name in snapshots]
+        if np.any(np.diff(self.times) == np.timedelta64(0, 'us')):
+            raise ValueError('There are snapshots with the same time in ' + filename)
+
+    def brackets(self, time):
+        '''
+        Returns the snapshots before and after each time (indices), the
+        weight of the one after and whether the time is within the series
+        '''
+        seconds = (np.asarray(time, dtype='datetime64[us]') - self.times[0]) / np.timedelta64(1, 's')
+        snapshots = (self.times - self.times[0]) / np.timedelta64(1, 's')
+        last = len(snapshots) - 1
+        before = np.clip(np.searchsorted(snapshots, seconds, side='right') - 1, 0, max(last - 1, 0))
+        after = np.minimum(before + 1, last)
+        span = snapshots[after] - snapshots[before]
+        weight = np.where(span > 0, (seconds - snapshots[before]) / np.where(span > 0, span, 1), 0.)
+        inside = (seconds >= snapshots[0]) & (seconds <= snapshots[-1])
+        return before, after, weight, inside
+
+class Window(object):
+    '''
+    Interpolates points with a time in a Series: in space with
+    intpol(filename, x, y, z) -> ({var: values}, warnings) and linearly in
+    time between the snapshots before and after each point.  The points are
+    sorted by the snapshot before them, whatever the order of their times,
+    and the snapshots are visited in time order, each one interpolated once
+    for all the points that need it.  It can be called again for the next
+    chunk of an orbit (see getDataPointValue_spacecraft): the last two
+    snapshots are still open, so an orbit forward in time reads each
+    snapshot once; a chunk going back before them opens those again.
+    The window keeps at most two of the snapshots it opened resident on top
+    of the run cache: those that were already in hccache.runs are not
+    closed by the window and stay there (within run_cache_bytes) as any
+    other run.
+    '''
+    def __init__(self, series, intpol):
+        self.series = series
+        self.intpol = intpol
+        self.opened = set()  # runs opened for this window (not already cached)
+
+    def interpolate(self, time, x, y, z):
+        x, y, z = [np.asarray(c, dtype=np.float64) for c in (x, y, z)]
+        before, after, weight, inside = self.series.brackets(time)
+        # Weight of each snapshot for every point (none for those out of the series)
+        use_before = inside & (weight < 1)
+        use_after = inside & (weight > 0)
+        # The points sorted by the snapshot before them, so those of
+        # snapshot k (after k - 1 or before k) are a block
+        order = np.argsort(before, kind='mergesort')
+        starts = np.searchsorted(before[order], np.arange(len(self.series.filenames) + 1))
+        result = None
+        warnings = []
+        for k in np.unique(np.concatenate((before[use_before], after[use_after]))):
+            block = order[starts[max(k - 1, 0)]:starts[k + 1]]
+            take_before = use_before[block] & (before[block] == k)
+            take_after = use_after[block] & (after[block] == k)
+            take = take_before | take_after
+            rows = block[take]
+            weights = (np.where(take_before, 1 - weight[block], 0.) +
+                       np.where(take_after, weight[block], 0.))[take]
+            self._slide(k)
+            filename = self.series.filenames[k]
+            if filename not in hccache.runs:
+                self.opened.add(filename)
+            values, warning = self.intpol(filename, x[rows], y[rows], z[rows])
+            if len(values.keys()) < 4:
+                return values, warning
+            if warning:
+                warnings.append(warning)
+            if result is None:
+                result = {var: np.zeros(len(x)) for var in values.keys() if var not in ['x', 'y', 'z']}
+            for var in result.keys():
+                result[var][rows] += weights * np.asarray(values[var], dtype=np.float64)
+        if result is None:
+            return {}, 'No point is within the time of the snapshots'
+        outside = np.count_nonzero(~inside)
+        for var in result.keys():
+            result[var][~inside] = np.nan
+        if outside:
+            warnings.append('{0} points are out of the time of the snapshots'.format(outside))
+        result.update({'x': x, 'y': y, 'z': z})
+        return result, '\n'.join(warnings)
+
+    def _slide(self, k):
+        '''Closes the snapshots (opened here) before k - 1'''
+        for filename in self.series.filenames[:max(k - 1, 0)]:
+            self._release(filename)
+
+    def _release(self, filename):
+        if filename in self.opened:
+            self.opened.discard(filename)
+            hccache.runs.invalidate(filename)
+
+    def close(self):
+        for filename in list(self.opened):
+            self._release(filename)
@@ -11,17 +11,61 @@ import astropy.io.votable as votable
 import astropy.units as u
 import astropy.constants as const
 from  scipy.io import netcdf
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None  # Just needed for the netcdf4 output
 from itertools import izip
-import urllib2
-import StringIO
+import urlfetch
 import tempfile
 import datetime
 import ConfigParser
 import traceback
+import socket
+import signal
+import errno
+import hashlib
+import base64
+import struct
+import shutil
+import fcntl
+import grp
+import time
+import uuid
+import multiprocessing
+import hcpy
+import hccache
+import hcseries
+import fieldtrace
+import stages
+import shmarrays
+import files
+import xml.etree.cElementTree as ElementTree
 
 impex_cfg = ConfigParser.RawConfigParser()
 impex_cfg.read('fmi/code/fmi.cfg')  # Is there a way to don't parse the path this way?
 
+def _cfg(option, default = None):
+    '''
+    Returns the option from the [fmi] section of fmi.cfg or the default
+    value when the option is not set there.
+    '''
+    if impex_cfg.has_option('fmi', option):
+        return impex_cfg.get('fmi', option)
+    return default
+
+# Input urls are kept in a local cache, revalidated on each request
+urlfetch.fetcher = urlfetch.Fetcher(_cfg('urlcache', os.path.join(tempfile.gettempdir(), 'impex_urlcache')),
+                                    timeout = float(_cfg('url_timeout', 30)),
+                                    max_bytes = int(_cfg('urlcache_bytes', 1024 ** 3)),
+                                    local_dir = _cfg('url_local_dir') or None)
+
+# Opened simulation runs are kept between requests (see --serve)
+hccache.runs.max_bytes = int(_cfg('run_cache_bytes', hccache.runs.max_bytes))
+shmarrays.directory = _cfg('shm_dir', shmarrays.directory)
+stages.logfile = _cfg('timing_log')
+stages.summary = bool(int(_cfg('timing_summary', 0)))
+
 # Definitions for fields #
 fields_props = {'x':     {'name': 'posx', 'ucd': 'pos.cartesian.x', 'units': u.m, 'type': 'double', 'size': '1'},
                 'y':     {'name': 'posy', 'ucd': 'pos.cartesian.y', 'units': u.m, 'type': 'double', 'size': '1'},
@@ -46,8 +90,8 @@ fields_props = {'x':     {'name': 'posx', 'ucd': 'pos.cartesian.x', 'units': u.m
                 'Bz' :   {'name': 'Bz','ucd': 'phys.magField', 'units': u.T, 'type': 'double', 'size': '1'},
                 'B'  :   {'name': 'B','ucd': 'phys.magField', 'units': u.T, 'type': 'double', 'size': '1'},
                 'Ex' :   {'name': 'Ex','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'},
-                'Ey' :   {'name': 'Ex','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'},
-                'Ez' :   {'name': 'Ex','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'},
+                'Ey' :   {'name': 'Ey','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'},
+                'Ez' :   {'name': 'Ez','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'},
                 'E'  :   {'name': 'E','ucd': 'phys.electField', 'units': u.V / u.m ** 2, 'type': 'double', 'size': '1'}, 
                 'Time':  {'name': 'Date', 'ucd': 'time', 'units': 'iso-8601', 'type': 'char', 'size': '*'},
                 'mass':  {'name': 'Mass', 'ucd': 'phys.mass', 'units': u.kilogram, 'type':'double', 'size': '1'},
@@ -58,6 +102,8 @@ def query2string(query):
     finalstring = 'Result provided by impex-fp7 project with query {\n '
     # TODO! Try in case it does not have keys
     for key in query:
+        if key.startswith('_'):
+            continue  # internal
         if key == 'variables':
             finalstring += key + ': ' + ','.join(query[key]) + ';\n '
         else:
@@ -66,72 +112,204 @@ def query2string(query):
     finalstring += '}\n == Query executed on: ' + datetime.datetime.now().isoformat() + '==\n'
     return finalstring
 
+# Units of the AMDA orbits (planet radius)
+planets = {'Rv': 6051*u.km, 'Rm': 3396*u.km, 'Re': 6371*u.km}  #TODO: check values!
+
 def _vot2points_amda(vot):
-    planets = {'Rv': 6051*u.km, 'Rm': 3396*u.km, 'Re': 6371*u.km}  #TODO: check values!
     points = {}
     table = vot.get_first_table()
     data = table.array
-    time = []
-    coord = np.empty((3,len(data)))
-    for i, element in enumerate(data):
-        time.append(element[0])
-        coord[:,i] = element.tolist()[1:4]
-    points['Time'] = time
-    axes = ['x', 'y', 'z']
+    # Time and the coordinates (in planet radius) as whole columns
+    points['Time'] = iso2datetime64(data[table.fields[0].ID].data)
+    coord = np.hstack([np.asarray(data[field.ID].data, dtype=np.float64).reshape(len(data), -1)
+                       for field in table.fields[1:]])[:, :3]
     units = planets[str(table.fields[1].unit)]
     value = coord * units.si.value
-    points['x'] = value[0,:]
-    points['y'] = value[1,:]
-    points['z'] = value[2,:]
+    points['x'] = value[:,0]
+    points['y'] = value[:,1]
+    points['z'] = value[:,2]
     return points
 
+# ucd of the inputs: key in fields_props (but velocities, found by name)
+input_ucds = {fields_props[key]['ucd']: key for key in ['x', 'y', 'z', 'mass', 'charge', 'Time']}
+
 def vot2points(filename):
     '''
     It produces a dictionary with the arrays for each of the fields we use in the other functions
     '''
-    # Work around for AMDA tables
     vot = votable.parse(filename, pedantic = False)
+    # Work around for AMDA tables
     if vot.description == 'Generated by CDPP/AMDA':
         return _vot2points_amda(vot)
     # back to normal...
-    vot = votable.parse_single_table(filename, pedantic = False)
+    table = vot.get_first_table()
     axis = ['x', 'y', 'z']
-    types = ['pos.cartesian.'+l for l in axis] + ['phys.veloc', 'phys.mass', 'phys.atmol.charge', 'time']
     points = {}
-    for column in vot.iter_fields_and_params():
-        ucd = str(column.ucd)
-        if ucd.lower() in types:
-            if ucd.lower() == types[3]:
-                # Create the points for the velocity 
-                findaxis = lambda x: x in column.name.lower()
-                mask = map(findaxis, axis)
-                if True in mask:
-                    column_name = 'v'+axis[mask.index(True)]
-                    column_unit = column.unit if column.unit is not None else fields_props[column_name]['units']
-                    column_values = vot.array[column.ID].data * column_unit
-                    points[column_name] = column_values.si.value.reshape((len(column_values),))
-            else:
-                # Create the points for the rest
-                for key in fields_props.keys():
-                    if ucd.lower() == fields_props[key]['ucd']:
-                        #column_unit = column.unit if column.unit is not None else fields_props[key]['units']
-                        if (column.unit is not None and ucd.lower() != 'time'):
-                            column_values = (vot.array[column.ID].data * column.unit).si.value  
-                        else:
-                            column_values = vot.array[column.ID].data
-                        points[key] = column_values.reshape((len(column_values),))
+    for column in table.fields:
+        ucd = str(column.ucd).lower()
+        if ucd == 'phys.veloc':
+            # Create the points for the velocity 
+            found = [ax for ax in axis if ax in column.name.lower()]
+            if not found:
+                continue
+            key = 'v' + found[0]
+        elif ucd in input_ucds:
+            # Create the points for the rest
+            key = input_ucds[ucd]
+        else:
+            continue
+        column_values = table.array[column.ID].data
+        column_values = column_values.reshape((len(column_values),))
+        if key == 'Time':
+            column_values = iso2datetime64(column_values)
+        else:
+            column_unit = column.unit if column.unit is not None else fields_props[key]['units']
+            # The whole column converted at once
+            column_values = np.asarray(column_values, dtype=np.float64) * column_unit.si.scale
+        points[key] = column_values
+    return points
+
+def _unit_scale(unit, key):
+    ''' Scale to SI of the unit (a string as in the VOTable) of key '''
+    if not unit:
+        return fields_props[key]['units'].si.scale
+    for unit_format in ['vounit', 'cds', 'generic']:
+        try:
+            return u.Unit(unit, format = unit_format).si.scale
+        except ValueError:
+            continue
+    raise ValueError('Unknown unit ' + unit + ' for ' + key)
+
+def _rows2points(fields, rows, amda):
+    '''
+    Converts the rows (lists of TD strings) of a TABLEDATA into the points
+    dictionary, as vot2points does with the whole table.
+    '''
+    points = {}
+    column = lambda i: [row[i] if i < len(row) else '' for row in rows]
+    if amda:
+        # Time and the coordinates (in planet radius)
+        points['Time'] = iso2datetime64(np.array(column(0)))
+        coord = np.array(' '.join(' '.join(row[1:]) for row in rows).split(),
+                         dtype=np.float64).reshape(len(rows), -1)[:, :3]
+        coord *= planets[fields[1].get('unit')].si.value
+        points['x'], points['y'], points['z'] = coord[:, 0].copy(), coord[:, 1].copy(), coord[:, 2].copy()
+        return points
+    axis = ['x', 'y', 'z']
+    for i, field in enumerate(fields):
+        ucd = field.get('ucd', '').lower()
+        if ucd == 'phys.veloc':
+            found = [ax for ax in axis if ax in field.get('name', '').lower()]
+            if not found:
+                continue
+            key = 'v' + found[0]
+        elif ucd in input_ucds:
+            key = input_ucds[ucd]
+        else:
+            continue
+        if key == 'Time':
+            points[key] = iso2datetime64(np.array(column(i)))
+        else:
+            values = np.array(' '.join(value or 'nan' for value in column(i)).split(), dtype=np.float64)
+            points[key] = values * _unit_scale(field.get('unit'), key)
     return points
 
+def iter_vot2points(filename, chunksize):
+    '''
+    Generator version of vot2points: it reads the first table of the
+    VOTable incrementally and yields its points in chunks of chunksize
+    rows, so the memory used does not depend on the size of the table.
+    Just TABLEDATA is streamed; other serializations are read whole.
+    '''
+    tag = lambda elem: elem.tag.rsplit('}', 1)[-1]
+    fields = []
+    rows = []
+    amda = False
+    depth = 0
+    tabledata = None
+    for event, elem in ElementTree.iterparse(filename, events = ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if tag(elem) in ['BINARY', 'BINARY2', 'FITS']:
+                break
+            if tag(elem) == 'TABLEDATA':
+                tabledata = elem
+            continue
+        depth -= 1
+        name = tag(elem)
+        if name == 'DESCRIPTION' and depth == 1:
+            amda = (elem.text or '').strip() == 'Generated by CDPP/AMDA'
+        elif name == 'FIELD':
+            fields.append(dict(elem.attrib))
+        elif name == 'TR':
+            rows.append([(td.text or '').strip() for td in elem])
+            if len(rows) == chunksize:
+                yield _rows2points(fields, rows, amda)
+                rows = []
+                tabledata.clear()
+        elif name == 'TABLE':
+            if rows:
+                yield _rows2points(fields, rows, amda)
+            return
+    else:
+        return
+    # Not TABLEDATA
+    points = vot2points(filename)
+    for start in range(0, len(points['x']), chunksize):
+        yield {key: values[start:start + chunksize] for key, values in points.items()}
+
+def _vot_columns(columns):
+    '''
+    Order of the columns in the tables: Time (if any) goes first, then
+    x, y, z and the rest of variables.
+    '''
+    var = sorted(key for key in columns.keys() if key != 'Time' and columns[key] is not None)
+    var = var[-3:] + var[:-3]
+    if columns.get('Time') is not None:
+        var = ['Time'] + var
+    return var
+
+def _vot_table(vot, columns, time = None):
+    '''
+    Creates a votable table with a field per variable in columns (dict of
+    arrays) and fills it a column at a time.  Time (if any) goes first,
+    then x, y, z and the rest of variables.
+    '''
+    table = votable.tree.Table(vot)
+
+    if columns.get('Time') is None and time is not None:
+        columns = dict(columns, Time = time)
+    var = _vot_columns(columns)
+
+    units = lambda x: fields_props[x]['units'].to_string('cds') if x != 'Time' else fields_props[x]['units']
+    fields = [votable.tree.Field(vot, name=fields_props[v]['name'], datatype=fields_props[v]['type'],
+                                 arraysize=fields_props[v]['size'], unit=units(v),  #arraysize is creating an array of shape (lines, 1)
+                                 ucd=fields_props[v]['ucd']) for v in var]
+    table.fields.extend(fields)
+
+    nrows = len(columns[var[0]]) if var else 0
+    table.create_arrays(nrows)
+    for field, v in zip(fields, var):
+        if v == 'Time':
+            table.array[field.ID] = datetime642iso(columns[v]).astype(object)
+        else:
+            values = np.asarray(columns[v], dtype=np.float64)
+            table.array[field.ID] = values.reshape(table.array[field.ID].shape)
+    table.array.mask = False
+    return table
+
 def points2vot(filename, points_d, query, time = None):
     #'''
     #filename where to write the votable
     #points_d points dictionary where the key is the variable and it contains a list of its values
     #query    the query made to get this votable
+    #         'votable_format' in the query selects the serialization:
+    #         tabledata (default), binary or binary2
     #'''
     # as explained in
     # https://astropy.readthedocs.org/en/latest/io/votable/index.html#building-a-new-table-from-scratch
 
-    vot = votable.tree.VOTableFile()
+    vot = votable.tree.VOTableFile(version = '1.3')  # 1.3 is needed for binary2
 
     resource = votable.tree.Resource()
     vot.resources.append(resource)
@@ -143,85 +321,60 @@ def points2vot(filename, points_d, query, time = None):
 
     params.description = query2string(query)
 
-    # TODO, FIXME! This can be done in less lines!
-    if points_d.has_key('line_00'):
+    if _has_lines(points_d):
         for key in sorted(points_d.keys()): # line_00, line_01, ...
-            line = points_d[key]
-            table = votable.tree.Table(vot)
-            resource.tables.append(table)
-
+            table = _vot_table(vot, points_d[key], time)
             table.description = key  # line_00, ..
-
-            var = sorted(line.keys())
-            if time is None: # Does it make sense having time here, field lines or trajectories does not produce times
-                var = var[-3:] + var[:-3]
-            else:
-                var = ['Time'] + var[-3:] + var[:-3]
-
-            fields = [votable.tree.Field(votable, name=fields_props[v]['name'], datatype=fields_props[v]['type'], 
-                                         unit=fields_props[v]['units'].to_string('cds'), arraysize=fields_props[v]['size'],  #arraysize is creating an array of shape (lines, 1)
-                                         ucd=fields_props[v]['ucd']) for v in var if line[v] is not None]
-            table.fields.extend(fields)
-
-            # points_d dict to array
-            points_array = np.array([map(float, line[x]) for x in var if line[x] is not None]).transpose() #NOTE: this assumes we are just passing numbers!
-            table.create_arrays(points_array.shape[0])
-    
-            if time is None:
-                points_mask = np.ma.masked_array(points_array, mask = False)
-                table.array = points_mask
-            else:
-                for i, line in enumerate(time):
-                    table.array[i] = tuple(time[i]) + tuple(points_array[i, :])
-
+            resource.tables.append(table)
     else:  # There are just the variables (not lines)
         # Tabular information
-        table = votable.tree.Table(vot)
-        resource.tables.append(table)
+        resource.tables.append(_vot_table(vot, points_d, time))
 
-        var = sorted(points_d.keys())
-        if points_d.has_key('Time'):
-            time = points_d['Time']
-            
-        if time is None:
-            var = var[-3:] + var[:-3]
-        else:
-            var.remove('Time')
-            var = ['Time'] + var[-3:] + var[:-3]
-        units = lambda x: fields_props[x]['units'].to_string('cds') if x != 'Time' else fields_props[x]['units']
-        fields = [votable.tree.Field(votable, name=fields_props[v]['name'], datatype=fields_props[v]['type'], 
-                                     arraysize=fields_props[v]['size'], unit=units(v), 
-                                     ucd=fields_props[v]['ucd']) for v in var if points_d[v] is not None]
-        table.fields.extend(fields)
-
-        # points_d dict to array
-        points_array = np.array([map(float, points_d[x]) for x in var if (x != 'Time' and points_d[x] is not None)]).transpose() #NOTE: this assumes we are just passing numbers!
-        table.create_arrays(points_array.shape[0])
-
-        if time is None:
-            points_mask = np.ma.masked_array(points_array, mask = False)
-            table.array = points_mask
-        else:
-            for i, line in enumerate(time):
-                table.array[i] = tuple([time[i]]) + tuple(points_array[i, :])
+    tabledata_format = query.get('votable_format', _cfg('votable_format', 'tabledata')).lower()
+    vot.to_xml(filename, tabledata_format = tabledata_format)
 
-    vot.to_xml(filename)
+def iso2datetime64(time):
+    '''
+    It converts a column of iso8601 times (strings, with or without
+    fractional seconds, a trailing Z or a space instead of the T) into a
+    numpy.datetime64 array.  datetime64 arrays are returned as they are.
+    '''
+    time = np.asarray(time)
+    if time.dtype.kind == 'M':
+        return time
+    time = np.char.strip(time.astype(str))
+    time = np.char.replace(np.char.rstrip(time, 'Z'), ' ', 'T')
+    return time.astype('datetime64[us]')
+
+def datetime642iso(time):
+    ''' numpy.datetime64 array to iso8601 strings '''
+    return np.datetime_as_string(iso2datetime64(time))
+
+def _time2seconds(time):
+    '''
+    It converts the iso8601 times to seconds from the first one.
+    Returns the seconds and the first time.
+    '''
+    time = iso2datetime64(time)
+    return (time - time[0]) / np.timedelta64(1, 's'), datetime642iso(time[:1])[0]
 
 def points2netcdf(filename, points_d, query, time = None):
     f = netcdf.netcdf_file(filename, 'w')
     f.history = query2string(query)
 
+    if not _has_lines(points_d) and 'Time' in points_d:
+        points_d = points_d.copy()
+        time = points_d.pop('Time')
+
     if time is not None:
         # convert time to seconds from first point
-        iso8601_fmt = '%Y-%m-%dT%H:%M:%S.%f'
         f.createDimension('time', len(time))
         time_n = f.createVariable('time', 'd', ('time',))
-        time_n.units = 'Seconds since ' + time[0]
-        time = [datetime.datetime.strptime(x, iso8601_fmt) for x in time]
-        time_n[:] = [(x-time[0]).total_seconds()  for x in time] 
+        time_n[:], start = _time2seconds(time)
+        time_n.units = 'seconds since ' + start
 
     # TODO, FIXME! This can be done in less lines!
-    if points_d.has_key('line_00'):
+    if _has_lines(points_d):
         for key in sorted(points_d.keys()):  #line_00, line_01, ...
             dim = 'dim_' + key
             f.createDimension(dim, len(points_d[key]['x']))
@@ -239,59 +392,522 @@ def points2netcdf(filename, points_d, query, time = None):
             key_n[:] = points_d[key]
     f.close()
 
+def _netcdf4_variable(f, name, values, dim, units):
+    '''Chunked and deflate compressed float64 variable'''
+    size = len(values)
+    chunks = {'chunksizes': (min(size, 65536),)} if size > 0 else {'contiguous': True}
+    variable = f.createVariable(name, 'f8', (dim,), zlib = True, complevel = 4,
+                                shuffle = True, **chunks)
+    variable.units = units
+    variable[:] = values
+    return variable
+
+def points2netcdf4(filename, points_d, query, time = None):
+    '''
+    Writes the points as NetCDF4 (HDF5) with chunked, compressed variables.
+    Lines (line_00, ...) are stored one after the other along the 'obs'
+    dimension (CF contiguous ragged array) with their sizes in 'rowSize'.
+    '''
+    if netCDF4 is None:
+        raise ImportError('The netCDF4 module is needed for the netcdf4 output')
+    f = netCDF4.Dataset(filename, 'w', format = 'NETCDF4')
+    f.history = query2string(query)
+    f.Conventions = 'CF-1.6'
+
+    if _has_lines(points_d):
+        keys = sorted(points_d.keys()) #line_00, line_01, ...
+        lines = [points_d[key] for key in keys]
+        sizes = [len(line['x']) for line in lines]
+        f.featureType = 'trajectory'
+        f.createDimension('line', len(keys))
+        f.createDimension('obs', sum(sizes))
+        names = f.createVariable('line', str, ('line',))
+        names.cf_role = 'trajectory_id'
+        for i, key in enumerate(keys):
+            names[i] = key
+        rowsize = f.createVariable('rowSize', 'i4', ('line',))
+        rowsize.long_name = 'number of points of each line'
+        rowsize.sample_dimension = 'obs'
+        rowsize[:] = sizes
+        variables = sorted(set(v for line in lines for v in line.keys() if v in fields_props and v != 'Time'))
+        for v in variables:
+            values = np.concatenate([np.asarray(line[v], dtype=np.float64) if line.get(v) is not None
+                                     else np.nan * np.empty(size) for line, size in zip(lines, sizes)])
+            _netcdf4_variable(f, fields_props[v]['name'], values, 'obs',
+                              fields_props[v]['units'].to_string('cds'))
+    else:
+        if points_d.get('Time') is not None:
+            time = points_d['Time']
+        variables = [v for v in sorted(points_d.keys()) if v != 'Time' and points_d[v] is not None]
+        f.createDimension('dim', len(points_d[variables[0]]))
+        for v in variables:
+            _netcdf4_variable(f, fields_props[v]['name'], np.asarray(points_d[v], dtype=np.float64),
+                              'dim', fields_props[v]['units'].to_string('cds'))
+        if time is not None:
+            # convert time to seconds from first point
+            seconds, start = _time2seconds(time)
+            _netcdf4_variable(f, 'time', seconds, 'dim', 'seconds since ' + start)
+    f.close()
+
+# Inputs already fetched in this request (url: (path, sha1)), see cached_result
+_fetched = {}
+
+def _fetch(url):
+    '''
+    Fetches url through the local cache (see urlfetch), returns the
+    path to the local copy and the sha1 of its content.
+    '''
+    url = url.replace('\\','')
+    if url not in _fetched:
+        with stages.stage('fetch') as record:
+            _fetched[url] = urlfetch.fetch(url)
+            record['bytes'] = os.path.getsize(_fetched[url][0])
+    return _fetched[url]
+
 def _url2points(url):
     url_XYZ = url
-    response = urllib2.urlopen(url_XYZ.replace('\\',''))
-    votfile = StringIO.StringIO()
-    votfile.write(response.read())
-    return vot2points(votfile)
+    path, digest = _fetch(url_XYZ)
+    # Parsed from the local copy
+    with stages.stage('parse') as record:
+        points = vot2points(path)
+        record['points'] = len(points['x'])
+    return points
 
 def _writeout(dict_input, values):
+    with stages.stage('write') as record:
+        outname = _write_file(dict_input, values)
+        record['bytes'] = os.path.getsize(outname)
+    return outname
+
+def _write_file(dict_input, values):
     # write in the fileformat requested
-    write_file = {'votable': points2vot, 'netcdf': points2netcdf}
+    write_file = {'votable': points2vot, 'netcdf': points2netcdf, 'netcdf4': points2netcdf4}
+    if '_outname' in dict_input:
+        # Name given by cached_result, written in a temporary file first
+        # so nobody sees it half written
+        outname = dict_input['_outname']
+        outfile = tempfile.NamedTemporaryFile(prefix = os.path.basename(outname) + '.', dir = os.path.dirname(outname), delete = False)
+        outfile.close()
+        try:
+            write_file[dict_input['OutputFiletype']](outfile.name, values, dict_input)
+            os.chmod(outfile.name, 0o644)
+            os.rename(outfile.name, outname)
+        finally:
+            if os.path.exists(outfile.name):
+                os.unlink(outfile.name)
+        return outname
     # - Create file
     outfile = tempfile.NamedTemporaryFile(prefix = 'hwa_', dir = impex_cfg.get('fmi', 'diroutput'), suffix = '.'+dict_input['OutputFiletype'])
     outfile.close()
     write_file[dict_input['OutputFiletype']](outfile.name, values, dict_input)
     return outfile.name
 
+def _tabledata_doubles(values):
+    ''' The values as TABLEDATA writes doubles (NaN, +Inf, -Inf) '''
+    values = np.asarray(values, dtype=np.float64).ravel()
+    strings = np.char.mod('%r', values).astype(object)
+    strings[np.isnan(values)] = 'NaN'
+    strings[values == np.inf] = '+Inf'
+    strings[values == -np.inf] = '-Inf'
+    return strings
+
+def _tabledata_rows(columns, var):
+    ''' The TR elements of the rows of columns (the fields in var) '''
+    strings = [datetime642iso(columns[v]) if v == 'Time' else _tabledata_doubles(columns[v])
+               for v in var]
+    return ''.join('<TR><TD>' + '</TD><TD>'.join(row) + '</TD></TR>\n' for row in izip(*strings))
+
+def _binary_rows(columns, var, binary2):
+    '''
+    The bytes of the rows of columns (the fields in var) as in a BINARY
+    stream, or in a BINARY2 one (with the null flags before each row)
+    '''
+    doubles = [v for v in var if v != 'Time']
+    raw = np.column_stack([np.asarray(columns[v], dtype=np.float64).ravel()
+                           for v in doubles]).astype('>f8').tobytes()
+    width = 8 * len(doubles)
+    flags = '\0' * ((len(var) + 7) // 8) if binary2 else ''
+    if 'Time' not in var:
+        return ''.join(flags + raw[i:i + width] for i in xrange(0, len(raw), width))
+    # Time goes first, with its length (arraysize *)
+    return ''.join(flags + struct.pack('>I', len(time)) + time + raw[i * width:(i + 1) * width]
+                   for i, time in enumerate(datetime642iso(columns['Time'])))
+
+# DATA element of each votable_format (around the rows)
+vot_data = {'tabledata': ('<DATA>\n<TABLEDATA>\n', '</TABLEDATA>\n</DATA>\n'),
+            'binary': ('<DATA>\n<BINARY>\n<STREAM encoding="base64">\n', '</STREAM>\n</BINARY>\n</DATA>\n'),
+            'binary2': ('<DATA>\n<BINARY2>\n<STREAM encoding="base64">\n', '</STREAM>\n</BINARY2>\n</DATA>\n')}
+
+class PointsStream(object):
+    '''
+    Writes the points in the OutputFiletype a chunk (dictionary of arrays,
+    same variables each time) at a time, so they don't need to be in
+    memory at once.  The file is written with a temporary name and gets
+    its final name (returned by close) when it's complete.
+    The VOTable rows (in the votable_format) are written as they come and
+    the header (written by points2vot for no rows) is put before them at
+    close, so it has the warnings of all the chunks; so is the history of
+    the netcdf output.  The netcdf output needs the netCDF4 module to be
+    streamed, otherwise the chunks are kept and written at the end.
+    '''
+    def __init__(self, dict_input):
+        self.query = dict_input
+        self.filetype = dict_input['OutputFiletype']
+        if self.filetype == 'netcdf4' and netCDF4 is None:
+            raise ImportError('The netCDF4 module is needed for the netcdf4 output')
+        if self.filetype == 'votable':
+            self.vot_format = dict_input.get('votable_format', _cfg('votable_format', 'tabledata')).lower()
+            if self.vot_format not in vot_data:
+                raise ValueError('Unknown votable_format ' + self.vot_format)
+        if '_outname' in dict_input:
+            self.outname = dict_input['_outname']
+        else:
+            outfile = tempfile.NamedTemporaryFile(prefix = 'hwa_', dir = impex_cfg.get('fmi', 'diroutput'),
+                                                  suffix = '.' + self.filetype, delete = False)
+            outfile.close()
+            self.outname = outfile.name
+        outfile = tempfile.NamedTemporaryFile(prefix = os.path.basename(self.outname) + '.',
+                                              dir = os.path.dirname(self.outname), delete = False)
+        outfile.close()
+        self.tmpname = outfile.name
+        self.rowsname = self.tmpname + '.rows'  # VOTable rows
+        self.nrows = 0
+        self.f = None
+        self.chunks = []
+        self.warnings = []
+
+    def write(self, columns, warnings = ''):
+        ''' Writes the chunk columns; warnings (hcintpol's) go to the header '''
+        if warnings and warnings not in self.warnings:
+            self.warnings.append(warnings)
+        if self.filetype == 'votable':
+            self._write_vot(columns)
+        elif netCDF4 is not None:
+            self._write_netcdf(columns)
+        else:
+            self.chunks.append(columns)
+        self.nrows += len(columns['x'])
+
+    def _write_vot(self, columns):
+        if self.f is None:
+            self.var = _vot_columns(columns)
+            self.empty = {v: columns[v][:0] for v in self.var}  # for the header
+            self.f = open(self.rowsname, 'wb')
+            self.pending = ''  # the base64 stream is encoded 3 bytes at a time
+        if self.vot_format == 'tabledata':
+            self.f.write(_tabledata_rows(columns, self.var))
+            return
+        data = self.pending + _binary_rows(columns, self.var, self.vot_format == 'binary2')
+        end = len(data) - len(data) % 3
+        self.f.write(base64.encodestring(data[:end]))
+        self.pending = data[end:]
+
+    def _write_netcdf(self, columns):
+        var = [v for v in _vot_columns(columns) if v != 'Time']
+        if self.f is None:
+            if self.filetype == 'netcdf4':
+                self.f = netCDF4.Dataset(self.tmpname, 'w', format = 'NETCDF4')
+                self.f.Conventions = 'CF-1.6'
+                options = {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunksizes': (65536,)}
+            else:
+                self.f = netCDF4.Dataset(self.tmpname, 'w', format = 'NETCDF3_CLASSIC')
+                options = {}
+            self.f.history = query2string(self.query)
+            self.f.createDimension('dim', None)
+            for v in var:
+                variable = self.f.createVariable(fields_props[v]['name'], 'f8', ('dim',), **options)
+                variable.units = fields_props[v]['units'].to_string('cds')
+            if columns.get('Time') is not None:
+                self.start = iso2datetime64(columns['Time'][:1])[0]
+                variable = self.f.createVariable('time', 'f8', ('dim',), **options)
+                variable.units = 'seconds since ' + datetime642iso(self.start)
+        end = self.nrows + len(columns['x'])
+        for v in var:
+            self.f.variables[fields_props[v]['name']][self.nrows:end] = columns[v]
+        if columns.get('Time') is not None:
+            seconds = (iso2datetime64(columns['Time']) - self.start) / np.timedelta64(1, 's')
+            self.f.variables['time'][self.nrows:end] = seconds
+
+    def close(self):
+        if self.warnings:
+            self.query['hc_warnings'] = '\n'.join(self.warnings)
+        if self.filetype == 'votable' and self.f is not None:
+            self._close_vot()
+        elif self.f is not None:
+            if self.warnings:
+                self.f.history = query2string(self.query)
+            self.f.close()
+        elif self.chunks:
+            points = {key: np.concatenate([chunk[key] for chunk in self.chunks])
+                      for key in self.chunks[0].keys()}
+            self.chunks = []
+            points2netcdf(self.tmpname, points, self.query)
+        os.chmod(self.tmpname, 0o644)
+        os.rename(self.tmpname, self.outname)
+        return self.outname
+
+    def _close_vot(self):
+        if self.pending:
+            self.f.write(base64.encodestring(self.pending))
+        self.f.close()
+        # The header and the end of the table of no rows: the rows go in
+        # its DATA (the last element of the TABLE)
+        points2vot(self.tmpname, self.empty, dict(self.query, votable_format = 'tabledata'))
+        text = open(self.tmpname).read()
+        end = text.rindex('</TABLE>')
+        start, stop = vot_data[self.vot_format]
+        with open(self.tmpname, 'wb') as f:
+            f.write(text[:end] + start)
+            with open(self.rowsname, 'rb') as rows:
+                shutil.copyfileobj(rows, f, 1024 * 1024)
+            f.write(stop + text[end:])
+        os.unlink(self.rowsname)
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+        for name in [self.tmpname, self.rowsname] + ([self.outname] if '_outname' not in self.query else []):
+            if os.path.exists(name):
+                os.unlink(name)
+
+def result_key(dict_input):
+    '''
+    Hash of the query: the dictionary sent by PHP (in canonical form),
+    the modification time of the simulation file and the content of the
+    input url.
+    '''
+    query = {key: value for key, value in dict_input.items()
+             if not key.startswith('_') and key not in ['hc_warnings', 'ion_warnings', 'suggested_stepsize', 'async', 'timing']}
+    key = hashlib.sha1(json.dumps(query, sort_keys = True))
+    filename = str(dict_input.get('filename', '')).replace('\\','')
+    if os.path.exists(filename):
+        key.update(repr(os.stat(filename).st_mtime))
+        if hcseries.is_series(filename):
+            for snapshot in hcseries.Series(filename).filenames:
+                if os.path.exists(snapshot):
+                    key.update(repr(os.stat(snapshot).st_mtime))
+    if dict_input.get('url_XYZ'):
+        key.update(_fetch(dict_input['url_XYZ'])[1])
+    return key.hexdigest()
+
+def _evict_results(keep = None):
+    '''
+    Removes the cached results older than result_cache_age (seconds) and
+    then the oldest ones until they take less than result_cache_bytes, and
+    the lock files of the results that are not there (and nobody holds).
+    The result keep (just produced) is never removed.  It's done by one
+    worker at a time, at most once every result_cache_interval seconds.
+    '''
+    diroutput = impex_cfg.get('fmi', 'diroutput')
+    max_age = float(_cfg('result_cache_age', 7 * 24 * 3600))
+    max_bytes = int(_cfg('result_cache_bytes', 10 * 1024 ** 3))
+    interval = float(_cfg('result_cache_interval', 60))
+    stamp = open(os.path.join(diroutput, 'hwa_evicted'), 'a')
+    try:
+        try:
+            fcntl.flock(stamp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return  # another worker is at it
+        now = time.time()
+        if now - os.fstat(stamp.fileno()).st_mtime < interval:
+            return
+        os.utime(stamp.name, None)
+        results = []
+        locks = []
+        for name in os.listdir(diroutput):
+            if not name.startswith('hwa_c') or name == os.path.basename(str(keep)):
+                continue
+            path = os.path.join(diroutput, name)
+            if name.endswith('.answer'):
+                continue  # goes with its result
+            if name.endswith('.lock'):
+                locks.append(path)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed by somebody else
+            if now - stat.st_mtime > max_age:
+                files.unlink(path)
+                files.unlink(path + '.answer')
+            else:
+                results.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in results)
+        for mtime, size, path in sorted(results):
+            if total <= max_bytes:
+                break
+            files.unlink(path)
+            files.unlink(path + '.answer')
+            total -= size
+        for path in locks:
+            _remove_lock(path)
+    finally:
+        stamp.close()
+
+def _remove_lock(path):
+    '''
+    Removes the lock file (and the answer) of a result if the result is
+    not there and nobody is holding it (see _lock_result)
+    '''
+    try:
+        lock = open(path, 'r')
+    except IOError:
+        return
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not os.path.exists(path[:-len('.lock')]):
+            files.unlink(path[:-len('.lock')] + '.answer')
+            files.unlink(path)
+    except IOError:
+        pass  # being computed or served
+    finally:
+        lock.close()
+
+def _lock_result(outname):
+    '''
+    Opens and locks outname.lock.  As the lock files of the results that
+    are not there get removed (see _evict_results), it's tried again when
+    the file locked is not the one in the directory anymore.
+    '''
+    while True:
+        lock = open(outname + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(outname + '.lock').st_ino:
+                return lock
+        except OSError:
+            pass  # removed meanwhile
+        lock.close()
+
+def _read_answer(outname):
+    ''' The rest of the answer of the cached result outname (see cached_result) '''
+    try:
+        with open(outname + '.answer') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _result_name(dict_input):
+    ''' Name of the file with the result of the query (see result_key) '''
+    return os.path.join(impex_cfg.get('fmi', 'diroutput'),
+                        'hwa_c' + result_key(dict_input) + '.' + dict_input['OutputFiletype'])
+
+def cached_result(function):
+    '''
+    Decorator for the methods so identical queries (see result_key) get
+    the out_url of the file already produced.  A lock per query makes
+    concurrent identical requests wait for the first one instead of
+    computing it again.  Disabled with result_cache = 0 in fmi.cfg.
+    The variables are checked first (see _check_request), so a request
+    that will be rejected does not fetch the input for the key.  The rest
+    of the answer (e.g. 'skipped') is kept in <result>.answer for the hits.
+    '''
+    def cached(dict_input):
+        try:
+            error = _check_request(dict_input)
+            if error:
+                return {'out_url':'', 'error':error}
+            if not int(_cfg('result_cache', 1)):
+                return function(dict_input)
+            # The name may be set already when it was submitted as a job
+            with stages.stage('cache') as record:
+                outname = dict_input.get('_outname') or _result_name(dict_input)
+                lock = _lock_result(outname)
+                record['hit'] = os.path.exists(outname)
+            try:
+                if record['hit']:
+                    os.utime(outname, None)  # recently used
+                    outjson = _read_answer(outname)
+                    outjson.update({'out_url': impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname),
+                                    'error': ''})
+                    return outjson
+                dict_input['_outname'] = outname
+                outjson = function(dict_input)
+                answer = {key: value for key, value in outjson.items() if key not in ['out_url', 'error']}
+                if answer and not outjson.get('error') and os.path.exists(outname):
+                    _write_json(outname + '.answer', answer)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+            _evict_results(keep = outname)
+            return outjson
+        finally:
+            _fetched.clear()
+    cached.__name__ = function.__name__
+    cached.__doc__ = function.__doc__
+    return cached
+
 def _table2dict(table):
     '''
-    It reads an array of lines with space separated values
-    into a dictionary of the header variables
+    It reads an array of lines (or a string) with space separated values
+    into a dictionary of the header variables (the last line starting
+    with # or %) with a contiguous float64 array per variable.  Blank
+    lines are skipped, the values after the variables of a line are
+    ignored and a line with less values raises ValueError.
     '''
+    if isinstance(table, basestring):
+        table = table.splitlines()
+    variables_list = None
+    data = []
     for line in table:
-        if (line[0] == '%') or (line[0] == '#'):
+        if (line[:1] == '%') or (line[:1] == '#'):
             variables_list = line[1:].split()
-            variables_out = {var: [] for var in variables_list}
-        else:  
-            values = line.split()
-            for i, var in enumerate(variables_list):   # If 1st line is not # or % with variables, then this fails!
-                variables_out[var].append(float(values[i]))
-    return variables_out
+        elif line.strip():
+            data.append(line)
+    if not variables_list:
+        raise ValueError('The table has no header line (# or %) with the variables')
+    nvars = len(variables_list)
+    values = np.fromstring(' '.join(data), sep=' ')
+    if len(values) == len(data) * nvars:
+        values = values.reshape(-1, nvars)
+    else:
+        # Not the same number of values per line: one at a time
+        rows = [line.split() for line in data]
+        short = [n for n, row in enumerate(rows) if len(row) < nvars]
+        if short:
+            raise ValueError('Line {0} of the table has less than {1} values'.format(short[0] + 1, nvars))
+        values = np.array([row[:nvars] for row in rows], dtype=np.float64).reshape(-1, nvars)
+    values = np.ascontiguousarray(values.transpose())
+    return {var: values[i] for i, var in enumerate(variables_list)}
+
+def _line_name(line, nlines):
+    '''
+    line_00, line_01, ... zero padded to the number of lines so they sort
+    in order (line_000 ... when there are more than 100)
+    '''
+    return 'line_{0:0{1}d}'.format(line, max(2, len(str(nlines - 1))))
 
-def _writeout_ion(dict_input, values):
-    #read result file
-    #results = open(resultfile, 'r')     # TODO: If to do in a general way this should either get a stdout (eg., fieldline tracer)
+def _has_lines(points_d):
+    ''' Whether points_d contains lines (line_00, B_line_00, ...) or just variables '''
+    return any(key.startswith('line_') or '_line_' in key for key in points_d)
+
+def _group_lines(values, prefix=''):
+    '''
+    Groups the rows of a table with a parID column (as a dictionary or the
+    text lines of the tracers' output) into {prefix + line_NN: {var: array}}
+    '''
     # Extracts {x:[...], y:[...], z:[...], pairID:[...]}
-    variables = _table2dict(values)
-    #results.close()
+    # (unless values are already a dictionary)
+    variables = values if isinstance(values, dict) else _table2dict(values)
 
-    # number of ion paths
-    # Each path has a number > 0.  So, we count these pairs > 0
-    # (len(pairs) is always going to be larger than pairID)
+    # Each path has a number > 0 (parID).  Sort the rows by it (stable, so
+    # each path keeps its order) and split them into a view per path.
     pairs = variables['parID']
-    ind_paths = [l for l in range(1, len(pairs)) if pairs.count(l) > 0]
-    ion_paths = len(ind_paths)# - ind_paths.count(0) (they are not already.)
+    rows = np.flatnonzero(pairs > 0)
+    rows = rows[np.argsort(pairs[rows], kind='mergesort')]
+    ind_paths, starts, counts = np.unique(pairs[rows], return_index=True, return_counts=True)
+    ion_paths = len(ind_paths)
+    ends = starts + counts
+
+    sorted_variables = {l: variables[l][rows] for l in fields_props.keys() if l in variables.keys()}
+    variables_lines = {}
+    for line in range(ion_paths):
+        variables_lines[prefix + _line_name(line, ion_paths)] = {l: values[starts[line]:ends[line]]
+                                                                 for l, values in sorted_variables.items()}
+    return variables_lines
 
-    variables_lines = {'line_{:02d}'.format(x):{} for x in range(ion_paths)}
-    line = 0
-    for elem in ind_paths:
-        if elem != 0: # It should never be == 0 after the condition added in ind_paths
-            variables_lines['line_{:02d}'.format(line)]={l: [x for i,x in enumerate(variables[l]) if pairs[i] == elem] for l in fields_props.keys() if l in variables.keys()}
-            line += 1
-
-    return _writeout(dict_input, variables_lines)
+def _writeout_ion(dict_input, values):
+    return _writeout(dict_input, _group_lines(values))
  
 
 def iontracer_writecfg(dict_input, points):
@@ -373,109 +989,220 @@ def iontracer_writecfg(dict_input, points):
     return cfgfile.name
 
 
+def _check_variables(filename, variables):
+    '''
+    Returns the error message for the variables that the run does not have
+    ('' if it has all of them, or they can't be known without running the
+    hctools, i.e., non native runs without the sidecar index, see hcpy).
+    '''
+    if isinstance(variables, basestring):
+        variables = variables.split(',')
+    try:
+        known = hccache.open_run(_first_run(filename)).known_variables
+    except (IOError, OSError, KeyError, ValueError):
+        return ''  # let the tools report about the file
+    if known is None:
+        return ''
+    unknown = [v for v in variables if v not in known]
+    if unknown:
+        return 'ERROR: Unrecognized variable names: ' + ', '.join(unknown)
+    return ''
+
+def _check_request(dict_input):
+    '''
+    _check_variables for the variables of a request (the components of
+    the fields for getFieldLine), '' for the methods without variables.
+    '''
+    if 'variables' not in dict_input:
+        return ''
+    filename = str(dict_input['filename']).replace('\\','')
+    variables = dict_input['variables']
+    if dict_input.get('function') == 'getFieldLine':
+        variables = [field + ax for field in _field_names(variables) for ax in 'xyz']
+    return _check_variables(filename, variables)
+
+def _first_run(filename):
+    '''The run, or the first snapshot of a series (for the box and variables)'''
+    if hcseries.is_series(filename):
+        return hcseries.Series(filename).filenames[0]
+    return filename
+
+def _series_window(filename, variables, linear):
+    '''hcseries.Window to interpolate in time and space in the snapshots of filename'''
+    return hcseries.Window(hcseries.Series(filename),
+                           lambda snapshot, x, y, z: hcintpol(snapshot, x, y, z, variables=variables,
+                                                              linear=linear))
+
 def hcintpol(filename, x, y, z, variables=None, linear=True):
     '''
     x,y,z needs to be a list of numbers, not other type
     variables need to be a list too
+    The file is interpolated in-process when hcpy can read it, otherwise
+    the hcintpol binary is executed.
     '''
-    cmd = os.path.join(impex_cfg.get('fmi','bindir'),'hcintpol') 
+    with stages.stage('interpolate', points=len(x)):
+        try:
+            hc = hccache.open_run(filename)
+            if hc.native:
+                return hc.intpol(x, y, z, variables=variables, linear=linear), ''
+        except (hcpy.HCFormatError, KeyError, IOError, OSError):
+            pass  # let hcintpol deal with it (and report the errors)
+        return _run_hcintpol(filename, x, y, z, variables, linear)
+
+def _run_hcintpol(filename, x, y, z, variables, linear):
+
+    cmd = [os.path.join(impex_cfg.get('fmi','bindir'),'hcintpol')]
     if not linear:
-        cmd += ' -z '
+        cmd += ['-z']
     if variables is not None:
-        cmd += ' -v '+ ','.join(variables)
-        cmd += ' ' + filename
+        cmd += ['-v', ','.join(variables)]
+    cmd += [filename]
 
-    # Coordinates single or multiple values
-    coordinates = ''
-    # check whether a list as input
-    try:
-        for i,j,k in izip(x, y, z):
-            coordinates += '{0:e} {1:e} {2:e}\n'.format(i, j, k)
-    except TypeError:
-        print('inputs x, y and z need to be a list\n')
-    except:
-        print('something went wrong\n')
-        raise
+    # Coordinates are streamed to hcintpol and the values read back
+    # as a dictionary {var(x,y,z,rho): [values]}
+    return hcpy.run_table(cmd, x, y, z)
 
-    # Execute the command
-    hc_in = subprocess.Popen(cmd, shell=True, 
-                             stdout=subprocess.PIPE, 
-                             stdin=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    interpolatedvalues, error = hc_in.communicate(coordinates) 
-
-    # Extract the values as a dictionary {var(x,y,z,rho): [values]}
-    variables_out = _table2dict(interpolatedvalues.splitlines())
-    return variables_out, error
+def _field_names(variables):
+    '''
+    Vector fields to trace from the requested variables, e.g.,
+    'B', ['Bx', 'E'] or 'B,v' => ['B'], ['B', 'E'], ['B', 'v']
+    '''
+    if isinstance(variables, basestring):
+        variables = variables.split(',')
+    fields = []
+    for variable in variables:
+        variable = variable.strip()
+        if len(variable) > 1 and variable[-1] in 'xyz':
+            variable = variable[:-1]  # Bx => B
+        if variable and variable not in fields:
+            fields.append(variable)
+    return fields
 
 def hcfieldline(filename, file_start, variables = None, radius = 0,
                 stop_box = None, max_step = None, step_size = 1, 
                 direction = 'Forward', linear=True):
     '''
     wrapper to call the ft function from hctools.
-    x,y,z:
-    variables: 
+    file_start: file with the starting points (x y z per line); ft traces
+                all of them in a single run.
+    variables: vector field to follow (eg, B or Bx)
     '''
 
-    cmd = os.path.join(impex_cfg.get('fmi', 'bindir'), 'ft')
+    cmd = [os.path.join(impex_cfg.get('fmi', 'bindir'), 'ft')]
 
     if not linear:
-        cmd += ' -z '
+        cmd += ['-z']
 
     if direction.lower() == 'backward':
-        cmd += ' -b '
+        cmd += ['-b']
 
     if radius != 0:
-        cmd += ' -r {:f} '.format(radius)
+        cmd += ['-r', '{:f}'.format(radius)]
 
     if (stop_box is not None):
         if (len(stop_box) == 6):
-            cmd += ' -l ' + ','.join(str(x) for x in stop_box)
+            cmd += ['-l', ','.join(str(x) for x in stop_box)]
         else: 
             raise Exception('stop_box can just work with 6 values')
     
     if (max_step is not None):
-        cmd += ' -ms {:d} '.format(max_step)
+        cmd += ['-ms', '{:d}'.format(max_step)]
 
     if (step_size != 1):
-        cmd += ' -ss {:f} '.format(step_size)
+        cmd += ['-ss', '{:f}'.format(step_size)]
 
-    axis = ['x', 'y', 'z']
-    if (variables in [variables[0] + ax for ax in axis]):
-        cmd += variables[0]
-    else:
-        cmd += variables # FixMe! This assumes a single variable!
+    cmd += _field_names(variables)[:1]
 
-    cmd += ' ' + filename
+    cmd += [filename]
 
-    cmd += ' -i ' + file_start
+    cmd += ['-i', file_start]
     
-    ft_in = subprocess.Popen(cmd, shell=True,
-                             stdout=subprocess.PIPE, 
-                             stderr=subprocess.PIPE)
-    fieldline, error = ft_in.communicate() 
+    with stages.stage('ft') as record:
+        ft_in = subprocess.Popen(cmd,
+                                 stdout=subprocess.PIPE, 
+                                 stderr=subprocess.PIPE)
+        fieldline, error = ft_in.communicate() 
+        record['bytes'] = len(fieldline)
              
     # Extract the 6 columns (coordinates and fields - x,y,z) into a dict
     #variables_out = _table2dict(fieldline.splitlines())
     return fieldline, error
 
+def _trace_method(dict_input):
+    '''
+    The method and tolerance (None for the default) to trace the field
+    lines: those of the request, else fieldline_method and
+    fieldline_tolerance (fmi.cfg).  ValueError for an unknown method.
+    '''
+    method = dict_input.get('method') or _cfg('fieldline_method', 'midpoint')
+    if method not in fieldtrace.methods:
+        raise ValueError('Unknown method ' + str(method) + ' (' + ', '.join(fieldtrace.methods) + ')')
+    tolerance = dict_input.get('tolerance') or _cfg('fieldline_tolerance', '')
+    return method, float(tolerance) if tolerance else None
 
+def _trace_native(filename, fields, points, dict_input, linear=True):
+    '''
+    Traces the lines of all the starting points for each field in the run
+    (opened once through the run cache), one batched pass per field.
+    Returns {field: {line_NN: {x, y, z, Fx, Fy, Fz}}}.
+    '''
+    stop_box = dict_input.get('stop_box')
+    tracker = fieldtrace.Fieldtrack(filename,
+                                    stop_minradius=float(dict_input.get('stop_radius') or 0),
+                                    stop_box=stop_box if stop_box else None)
+    hc = tracker.hc
+    unknown = [f for f in fields if not all(f + ax in hc.variables for ax in 'xyz')]
+    if unknown:
+        raise KeyError('Unrecognized variable(s): ' + ', '.join(unknown))
+    seeds = np.column_stack((points['x'], points['y'], points['z']))
+    # No MaxSteps (PHP sends null) is ft's default
+    maxsteps = int(dict_input.get('maxsteps') or _cfg('fieldline_maxsteps', 100))
+    method, tolerance = _trace_method(dict_input)
+    traced = {}
+    for field in fields:
+        with stages.stage('trace', field=field, seeds=len(seeds), scheme=method) as record:
+            lines = tracker.track_many(seeds, field,
+                                       stepsize=float(dict_input['stepsize']),
+                                       maxstep=maxsteps,
+                                       direction=dict_input['direction'].lower(),
+                                       method=method,
+                                       tolerance=tolerance,
+                                       linear=linear)
+            record['nevals'] = tracker.nevals
+            # The field along all the lines in a single interpolation
+            steps = np.concatenate(lines)
+            record['points'] = len(steps)
+            components = [field + ax for ax in 'xyz']
+            values = hc.intpol(steps[:, 0], steps[:, 1], steps[:, 2],
+                               variables=components, linear=linear)
+        ends = np.cumsum([len(line) for line in lines])
+        starts = ends - np.array([len(line) for line in lines])
+        traced[field] = {_line_name(line, len(lines)): {v: values[v][starts[line]:ends[line]]
+                                                        for v in ['x', 'y', 'z'] + components}
+                         for line in range(len(lines))}
+    return traced
+
+@stages.traced
+@cached_result
 def getDataPointValue(dict_input):
     '''
     Executes the method with the same name.  The input has to be a dictionary
     with all the parameters needed, they are:
     -function: getDataPointValue
-    -filename: filename (with path) to the requested ResourceID
+    -filename: filename (with path) to the requested ResourceID, or a
+               snapshot series (.series, see hcseries) to interpolate the
+               points in time too (they need Time then)
     -variables: List of variables
     -url_XYZ: url address to the input data
     -IMFClockAngle: Not used here, yet.
     -InterpolationMethod: whether lineal or not
-    -OutputFiletype: which kind (netcdf, votable)
+    -OutputFiletype: which kind (netcdf, netcdf4, votable)
     '''
     outjson = {'out_url':'', 'error':'' }
     # TODO: read config file, paths...
     # Get filename - TODO: Check whether it's right/accessible
     filename = dict_input['filename']
+    # The variables are checked already (see cached_result)
     # Check variables is a proper list (Needed?)
     # Check Interpolation Method
     if (dict_input['order'] == 'nearestgridpoint'):
@@ -488,11 +1215,28 @@ def getDataPointValue(dict_input):
     x, y, z = points['x'], points['y'], points['z']
 
     # Run hcintpol with the the file, coordinates, var and intpol method
-    filename = str(dict_input['filename'])
-    result, hcerror = hcintpol(filename.replace('\\',''), 
-                      x, y, z, 
-                      variables=dict_input['variables'], 
-                      linear=linear)
+    filename = str(dict_input['filename']).replace('\\','')
+    if hcseries.is_series(filename):
+        if points.get('Time') is None:
+            outjson['error'] = 'ERROR: The points need Time to be interpolated in a snapshot series'
+            return outjson
+        try:
+            window = _series_window(filename, dict_input['variables'], linear)
+        except (IOError, ValueError) as e:
+            outjson['error'] = 'ERROR: ' + str(e)
+            return outjson
+        try:
+            result, hcerror = window.interpolate(iso2datetime64(points['Time']), x, y, z)
+        finally:
+            window.close()
+        if not result:
+            outjson['error'] = 'ERROR: ' + hcerror
+            return outjson
+    else:
+        result, hcerror = hcintpol(filename,
+                          x, y, z, 
+                          variables=dict_input['variables'], 
+                          linear=linear)
     if (len(result.keys()) < 4):
         outjson['error'] = 'ERROR: Unrecognized variable names \n hcintpol message:\n' + hcerror
         return outjson
@@ -510,23 +1254,31 @@ def getDataPointValue(dict_input):
     outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname)
     return outjson
 
+@stages.traced
+@cached_result
 def getFieldLine(dict_input):
     '''
     Executes the method with such name. The input needs to be a dictionary with 
     the following parameters:
     -function: getFieldLine
     -filename: filename (with path) to the requested ResourceID
-    -variables: Variable desired to follow the fieldline #todo: what if more than one?
+    -variables: Vector field(s) to follow, eg 'B' or ['B', 'E', 'v']
     -direction: Direction on how to follow the fieldline (forward or backward)
     -stepsize: Size of the step in m.
     -maxsteps: Maximum number of steps to follow the field.
     -stop_radius: Lower limit as radius in m on the simulation box.
     -stop_box: Edge limits as box coordinates in m: [x0, x1, y0, y1, z0, z1]
-    -url_XYZ: url address to the input data
-    -OutputFiletype: which kind (netcdf, votable)
-
-    Attention, at the moment this works just for one variable and one initial point. 
-    So, it returns just one fieldline.
+    -url_XYZ: url address to the input data, one line per starting point
+    -method: optional, midpoint, rk4 or rk45 (native runs only),
+             fieldline_method (fmi.cfg) by default
+    -tolerance: optional, error per step of rk45 in m, fieldline_tolerance
+                (fmi.cfg) by default, else stepsize/1000
+    -OutputFiletype: which kind (netcdf, netcdf4, votable)
+
+    All the starting points are traced together, in one pass per field.
+    Native runs are traced in-process with the run cache; otherwise ft is
+    run once per field.  The lines are line_00, line_01... for a single
+    field, and B_line_00, ..., E_line_00, ... for several.
 
     Attention, Default is linear interpolation.  If zeroth order required, then need to be implemented in the Method's input (php) and then here!
     '''
@@ -535,42 +1287,155 @@ def getFieldLine(dict_input):
     
     outjson = {'out_url':'', 'error':''}
 
+    filename = str(dict_input['filename']).replace('\\','')
+    fields = _field_names(dict_input['variables'])
+    prefix = lambda field: field + '_' if len(fields) > 1 else ''
+    try:
+        _trace_method(dict_input)
+    except ValueError as e:
+        outjson['error'] = 'ERROR: ' + str(e)
+        return outjson
     points = _url2points(dict_input['url_XYZ'])
 
-    # Starting points to file
-    startfile = tempfile.NamedTemporaryFile(prefix = 'hwa_ft_', dir = impex_cfg.get('fmi', 'diroutput'), suffix = '.cfg', delete = False)
-    startfile_str = ''
-    for index, elem in enumerate(points['x']):
-        startfile_str += '{0:f} {1:f} {2:f}\n'.format(points['x'][index], points['y'][index], points['z'][index])
-    startfile.write(startfile_str)
-    startfile.close()
-
-    # Run fieldline tracer with the the file, coordinates, var and intpol method
-    filename = str(dict_input['filename'])
-    result, hcerror = hcfieldline(filename.replace('\\',''),  #TODO: FIXME, check parms!
-                                  file_start = startfile.name,
-                                  variables=dict_input['variables'], # fixme: what if we have mult vars?
-                                  radius = dict_input['stop_radius'],
-                                  stop_box = dict_input['stop_box'],
-                                  max_step = dict_input['maxsteps'],
-                                  step_size = dict_input['stepsize'],
-                                  direction = dict_input['direction'],
-                                  linear = True)
-    # TODO! Any error message to stop execution? => outjson['error']
-
-    # any other warnings:
-    if (hcerror != ''):
-        dict_input['hc_warnings'] = hcerror
-        
-    outname = _writeout_ion(dict_input, result.splitlines()) #Fixme: if we want to provide multiple input points or variables this needs also to apply.
+    lines = {}
+    try:
+        native = hccache.open_run(filename).native
+    except (IOError, OSError, KeyError, ValueError):
+        native = False  # let ft report about the file
+    if native:
+        try:
+            traced = _trace_native(filename, fields, points, dict_input, linear=True)
+        except KeyError as e:
+            outjson['error'] = 'ERROR: ' + e.args[0]
+            return outjson
+        for field in fields:
+            lines.update({prefix(field) + name: line for name, line in traced[field].items()})
+    else:
+        # Starting points to file
+        startfile = tempfile.NamedTemporaryFile(prefix = 'hwa_ft_', dir = impex_cfg.get('fmi', 'diroutput'), suffix = '.cfg', delete = False)
+        np.savetxt(startfile, np.column_stack((points['x'], points['y'], points['z'])), fmt='%f')
+        startfile.close()
+
+        # Run fieldline tracer with the the file, coordinates, var and intpol method
+        warnings = []
+        try:
+            for field in fields:
+                result, hcerror = hcfieldline(filename,
+                                              file_start = startfile.name,
+                                              variables=field,
+                                              radius = dict_input['stop_radius'],
+                                              stop_box = dict_input['stop_box'],
+                                              max_step = dict_input['maxsteps'],
+                                              step_size = dict_input['stepsize'],
+                                              direction = dict_input['direction'],
+                                              linear = True)
+                if (hcerror != ''):
+                    warnings.append(hcerror)
+                with stages.stage('parse_output'):
+                    lines.update(_group_lines(result, prefix(field)))
+        finally:
+            os.unlink(startfile.name)
+        # TODO! Any error message to stop execution? => outjson['error']
+
+        # any other warnings:
+        if warnings:
+            dict_input['hc_warnings'] = '\n'.join(warnings)
+
+    if not lines:
+        outjson['error'] = 'ERROR: No field line could be traced for ' + ', '.join(fields)
+        return outjson
+
+    outname = _writeout(dict_input, lines)
     outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname)
 
     return outjson
 
+@stages.traced
+@cached_result
 def getDataPointValue_spacecraft(dict_input):
-    pass
+    '''
+    getDataPointValue for long (time tagged) orbits.  The input has the
+    same parameters as getDataPointValue; the orbit is streamed in chunks
+    of spacecraft_chunk (fmi.cfg) samples from its file through the
+    interpolation to the output file, so the memory used is bounded.
+    The samples outside the simulation box are skipped (their number is
+    in the answer as 'skipped') and Time is kept when the orbit has it.
+    For a snapshot series the samples out of its time are skipped too, and
+    the snapshots are kept open from one chunk to the next (see hcseries).
+    '''
+    outjson = {'out_url':'', 'error':''}
+    filename = str(dict_input['filename']).replace('\\','')
+    linear = dict_input['order'] != 'nearestgridpoint'
+    try:
+        box = hccache.open_run(_first_run(filename)).box
+    except (IOError, OSError, KeyError, ValueError):
+        box = None  # let hcintpol report about the file
+    window = None
+    if hcseries.is_series(filename):
+        try:
+            window = _series_window(filename, dict_input['variables'], linear)
+        except (IOError, ValueError) as e:
+            outjson['error'] = 'ERROR: ' + str(e)
+            return outjson
+
+    path, digest = _fetch(dict_input['url_XYZ'])
+    chunksize = int(_cfg('spacecraft_chunk', 100000))
+    skipped = 0
+    stream = None
+    try:
+        for points in iter_vot2points(path, chunksize):
+            with stages.stage('parse', points=len(points['x'])):
+                coords = np.column_stack((points['x'], points['y'], points['z']))
+                inside = np.ones(len(coords), dtype=bool) if box is None else \
+                         np.all((coords >= box[:, 0]) & (coords <= box[:, 1]), axis=1)
+                if window is not None:
+                    if points.get('Time') is None:
+                        outjson['error'] = 'ERROR: The points need Time to be interpolated in a snapshot series'
+                        return outjson
+                    time = iso2datetime64(points['Time'])
+                    inside &= window.series.brackets(time)[3]
+                skipped += len(inside) - np.count_nonzero(inside)
+            if not inside.any():
+                continue
+            if window is not None:
+                result, hcerror = window.interpolate(time[inside], coords[inside, 0],
+                                                     coords[inside, 1], coords[inside, 2])
+            else:
+                result, hcerror = hcintpol(filename,
+                                           coords[inside, 0], coords[inside, 1], coords[inside, 2],
+                                           variables=dict_input['variables'],
+                                           linear=linear)
+            if (len(result.keys()) < 4):
+                outjson['error'] = 'ERROR: Unrecognized variable names \n hcintpol message:\n' + hcerror
+                return outjson
+            if points.get('Time') is not None:
+                result['Time'] = points['Time'][inside]
+            if stream is None:
+                stream = PointsStream(dict_input)
+            with stages.stage('write', points=np.count_nonzero(inside)):
+                stream.write(result, hcerror)
+        if stream is None:
+            outjson['error'] = 'ERROR: No sample of the orbit is within the simulation box'
+            if window is not None:
+                outjson['error'] += ' and the time of the snapshots'
+            return outjson
+        with stages.stage('write') as record:
+            outname = stream.close()
+            record['bytes'] = os.path.getsize(outname)
+        stream = None
+    finally:
+        if stream is not None:
+            stream.abort()
+        if window is not None:
+            window.close()
+
+    outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname)
+    outjson['skipped'] = int(skipped)
+    return outjson
 def getDataPointSpectra(dict_input):
     pass
+@stages.traced
+@cached_result
 def getSurface(dict_input):
     '''
     Executes the getDataPointValue but for an input plane
@@ -582,14 +1447,14 @@ def getSurface(dict_input):
     -resolution: space between the datapoints
     -IMFClockAngle: no used here (yet)
     -order: Interpolation method wanted, either lineal or nearestgridpoint
-    -OutputFiletype: netcdf or votable
+    -OutputFiletype: netcdf, netcdf4 or votable
     -box_min: Minimum points for the simulation box
     -box_max: Maximum points for the simulation box
     '''    
     outjson = {'out_url':'', 'error':'' }
     # Get filename - TODO: Check whether it's right/accessible
     filename = dict_input['filename']
-    # Check variables is a proper list (Needed?)
+    # The variables are checked already (see cached_result)
     # Check Interpolation Method
     if (dict_input['order'] == 'nearestgridpoint'):
         linear = False
@@ -611,25 +1476,29 @@ def getSurface(dict_input):
     # The following are pseudo x,y and z, we will get back to the right one using indices
     x_limits = np.arange(box_min[indices[0]], box_max[indices[0]], resolution)
     y_limits = np.arange(box_min[indices[1]], box_max[indices[1]], resolution)
-    xx, yy = np.meshgrid(x_limits, y_limits)
-    
-    # The eq of a plane is: a*x + b*y + c*z + d = 0
-    # [a,b,c] = vector
-    # d is obtained from the dot product 'point * normal' (above)
-    # the last plane coordinates are obtained as
-    zz = (-normal[indices[0]]*xx - normal[indices[1]]*yy - d)*1./normal[indices[2]]
 
-    # Convert from the pseudo xx,yy,zz to the real x,y,z
-    axis_order = ['x', 'y', 'z']
-    pseudo_plan = [xx, yy, zz]
-    points = {axis_order[ind]:pseudo_plan[i].flatten() for i,ind in enumerate(indices)}
+    # Split the plane in tiles of rows and interpolate them in parallel
+    rows = max(1, int(_cfg('surface_tile', 262144)) // max(1, len(x_limits)))
+    filename = str(dict_input['filename']).replace('\\','')
+    tiles = [(filename, x_limits, y_limits[i:i + rows], normal, indices, d,
+              dict_input['variables'], linear) for i in range(0, len(y_limits), rows)]
+    nworkers = int(_cfg('surface_workers', 0)) or multiprocessing.cpu_count()
+    if len(tiles) > 1 and nworkers > 1:
+        with stages.stage('interpolate_tiles', points=len(x_limits) * len(y_limits), tiles=len(tiles)):
+            pool = multiprocessing.Pool(min(nworkers, len(tiles)))
+            try:
+                results = pool.map(_surface_tile, tiles, chunksize=1)  # keeps the order
+            finally:
+                pool.close()
+                pool.join()
+    else:
+        results = map(_surface_tile, tiles)
 
-    # Run hcintpol with the the file, coordinates, var and intpol method
-    filename = str(dict_input['filename'])
-    result, hcerror = hcintpol(filename.replace('\\',''), 
-                      points['x'], points['y'], points['z'],
-                      variables=dict_input['variables'], 
-                      linear=linear)
+    # Put the tiles back together
+    hcerror = ''.join(sorted(set(error for tile, error in results)))
+    keys = set.intersection(*[set(tile.keys()) for tile, error in results]) if results else set()
+    result = {key: np.concatenate([np.asarray(tile[key], dtype=np.float64) for tile, error in results])
+              for key in keys}
     if (len(result.keys()) < 4):
         outjson['error'] = 'ERROR: Unrecognized variable names \n hcintpol message:\n' + hcerror
         return outjson
@@ -643,10 +1512,41 @@ def getSurface(dict_input):
     outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname)
     return outjson
 
+def _surface_plane(x_limits, y_limits, normal, indices, d):
+    '''
+    Points of the plane normal * [x, y, z] + d = 0 over the pseudo x, y
+    limits, where the pseudo axes are the real ones sorted by indices.
+    '''
+    xx, yy = np.meshgrid(x_limits, y_limits)
+
+    # The eq of a plane is: a*x + b*y + c*z + d = 0
+    # [a,b,c] = vector
+    # d is obtained from the dot product 'point * normal' (above)
+    # the last plane coordinates are obtained as
+    zz = (-normal[indices[0]]*xx - normal[indices[1]]*yy - d)*1./normal[indices[2]]
+
+    # Convert from the pseudo xx,yy,zz to the real x,y,z
+    axis_order = ['x', 'y', 'z']
+    pseudo_plan = [xx, yy, zz]
+    return {axis_order[ind]:pseudo_plan[i].flatten() for i,ind in enumerate(indices)}
+
+def _surface_tile(tile):
+    '''
+    Interpolates a tile of the getSurface plane (run on the process pool).
+    '''
+    filename, x_limits, y_limits, normal, indices, d, variables, linear = tile
+    points = _surface_plane(x_limits, y_limits, normal, indices, d)
+    return hcintpol(filename,
+                    points['x'], points['y'], points['z'],
+                    variables=variables,
+                    linear=linear)
+
 def getFileURL(dict_input):
     pass
 def getDataPointSpectra_spacecraft(dict_input):
     pass
+@stages.traced
+@cached_result
 def getParticleTrajectory(dict_input):
     '''
     Gets the particle trajectory for the properties set in the input dictionary.
@@ -659,10 +1559,11 @@ def getParticleTrajectory(dict_input):
     -stop_radius: Lower limit as "planet boundary" in metres.
     -stop_box: Edge limits as box coordinates in m: [x0, x1, y0, y1, z0, z1]
     -order: whether linear or not (nearestgridpoint)
-    -OutputFiletype: which kind (netcdf, votable)
+    -OutputFiletype: which kind (netcdf, netcdf4, votable)
     -url_XYZ: url address to the input data
 
-    Attention, at the moment this is plan as single particle.
+    The particles are traced in parallel by ion_shards (fmi.cfg) iontracer
+    processes, all the cores when 0.
     '''
 
     outjson = {'out_url':'', 'error':''}
@@ -677,6 +1578,9 @@ def getParticleTrajectory(dict_input):
     if (False in checked):
         outjson['error'] = 'A votable with ' + ', '.join(needed_values) + ' is needed to run this function'
         return outjson
+    if len(points['x']) == 0:
+        outjson['error'] = 'ERROR: There are no particles in the input'
+        return outjson
 
     # Check all masses and charges in points are equal
     if ((np.any(points['mass'][0] != points['mass']) or np.any(points['charge'][0] != points['charge']))):
@@ -690,26 +1594,55 @@ def getParticleTrajectory(dict_input):
     if dict_input['stepsize'] is None:
         dict_input['stepsize'] = dict_input['suggested_stepsize']
 
-    # Write config file in a tmp file
-    ## Define the outdir 
-    cfgfilename = iontracer_writecfg(dict_input, points)
+    # Split the particles in shards, each one traced by its own iontracer
+    nparticles = len(points['x'])
+    nshards = int(_cfg('ion_shards', 1)) or multiprocessing.cpu_count()
+    shards = np.array_split(np.arange(nparticles), max(1, min(nshards, nparticles)))
 
-    # Execute program
+    # Write config file in a tmp file for each shard and execute the program
     cmd = os.path.join(impex_cfg.get('fmi','bindir'),'iontracer')
-    cmd += ' ' + cfgfilename
-    iontracer = subprocess.Popen(cmd, shell=True,
-                                 stderr=subprocess.PIPE)
-    ion_ex, ion_error = iontracer.communicate()
+    with stages.stage('iontracer', points=nparticles, shards=len(shards)):
+        running = []
+        for shard in shards:
+            ## Define the outdir 
+            cfgfilename = iontracer_writecfg(dict_input, {key: np.asarray(points[key])[shard]
+                                                          for key in needed_values})
+            errfile = tempfile.TemporaryFile()
+            iontracer = subprocess.Popen([cmd, cfgfilename],
+                                         stderr=errfile)
+            running.append((shard, cfgfilename, errfile, iontracer))
+
+        ion_error = ''
+        traces = []
+        for shard, cfgfilename, errfile, iontracer in running:
+            iontracer.wait()
+            errfile.seek(0)
+            ion_error += errfile.read()
+            errfile.close()
+            #FIXME!! Check whether the file was craeted and if it works;
+            #FIXME!! iontracer does not return anything if points out of boundaries
+            # "'Error: Some points go outside of the simulation box.\nCheck points in the point data or config file\n'"
+            values = open(cfgfilename + '_trace_0.m', 'r')
+            trace = values.read()
+            values.close()
+            traces.append(trace)
+
+    with stages.stage('parse_output') as record:
+        record['bytes'] = sum(len(trace) for trace in traces)
+        traces = [_table2dict(trace) for trace in traces]
+    for shard, trace in zip(shards, traces):
+        # parID is 2n - 1 (forward) and 2n (backward) for the nth particle of
+        # the shard; shift it so it's numbered as the input votable
+        trace['parID'] += 2 * shard[0]
+
     # What are the execution/error messages to check here?
     if (ion_error != ''):
         dict_input['ion_warnings'] = ion_error
-    #FIXME!! Check whether the file was craeted and if it works;
-    #FIXME!! iontracer does not return anything if points out of boundaries
-    # "'Error: Some points go outside of the simulation box.\nCheck points in the point data or config file\n'"
-    # Convert the output file to the required format
-    values = open(cfgfilename + '_trace_0.m', 'r')
-    outname = _writeout_ion(dict_input, values.readlines())
-    values.close()
+
+    # Convert the output files to the required format
+    variables = {key: np.concatenate([trace[key] for trace in traces])
+                 for key in traces[0].keys()}
+    outname = _writeout_ion(dict_input, variables)
     outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(outname)
     return outjson
 
@@ -727,33 +1660,377 @@ def getVOTableURL(dict_input):
     outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(filename.name)
     return outjson
 
+def _jobdir(*path):
+    return os.path.join(_cfg('jobdir', os.path.join(tempfile.gettempdir(), 'impex_jobs')), *path)
+
+def _write_json(filename, data):
+    ''' Writes data in filename through a temporary file (atomically) '''
+    tmp = tempfile.NamedTemporaryFile(dir = os.path.dirname(filename), delete = False)
+    json.dump(data, tmp)
+    tmp.close()
+    os.rename(tmp.name, filename)
+
+def _job_dirs():
+    # The workers run what is queued there, so it's just the service's
+    files.private_dir(_jobdir())
+    for directory in ['queued', 'running', 'status', 'slots', 'workers']:
+        if not os.path.isdir(_jobdir(directory)):
+            os.mkdir(_jobdir(directory))
+
+def _job_workers():
+    ''' Number of job workers running (see run_jobs), the dead ones are removed '''
+    running = 0
+    for pid in os.listdir(_jobdir('workers')):
+        if pid.isdigit() and shmarrays.alive(int(pid)):
+            running += 1
+        else:
+            files.unlink(_jobdir('workers', pid))
+    return running
+
+def _job_status(job_id, status, **info):
+    info.update({'job_id': job_id, 'status': status, 'updated': datetime.datetime.now().isoformat()})
+    statusfile = _jobdir('status', job_id + '.json')
+    if os.path.exists(statusfile):
+        with open(statusfile) as f:
+            previous = json.load(f)
+        previous.update(info)
+        info = previous
+    _write_json(statusfile, info)
+    return info
+
+def submit_job(dict_input):
+    '''
+    Queues the request to be run by the job workers (see run_jobs) and
+    returns the job_id and the out_url the result will have.  The queue
+    is bounded by job_queue_depth (fmi.cfg).
+    '''
+    outjson = {'out_url':'', 'error':'', 'job_id':''}
+    _job_dirs()
+    if not _job_workers():
+        outjson['error'] = 'ERROR: Asynchronous requests are not available (no job workers running)'
+        return outjson
+    if len(os.listdir(_jobdir('queued'))) >= int(_cfg('job_queue_depth', 100)):
+        outjson['error'] = 'ERROR: Too many requests queued, try again later'
+        return outjson
+    outjson['error'] = _check_request(dict_input)
+    if outjson['error']:
+        return outjson
+    dict_input = dict(dict_input)
+    dict_input.pop('async')
+    dict_input['_outname'] = _result_name(dict_input)
+    _fetched.clear()
+    job_id = uuid.uuid4().hex
+    outjson['job_id'] = job_id
+    outjson['out_url'] = impex_cfg.get('fmi', 'httpoutput') + os.path.basename(dict_input['_outname'])
+    _job_status(job_id, 'queued', function = dict_input['function'], out_url = outjson['out_url'])
+    # time stamp first so they're run in order
+    _write_json(_jobdir('queued', '{0:.6f}_{1}.json'.format(time.time(), job_id)), dict_input)
+    return outjson
+
+def getJobStatus(dict_input):
+    '''
+    Status of the job 'job_id': queued, running, done or error; with the
+    out_url and the error message (if any).
+    '''
+    statusfile = _jobdir('status', os.path.basename(str(dict_input['job_id'])) + '.json')
+    if not os.path.exists(statusfile):
+        return {'out_url':'', 'error':'ERROR: Unknown job ' + str(dict_input['job_id']), 'status':''}
+    with open(statusfile) as f:
+        status = json.load(f)
+    outjson = {'out_url': status['out_url'], 'error': status.get('error', ''), 'status': status['status']}
+    return outjson
+
+def _job_slot(function):
+    '''
+    Takes one of the job_limit_<function> slots (job_workers by default),
+    returns the locked file or None if they are all being used.
+    '''
+    limit = int(_cfg('job_limit_' + function, _cfg('job_workers', 2)))
+    for slot in range(limit):
+        lock = open(_jobdir('slots', '{0}.{1}'.format(function, slot)), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except IOError:
+            lock.close()
+    return None
+
+def _run_next_job():
+    '''
+    Runs the oldest queued job that has a free slot for its method.
+    Returns False when there was nothing to run.
+    '''
+    for name in sorted(os.listdir(_jobdir('queued'))):
+        queued = _jobdir('queued', name)
+        try:
+            with open(queued) as f:
+                dict_input = json.load(f)
+        except (IOError, ValueError):
+            continue  # taken by another worker or still being written
+        lock = _job_slot(dict_input['function'])
+        if lock is None:
+            continue
+        try:
+            # The pid of the worker in the name, see _recover_jobs
+            running = _jobdir('running', '{0}.{1}'.format(name, os.getpid()))
+            try:
+                os.rename(queued, running)  # claim it
+            except OSError:
+                continue
+            job_id = name.split('_', 1)[1][:-len('.json')]
+            _job_status(job_id, 'running')
+            fileout = run_request(dict_input, internal = True)
+            if fileout.get('error'):
+                _job_status(job_id, 'error', error = fileout['error'])
+            else:
+                _job_status(job_id, 'done', out_url = fileout['out_url'])
+            os.unlink(running)
+            return True
+        finally:
+            lock.close()
+    return False
+
+def _recover_jobs():
+    '''
+    Queues again the jobs left running by workers that are not there
+    anymore (e.g., they crashed or the daemon was stopped)
+    '''
+    for name in os.listdir(_jobdir('running')):
+        queued, pid = name.rsplit('.', 1)
+        if not pid.isdigit():
+            queued = name  # without the pid
+        elif shmarrays.alive(int(pid)):
+            continue
+        try:
+            os.rename(_jobdir('running', name), _jobdir('queued', queued))
+        except OSError:
+            continue  # recovered by another worker
+        _job_status(queued.split('_', 1)[1][:-len('.json')], 'queued')
+
+def _expire_jobs():
+    '''
+    Removes the status of the jobs finished more than job_status_age
+    seconds ago (result_cache_age by default)
+    '''
+    max_age = float(_cfg('job_status_age', _cfg('result_cache_age', 7 * 24 * 3600)))
+    now = time.time()
+    for name in os.listdir(_jobdir('status')):
+        statusfile = _jobdir('status', name)
+        try:
+            if now - os.stat(statusfile).st_mtime <= max_age:
+                continue
+            with open(statusfile) as f:
+                status = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if status.get('status') in ['done', 'error']:
+            files.unlink(statusfile)
+
+def run_jobs():
+    '''
+    Loop of a job worker.  It's registered in jobdir/workers, so the async
+    requests are just accepted while there are job workers, and it looks
+    for jobs to recover and status to expire every result_cache_interval
+    seconds.
+    '''
+    _job_dirs()
+    open(_jobdir('workers', str(os.getpid())), 'w').close()
+    interval = float(_cfg('result_cache_interval', 60))
+    checked = 0
+    while True:
+        if time.time() - checked > interval:
+            _recover_jobs()
+            _expire_jobs()
+            checked = time.time()
+        if not _run_next_job():
+            time.sleep(0.5)
+
+# dict of which functions call what
+functions = {'getDataPointValue': getDataPointValue,
+             'getFieldLine': getFieldLine,
+             'getDataPointValue_spacecraft': getDataPointValue_spacecraft,
+             'getDataPointSpectra': getDataPointSpectra,
+             'getSurface': getSurface,
+             'getFileURL': getFileURL,
+             'getDataPointSpectra_spacecraft': getDataPointSpectra_spacecraft,
+             'getParticleTrajectory': getParticleTrajectory,
+             'getVOTableURL': getVOTableURL,
+             'getJobStatus': getJobStatus}
+
+# The methods that can be run as jobs (with 'async' in the request)
+async_functions = ['getDataPointValue', 'getDataPointValue_spacecraft', 'getFieldLine', 'getSurface', 'getParticleTrajectory']
+
+def run_request(data, internal = False):
+    '''
+    Parses the data object (the dictionary sent by PHP) to the right function
+    and returns the dictionary to send back.  Any exception is reported in
+    the 'error' field, so PHP can raise the SoapFault.
+    The keys starting with _ (e.g. _outname) are set by impex itself
+    (submit_job, cached_result), so they are dropped from the requests but
+    the internal ones (the queued jobs).
+    '''
+    try:
+        if not internal:
+            data = {key: value for key, value in data.items() if not key.startswith('_')}
+        if data.get('async') and data['function'] in async_functions:
+            fileout = submit_job(data)
+        else:
+            fileout = functions[data['function']](data)
+    except:
+        error = str(sys.exc_info()[0])
+        error += traceback.format_exc()
+        fileout = {'error':error + ' ' + json.dumps(data)}
+    return fileout
+
+def _serve_connection(conn):
+    '''
+    Reads JSON lines from a client connection, one request per line,
+    and answers each of them with one JSON line.
+    '''
+    stream = conn.makefile('rw')
+    try:
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                fileout = {'error': 'ERROR: not appropriate json input.'}
+            else:
+                fileout = run_request(data)
+            stream.write(json.dumps(fileout) + '\n')
+            stream.flush()
+    except socket.error:
+        pass  # client went away
+    finally:
+        stream.close()
+        conn.close()
+
+def _serve_worker(server):
+    '''
+    Loop run by each of the pre-forked workers: all of them accept on the
+    same listening socket, so the kernel hands every connection to an idle one.
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    while True:
+        try:
+            conn, address = server.accept()
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        _serve_connection(conn)
+
+def _job_worker(server):
+    ''' Loop of the forked job workers (they don't use the socket) '''
+    server.close()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    run_jobs()
+
+def _listen(address):
+    '''
+    Binds the unix socket address, writable just by the user running the
+    daemon and the worker_socket_group (the web server's, when it's not
+    the same user) with worker_socket_mode.
+    '''
+    if os.path.exists(address):
+        os.unlink(address)
+    mode = int(_cfg('worker_socket_mode', '0660'), 8) & 0o770
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o777 & ~mode)  # no more open than mode, not even before the chmod
+    try:
+        server.bind(address)
+    finally:
+        os.umask(umask)
+    group = _cfg('worker_socket_group', '')
+    if group:
+        os.chown(address, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(address, mode)
+    return server
+
+def serve(address, nworkers = 1, njobworkers = 0):
+    '''
+    Runs impex as a long-lived worker daemon listening on the unix socket
+    'address'.  The modules and fmi.cfg are loaded once here, then 'nworkers'
+    processes are forked so a request does not pay for the python start up.
+    Each request is a JSON line (as the one passed in the command line) and
+    the answer is the JSON line we would print to PHP.
+    'njobworkers' processes are also forked to run the queued jobs.
+    '''
+    server = _listen(address)
+    server.listen(max(128, nworkers))
+
+    children = {}  # pid: worker loop
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker(server)
+            finally:
+                os._exit(1)
+        children[pid] = worker
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for n in range(nworkers):
+        spawn(_serve_worker)
+    for n in range(njobworkers):
+        spawn(_job_worker)
+    try:
+        # Keep the pool full: respawn any worker that dies
+        while children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            worker = children.pop(pid, None)
+            if not stopping and worker is not None:
+                spawn(worker)
+    finally:
+        server.close()
+        if os.path.exists(address):
+            os.unlink(address)
+
 if __name__ == '__main__':# Load the data that PHP sent us
 
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        parser = argparse.ArgumentParser(description=('Runs impex as a worker daemon '
+                                                      'answering JSON lines requests.'))
+        parser.add_argument('--serve', action='store_true')
+        parser.add_argument('-s', '--socket', type=str,
+                            default=_cfg('worker_socket', '/tmp/impex_fmi.sock'),
+                            help='Unix socket where to listen for requests')
+        parser.add_argument('-n', '--workers', type=int,
+                            default=int(_cfg('workers', 4)),
+                            help='Number of pre-forked worker processes')
+        parser.add_argument('-j', '--job-workers', type=int,
+                            default=int(_cfg('job_workers', 2)),
+                            help='Number of processes running the queued (async) jobs')
+        args = parser.parse_args()
+        serve(args.socket, args.workers, args.job_workers)
+        sys.exit(0)
+
     try:
         data = json.loads(sys.argv[1])
     except:
         print('ERROR: not appropriate json input.')
         sys.exit(1)
 
-    # dict of which functions call what
-    functions = {'getDataPointValue': getDataPointValue,
-                 'getFieldLine': getFieldLine,
-                 'getDataPointValue_spacecraft': getDataPointValue_spacecraft,
-                 'getDataPointSpectra': getDataPointSpectra,
-                 'getSurface': getSurface,
-                 'getFileURL': getFileURL,
-                 'getDataPointSpectra_spacecraft': getDataPointSpectra_spacecraft,
-                 'getParticleTrajectory': getParticleTrajectory,
-                 'getVOTableURL': getVOTableURL}
-
-    # parse the data object to the right function
-    try:
-        fileout = functions[data['function']](data)
-    except:
-        error = str(sys.exc_info()[0])
-        error += traceback.format_exc()
-        fileout = {'error':error + ' ' + sys.argv[1]}
-    
+    fileout = run_request(data)
+
     # Generate some data to send to PHP
     #result = {'fileout': fileout}
 
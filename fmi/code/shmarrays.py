@@ -0,0 +1,102 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import errno
+import fcntl
+import shutil
+import atexit
+import hashlib
+import tempfile
+import numpy as np
+import files
+from contextlib import contextmanager
+
+# Where the arrays are published (a tmpfs, so they live in shared memory)
+directory = '/dev/shm/impex' if os.path.isdir('/dev/shm') else \
+            os.path.join(tempfile.gettempdir(), 'impex_shm')
+
+_attached = {}  # key: users of key in this process
+
+def run_key(filename):
+    '''Key of the arrays of a run: its path, modification time and size'''
+    stat = os.stat(filename)
+    return hashlib.sha1(repr((os.path.abspath(filename), stat.st_mtime,
+                              stat.st_size))).hexdigest()[:20]
+
+@contextmanager
+def _locked(key):
+    files.private_dir(directory)  # the arrays found there are trusted
+    lock = open(os.path.join(directory, key + '.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def alive(pid):
+    '''Whether the process pid is running (of this user or not)'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def attach(key, build):
+    '''
+    Returns the arrays published with key ({name: read-only array}) as
+    views of the files in directory, so all the processes share the same
+    memory.  The first one calls build() (returning {name: array}) and
+    publishes them.  This process counts as a user of them until it
+    calls release(key).
+    '''
+    path = os.path.join(directory, key)
+    with _locked(key):
+        if not os.path.isdir(path):
+            tmp = tempfile.mkdtemp(prefix=key + '.', dir=directory)
+            try:
+                for name, array in build().items():
+                    np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(array))
+            except:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            os.rename(tmp, path)
+        arrays = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+                  for name in os.listdir(path) if name.endswith('.npy')}
+        refs = path + '.refs'
+        if not os.path.isdir(refs):
+            os.mkdir(refs)
+        open(os.path.join(refs, str(os.getpid())), 'w').close()
+        _attached[key] = _attached.get(key, 0) + 1
+    return arrays
+
+def release(key):
+    '''
+    This process does not use the arrays of key anymore.  They are removed
+    when no other (living) process is using them; the views already
+    given remain valid.
+    '''
+    if key not in _attached:
+        return
+    _attached[key] -= 1
+    if _attached[key] > 0:
+        return
+    del _attached[key]
+    path = os.path.join(directory, key)
+    refs = path + '.refs'
+    with _locked(key):
+        if os.path.isdir(refs):
+            for pid in os.listdir(refs):
+                if pid == str(os.getpid()) or not alive(int(pid)):
+                    os.unlink(os.path.join(refs, pid))
+            if os.listdir(refs):
+                return  # still used by others
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.rmtree(refs, ignore_errors=True)
+
+@atexit.register
+def _release_all():
+    for key in list(_attached):
+        _attached[key] = 1
+        release(key)
@@ -0,0 +1,133 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+# JSON lines are appended to logfile (when set) and the summary is added to
+# the answer of the methods when summary is True (or asked with 'timing')
+logfile = None
+summary = False
+
+class Trace(object):
+    '''
+    Times the stages of a request.  Each stage records its wall and CPU
+    time (of this process and of the programs it waited for, e.g.,
+    hcintpol), the RSS of this process at its end and how much it grew
+    within the stage (in kB, where /proc is there) and any counts (points,
+    bytes) given to or set on it by the code it wraps.
+    Stages can be nested; they are named after their parents (cache/fetch).
+    Just this process is traced: the stages of the code run by Pool
+    workers (getSurface tiles) are not recorded and their CPU is counted
+    in cpu_children only once the pool is joined.
+    '''
+    def __init__(self, method):
+        self.method = method
+        self.stages = []
+        self._names = []
+        self._start = _usage()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        record = dict(counts)
+        self._names.append(name)
+        start = _usage()
+        try:
+            yield record
+        finally:
+            record.update(_elapsed(start))
+            record['stage'] = '/'.join(self._names)
+            self._names.pop()
+            self.stages.append(record)
+
+    def summary(self):
+        total = _elapsed(self._start)
+        total['method'] = self.method
+        total['stages'] = self.stages
+        return total
+
+    def log(self, filename, **info):
+        '''Appends a JSON line per stage and one for the whole request'''
+        lines = []
+        for record in self.stages + [dict(_elapsed(self._start), stage='total')]:
+            line = dict(info, method=self.method, pid=os.getpid(), **record)
+            lines.append(json.dumps(line, sort_keys=True) + '\n')
+        # A single write in append mode, so lines of other workers don't get mixed
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, ''.join(lines))
+        finally:
+            os.close(fd)
+
+def _usage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(), me.ru_utime + me.ru_stime,
+            children.ru_utime + children.ru_stime, _rss_kb())
+
+_page_kb = resource.getpagesize() // 1024
+
+def _rss_kb():
+    '''Current RSS of this process (kB), None if it can't be read'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page_kb
+    except (IOError, ValueError, IndexError):
+        return None
+
+def _elapsed(start):
+    end = _usage()
+    elapsed = {'time': round(start[0], 6),
+               'wall': round(end[0] - start[0], 6),
+               'cpu': round(end[1] - start[1], 6),
+               'cpu_children': round(end[2] - start[2], 6)}
+    if end[3] is not None:
+        elapsed['rss_kb'] = end[3]
+        elapsed['rss_delta_kb'] = end[3] - start[3]
+    return elapsed
+
+_current = None
+
+@contextmanager
+def stage(name, **counts):
+    '''
+    Times the code within as a stage of the current request, e.g.:
+        with stages.stage('write') as record:
+            ...
+            record['bytes'] = os.path.getsize(outname)
+    It does nothing but give the record when no request is being traced.
+    '''
+    if _current is None:
+        yield dict(counts)
+    else:
+        with _current.stage(name, **counts) as record:
+            yield record
+
+def traced(function):
+    '''
+    Decorator for the service methods: their stages are timed and logged,
+    and the summary added to the answer as 'timing'.
+    '''
+    def tracer(dict_input):
+        global _current
+        if _current is not None:  # already within a traced method
+            return function(dict_input)
+        _current = Trace(function.__name__)
+        try:
+            outjson = function(dict_input)
+        finally:
+            trace, _current = _current, None
+            if logfile:
+                try:
+                    trace.log(logfile, request=dict_input.get('_outname', ''))
+                except (IOError, OSError):
+                    pass  # the request is not lost for the log
+        if (summary or dict_input.get('timing')) and isinstance(outjson, dict):
+            outjson['timing'] = trace.summary()
+        return outjson
+    tracer.__name__ = function.__name__
+    tracer.__doc__ = function.__doc__
+    return tracer
@@ -0,0 +1,52 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import numpy as np
+import fieldtrace
+
+def circular(x, y, z):
+    '''Field lines are circles around the z axis'''
+    return {'Bx': -y, 'By': x, 'Bz': np.zeros_like(x)}
+
+def uniform(x, y, z):
+    return {'Bx': np.ones_like(x), 'By': np.zeros_like(x), 'Bz': np.zeros_like(x)}
+
+def test_rk45_retries_the_steps_rejected_out_of_the_box(make_run):
+    # The first step (6) ends out of the stop_box, but it's rejected for its
+    # error, so the line goes on with shorter steps (the simulation box is
+    # large, so the field is known along all of them)
+    track = fieldtrace.Fieldtrack(make_run('circular.hc', circular, shape=(32, 32, 32),
+                                           box=np.array([[-16., 16.]] * 3)),
+                                  stop_box=[-1.2, 1.2, -1.2, 1.2, -1, 1])
+    line, = track.track_many([[1., 0, 0]], 'B', stepsize=6., maxstep=20,
+                             method='rk45', linear=True, tolerance=1e-3)
+    assert len(line) == 21
+    assert np.allclose(np.hypot(line[:, 0], line[:, 1]), 1., atol=0.05)
+
+def test_rk45_retries_the_steps_out_of_the_simulation(make_run):
+    # Some stages of the first step (6) are out of the simulation box, where
+    # the field is not known
+    track = fieldtrace.Fieldtrack(make_run('circular.hc', circular))
+    line, = track.track_many([[2., 0, 0]], 'B', stepsize=6., maxstep=20,
+                             method='rk45', linear=True, tolerance=1e-3)
+    assert len(line) == 21
+    assert np.allclose(np.hypot(line[:, 0], line[:, 1]), 2., atol=0.05)
+
+def test_rk45_stops_at_the_box(make_run):
+    track = fieldtrace.Fieldtrack(make_run('uniform.hc', uniform),
+                                  stop_box=[-2, 2.4, -2, 2, -2, 2])
+    line, = track.track_many([[2., 0, 0]], 'B', stepsize=0.1, maxstep=50,
+                             method='rk45', linear=True)
+    assert 1 < len(line) < 51
+    assert line[-1, 0] <= 2.4
+    assert np.allclose(line[:, 1:], 0)
+
+def test_methods_agree(make_run):
+    track = fieldtrace.Fieldtrack(make_run('circular.hc', circular))
+    seeds = [[2., 0, 0], [0, 1.5, 0.5]]
+    lines = {method: track.track_many(seeds, 'B', stepsize=0.05, maxstep=40,
+                                      method=method, linear=True)
+             for method in ['midpoint', 'rk4']}
+    for midpoint, rk4 in zip(lines['midpoint'], lines['rk4']):
+        assert midpoint.shape == rk4.shape == (41, 3)
+        assert np.allclose(midpoint, rk4, atol=1e-3)
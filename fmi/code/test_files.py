@@ -0,0 +1,28 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import pytest
+import files
+
+def test_private_dir(tmpdir):
+    path = str(tmpdir.join('a', 'b'))
+    assert files.private_dir(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert files.private_dir(path) == path  # already there
+
+@pytest.mark.parametrize('make', [lambda path: os.mkdir(path) or os.chmod(path, 0o777),
+                                  lambda path: os.symlink(os.path.dirname(path), path),
+                                  lambda path: open(path, 'w').close()])
+def test_private_dir_refuses_others(tmpdir, make):
+    path = str(tmpdir.join('shared'))
+    make(path)
+    with pytest.raises(OSError):
+        files.private_dir(path)
+
+def test_unlink(tmpdir):
+    path = tmpdir.join('result')
+    path.write('x')
+    files.unlink(str(path))
+    assert not path.exists()
+    files.unlink(str(path))  # already removed
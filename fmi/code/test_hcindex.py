@@ -0,0 +1,50 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import numpy as np
+import pytest
+import hcindex
+
+def interleave(i, j, k):
+    '''Morton code a bit at a time'''
+    code = 0
+    for bit in range(21):
+        for shift, v in [(2, i), (1, j), (0, k)]:
+            code |= ((int(v) >> bit) & 1) << (3 * bit + shift)
+    return code
+
+def test_morton():
+    assert [int(hcindex.morton(*np.array(c))) for c in [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (2, 0, 0)]] == \
+        [4, 2, 1, 7, 32]
+    ijk = np.random.RandomState(0).randint(0, 2 ** 21, size=(100, 3))
+    codes = hcindex.morton(ijk[:, 0], ijk[:, 1], ijk[:, 2])
+    assert [int(code) for code in codes] == [interleave(*c) for c in ijk]
+
+def refined():
+    '''2x2x2 grid with its first cell refined (8 leaves at level 1)'''
+    cells = [(1, i, j, k) for i in range(2) for j in range(2) for k in range(2)]
+    cells += [(0, i, j, k) for i in range(2) for j in range(2) for k in range(2) if (i, j, k) != (0, 0, 0)]
+    return np.array(cells)
+
+def test_find():
+    box = np.array([[-2., 2.], [0., 4.], [0., 1.]])
+    cells = refined()
+    index = hcindex.BlockIndex(box, (2, 2, 2), 1, cells)
+    points = np.random.RandomState(1).uniform(box[:, 0], box[:, 1], size=(500, 3))
+    leaves = index.find(points)
+    # Every point is within its leaf
+    size = (box[:, 1] - box[:, 0]) / 2 / (1 << cells[leaves, 0])[:, np.newaxis]
+    lower = box[:, 0] + cells[leaves, 1:] * size
+    assert np.all((points >= lower) & (points < lower + size))
+    assert np.allclose(index.cell_size(leaves), size)
+    # Those out of the box get the nearest leaf
+    assert list(index.find([[-10., -10., -10.], [10., 10., 10.]])) == \
+        [0, list(map(tuple, cells)).index((0, 1, 1, 1))]
+
+@pytest.mark.parametrize('cells', [refined()[1:],  # a hole
+                                   np.vstack((refined(), [(0, 0, 0, 0)])),  # overlap
+                                   np.vstack((refined()[1:], [(0, 2, 0, 0)])),  # out of the grid
+                                   np.vstack((refined()[1:], [(2, 0, 0, 0)]))])  # too fine
+def test_cells_must_cover_the_grid(cells):
+    with pytest.raises(ValueError):
+        hcindex.BlockIndex([[0, 1]] * 3, (2, 2, 2), 1, cells)
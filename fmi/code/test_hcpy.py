@@ -0,0 +1,100 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import numpy as np
+import hcpy
+import shmarrays
+from conftest import box, refine, write_refined
+
+def linear(x, y, z):
+    return {'rho': 1 + 2 * x - 3 * y + 0.5 * z, 'Bx': x * 0 + 7}
+
+def test_trilinear_is_exact_for_a_linear_field(make_run):
+    hc = hcpy.HCpy(make_run('linear.hc', linear, shape=(8, 10, 12)))
+    assert hc.native and not hc.refined
+    # Within the cell centres (it's constant half a cell from the faces)
+    rng = np.random.RandomState(4)
+    half = (box[:, 1] - box[:, 0]) / np.array([8, 10, 12]) / 2
+    points = rng.uniform(box[:, 0] + half, box[:, 1] - half, size=(1000, 3))
+    values = hc.intpol(points[:, 0], points[:, 1], points[:, 2], variables=['rho', 'Bx'])
+    assert np.allclose(values['rho'], linear(*points.T)['rho'])
+    assert np.allclose(values['Bx'], 7)
+    assert np.all(values['x'] == points[:, 0])
+
+def test_nearest_is_the_containing_cell(make_run):
+    shape = np.array([8, 10, 12])
+    hc = hcpy.HCpy(make_run('linear.hc', linear, shape=tuple(shape)))
+    rng = np.random.RandomState(5)
+    points = rng.uniform(box[:, 0], box[:, 1], size=(1000, 3))
+    values = hc.intpol(points[:, 0], points[:, 1], points[:, 2], variables=['rho'], linear=False)
+    delta = (box[:, 1] - box[:, 0]) / shape
+    centres = box[:, 0] + (np.floor((points - box[:, 0]) / delta) + 0.5) * delta
+    assert np.allclose(values['rho'], linear(*centres.T)['rho'])
+
+def test_outside_is_nan(make_run):
+    hc = hcpy.HCpy(make_run('linear.hc', linear))
+    values = hc.intpol([0., 5.], [0., 0.], [0., 0.], variables=['rho'])
+    assert np.isfinite(values['rho'][0]) and np.isnan(values['rho'][1])
+
+def refined_cells():
+    '''4x4x4 grid refined twice where x < 0 (and y < 0 at the second level)'''
+    cells = refine([(0, i, j, k) for i in range(4) for j in range(4) for k in range(4)],
+                   lambda cells: cells[:, 1] < 2)
+    return refine(cells, lambda cells: (cells[:, 0] == 1) & (cells[:, 1] < 4) & (cells[:, 2] < 4))
+
+def test_refined_find(tmpdir, monkeypatch):
+    monkeypatch.setattr(shmarrays, 'directory', str(tmpdir.join('shm')))
+    cells = refined_cells()
+    hc = hcpy.HCpy(write_refined(str(tmpdir.join('refined.hc')), linear, cells))
+    hc.load()
+    points = np.random.RandomState(6).uniform(box[:, 0], box[:, 1], size=(2000, 3))
+    leaves = hc.index.find(points)
+    size = (box[:, 1] - box[:, 0]) / 4 / (1 << cells[leaves, 0])[:, np.newaxis]
+    lower = box[:, 0] + cells[leaves, 1:] * size
+    assert np.all((points >= lower) & (points < lower + size))
+    assert set(cells[leaves, 0]) == set([0, 1, 2])
+    # The nearest grid point is the value of the leaf
+    values = hc.intpol(*points.T, variables=['rho'], linear=False)
+    assert np.allclose(values['rho'], linear(*(lower + size / 2).T)['rho'])
+    hc.close()
+
+def test_refined_linear_error(tmpdir, monkeypatch):
+    monkeypatch.setattr(shmarrays, 'directory', str(tmpdir.join('shm')))
+    cells = refined_cells()
+    hc = hcpy.HCpy(write_refined(str(tmpdir.join('refined.hc')), linear, cells))
+    # Within the centres of the coarsest cells by the faces, also across
+    # the levels, a linear field is interpolated exactly
+    points = np.random.RandomState(7).uniform(box[:, 0] + 1, box[:, 1] - 1, size=(5000, 3))
+    values = hc.intpol(*points.T, variables=['rho'])
+    assert np.max(np.abs(values['rho'] - linear(*points.T)['rho'])) < 1e-6
+    # A smooth one within a fraction of its variation over a cell
+    smooth = lambda x, y, z: {'rho': np.sin(x / 2.) * np.cos(y / 3.) + z ** 2 / 10}
+    hc = hcpy.HCpy(write_refined(str(tmpdir.join('smooth.hc')), smooth, cells))
+    values = hc.intpol(*points.T, variables=['rho'])
+    assert np.max(np.abs(values['rho'] - smooth(*points.T)['rho'])) < 0.2
+    hc.close()
+
+def test_sidecar(make_run, monkeypatch):
+    filename = make_run('run.hc', linear)
+    hcpy.HCpy(filename).write_sidecar()
+    stat = os.stat(filename)
+
+    def unread(self, filename):
+        raise AssertionError('The file was read with a fresh sidecar')
+    with monkeypatch.context() as m:
+        m.setattr(hcpy.HCpy, '_read', unread)
+        assert hcpy.HCpy(filename).stored == ['Bx', 'rho']
+
+    # Same size, another mtime: the sidecar is stale
+    renamed = lambda x, y, z: {'By': linear(x, y, z)['Bx'], 'rho': linear(x, y, z)['rho']}
+    make_run('run.hc', renamed)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+    assert os.stat(filename).st_size == stat.st_size
+    assert hcpy.HCpy(filename).stored == ['By', 'rho']
+
+    # Same mtime, another size
+    make_run('run.hc', renamed, shape=(4, 4, 5))
+    os.utime(filename, (stat.st_atime, stat.st_mtime))
+    hc = hcpy.HCpy(filename)
+    assert hc.shape == (4, 4, 5) and hc.stored == ['By', 'rho']
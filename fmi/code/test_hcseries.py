@@ -0,0 +1,110 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import numpy as np
+import pytest
+import hccache
+import hcseries
+
+@pytest.fixture(autouse=True)
+def runs(monkeypatch):
+    monkeypatch.setattr(hccache, 'runs', hccache.RunCache())
+
+def series(tmpdir):
+    filename = tmpdir.join('run.series')
+    filename.write('# time snapshot\n'
+                   '2014-01-01T00:01:00Z run_1.hc\n'
+                   '2014-01-01T00:00:00 run_0.hc\n'
+                   '2014-01-01T00:03:00 run_3.hc  # the last one\n')
+    return hcseries.Series(str(filename))
+
+def test_series(tmpdir):
+    s = series(tmpdir)
+    assert [name.rsplit('/', 1)[1] for name in s.filenames] == ['run_0.hc', 'run_1.hc', 'run_3.hc']
+    before, after, weight, inside = s.brackets(np.array(
+        ['2013-12-31T23:59:00', '2014-01-01T00:00:00', '2014-01-01T00:00:30',
+         '2014-01-01T00:01:00', '2014-01-01T00:02:30', '2014-01-01T00:03:00',
+         '2014-01-01T00:04:00'], dtype='datetime64[us]'))
+    assert list(before) == [0, 0, 0, 1, 1, 1, 1]
+    assert list(after) == [1, 1, 1, 2, 2, 2, 2]
+    assert np.allclose(weight[1:-1], [0, 0.5, 0, 0.75, 1])
+    assert list(inside) == [False, True, True, True, True, True, False]
+
+class Run(object):
+    def close(self):
+        pass
+
+class Intpol(object):
+    '''
+    Snapshot k has rho = k + x everywhere; the snapshots are put in the
+    run cache as hcintpol does, and the ones opened are in opens
+    '''
+    def __init__(self):
+        self.calls = []
+        self.opens = []
+
+    def __call__(self, filename, x, y, z):
+        self.calls.append((filename.rsplit('_', 1)[1], len(x)))
+        if filename not in hccache.runs:
+            self.opens.append(filename.rsplit('_', 1)[1])
+            hccache.runs.runs[filename] = (0, 0, Run())
+        k = float(filename.rsplit('_', 1)[1][:-len('.hc')])
+        return {'x': x, 'y': y, 'z': z, 'rho': k + x}, 'warning of ' + filename
+
+def test_window(tmpdir):
+    s = series(tmpdir)
+    intpol = Intpol()
+    window = hcseries.Window(s, intpol)
+    time = np.array(['2014-01-01T00:00:30', '2014-01-01T00:02:00', '2014-01-01T00:05:00',
+                     '2014-01-01T00:01:00'], dtype='datetime64[us]')
+    x = np.array([1., 2., 3., 4.])
+    values, warnings = window.interpolate(time, x, x, x)
+    assert np.allclose(values['rho'][[0, 1, 3]], [1.5, 2. + 2, 1. + 4])
+    assert np.isnan(values['rho'][2])
+    assert '1 points are out of the time of the snapshots' in warnings
+    # A snapshot is read once for all the points that need it
+    assert intpol.calls == [('0.hc', 1), ('1.hc', 3), ('3.hc', 1)]
+    # Those before the previous one are closed as it goes
+    assert window.opened == set(s.filenames[1:])
+    window.close()
+    assert window.opened == set()
+
+def test_window_keeps_the_cached_runs(tmpdir):
+    s = series(tmpdir)
+    hccache.runs.runs[s.filenames[1]] = (0, 0, Run())
+    window = hcseries.Window(s, Intpol())
+    window.interpolate(np.array(['2014-01-01T00:02:30'], dtype='datetime64[us]'), [0.], [0.], [0.])
+    assert window.opened == set(s.filenames[2:])
+    window.close()
+    assert list(hccache.runs.runs.keys()) == s.filenames[1:2]
+
+def test_window_in_any_order(tmpdir):
+    s = series(tmpdir)
+    rng = np.random.RandomState(2)
+    seconds = rng.uniform(-30, 210, size=200)
+    time = s.times[0] + (seconds * 1e6).astype('timedelta64[us]')
+    x = rng.uniform(size=200)
+    intpol = Intpol()
+    values, warnings = hcseries.Window(s, intpol).interpolate(time, x, x, x)
+    assert [name for name, n in intpol.calls] == ['0.hc', '1.hc', '3.hc']
+    # rho = k + x, linear in time between the snapshots at 0, 60 and 180 s
+    k = np.interp(seconds, [0, 60, 180], [0, 1, 3])
+    inside = (seconds >= 0) & (seconds <= 180)
+    assert np.allclose(values['rho'][inside], (k + x)[inside])
+    assert np.all(np.isnan(values['rho'][~inside]))
+
+def test_window_across_chunks(tmpdir):
+    s = series(tmpdir)
+    intpol = Intpol()
+    window = hcseries.Window(s, intpol)
+    for chunk in [['2014-01-01T00:00:10', '2014-01-01T00:00:50'],
+                  ['2014-01-01T00:00:40', '2014-01-01T00:01:30'],
+                  ['2014-01-01T00:02:50', '2014-01-01T00:01:10']]:
+        window.interpolate(np.array(chunk, dtype='datetime64[us]'), [0., 0.], [0., 0.], [0., 0.])
+    # Forward in time chunk by chunk (whatever the order within them): the
+    # snapshots are opened once and at most two are kept
+    assert intpol.opens == ['0.hc', '1.hc', '3.hc']
+    assert window.opened == set(s.filenames[1:]) == set(hccache.runs.runs.keys())
+    # Back in time, the snapshot closed is opened again
+    window.interpolate(np.array(['2014-01-01T00:00:10'], dtype='datetime64[us]'), [0.], [0.], [0.])
+    assert intpol.opens == ['0.hc', '1.hc', '3.hc', '0.hc']
@@ -0,0 +1,475 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import time
+import fcntl
+import numpy as np
+import pytest
+import astropy.io.votable as votable
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+def _result(impex, name, age=0, size=10):
+    path = os.path.join(impex.impex_cfg.get('fmi', 'diroutput'), name)
+    with open(path, 'w') as f:
+        f.write('x' * size)
+    then = time.time() - age
+    os.utime(path, (then, then))
+    return path
+
+def test_evict_results_by_age_and_size(impex):
+    impex.impex_cfg.set('fmi', 'result_cache_interval', '0')
+    impex.impex_cfg.set('fmi', 'result_cache_age', '100')
+    impex.impex_cfg.set('fmi', 'result_cache_bytes', '15')
+    old = _result(impex, 'hwa_cold.votable', age=200)
+    old_answer = _result(impex, 'hwa_cold.votable.answer', size=1000)
+    older = _result(impex, 'hwa_colder.votable', age=50)
+    newer = _result(impex, 'hwa_cnewer.votable', age=20)
+    new = _result(impex, 'hwa_cnew.votable', age=10)
+    other = _result(impex, 'hwa_other.votable', age=500)
+    impex._evict_results(keep=new)
+    assert not os.path.exists(old) and not os.path.exists(old_answer)
+    assert not os.path.exists(older)  # the oldest until they fit
+    assert os.path.exists(newer) and os.path.exists(new) and os.path.exists(other)
+
+def test_evict_results_locks(impex):
+    impex.impex_cfg.set('fmi', 'result_cache_interval', '0')
+    result = _result(impex, 'hwa_cresult.votable')
+    live = _result(impex, 'hwa_cresult.votable.lock')
+    orphan = _result(impex, 'hwa_cgone.votable.lock')
+    held = _result(impex, 'hwa_ccomputing.votable.lock')
+    lock = impex._lock_result(held[:-len('.lock')])
+    try:
+        impex._evict_results()
+        assert os.path.exists(result) and os.path.exists(live)
+        assert not os.path.exists(orphan)
+        assert os.path.exists(held)
+    finally:
+        lock.close()
+
+def test_evict_results_once_per_interval(impex):
+    impex.impex_cfg.set('fmi', 'result_cache_interval', '3600')
+    impex.impex_cfg.set('fmi', 'result_cache_age', '100')
+    impex._evict_results()  # the first one starts the interval
+    old = _result(impex, 'hwa_cold.votable', age=200)
+    impex._evict_results()
+    assert os.path.exists(old)
+
+def test_evict_results_skips_while_other_worker_evicts(impex):
+    impex.impex_cfg.set('fmi', 'result_cache_interval', '0')
+    impex.impex_cfg.set('fmi', 'result_cache_age', '100')
+    old = _result(impex, 'hwa_cold.votable', age=200)
+    stamp = open(os.path.join(impex.impex_cfg.get('fmi', 'diroutput'), 'hwa_evicted'), 'a')
+    fcntl.flock(stamp, fcntl.LOCK_EX)
+    try:
+        impex._evict_results()
+        assert os.path.exists(old)
+    finally:
+        stamp.close()
+    impex._evict_results()
+    assert not os.path.exists(old)
+
+def test_lock_result_is_the_file_in_the_directory(impex):
+    name = os.path.join(impex.impex_cfg.get('fmi', 'diroutput'), 'hwa_cx.votable')
+    lock = impex._lock_result(name)
+    try:
+        assert os.fstat(lock.fileno()).st_ino == os.stat(name + '.lock').st_ino
+    finally:
+        lock.close()
+
+def _request(**options):
+    request = {'function': 'getVOTableURL', 'async': True}
+    request.update(options)
+    return request
+
+def test_async_needs_job_workers(impex, monkeypatch):
+    monkeypatch.setattr(impex, 'async_functions', impex.async_functions + ['getVOTableURL'])
+    monkeypatch.setattr(impex, '_result_name', lambda dict_input: 'hwa_cjob.votable')
+    answer = impex.run_request(_request())
+    assert 'no job workers' in answer['error']
+    # A dead worker does not count
+    open(impex._jobdir('workers', '999999999'), 'w').close()
+    assert 'no job workers' in impex.run_request(_request())['error']
+    assert os.listdir(impex._jobdir('workers')) == []
+    open(impex._jobdir('workers', str(os.getpid())), 'w').close()
+    answer = impex.run_request(_request())
+    assert answer['error'] == '' and answer['job_id']
+    assert impex.getJobStatus(answer)['status'] == 'queued'
+    assert len(os.listdir(impex._jobdir('queued'))) == 1
+
+def test_recover_jobs_of_dead_workers(impex):
+    impex._job_dirs()
+    for job_id, pid in [('dead', 999999999), ('alive', os.getpid())]:
+        impex._job_status(job_id, 'running', function='getSurface', out_url='')
+        impex._write_json(impex._jobdir('running', '1.0_{0}.json.{1}'.format(job_id, pid)), {})
+    impex._recover_jobs()
+    assert os.listdir(impex._jobdir('queued')) == ['1.0_dead.json']
+    assert os.listdir(impex._jobdir('running')) == ['1.0_alive.json.{0}'.format(os.getpid())]
+    assert impex.getJobStatus({'job_id': 'dead'})['status'] == 'queued'
+    assert impex.getJobStatus({'job_id': 'alive'})['status'] == 'running'
+
+def test_expire_finished_jobs(impex):
+    impex._job_dirs()
+    impex.impex_cfg.set('fmi', 'job_status_age', '100')
+    then = time.time() - 200
+    for job_id, status in [('done', 'done'), ('error', 'error'), ('queued', 'queued'), ('recent', 'done')]:
+        impex._job_status(job_id, status, out_url='')
+        if job_id != 'recent':
+            os.utime(impex._jobdir('status', job_id + '.json'), (then, then))
+    impex._expire_jobs()
+    assert sorted(os.listdir(impex._jobdir('status'))) == ['queued.json', 'recent.json']
+
+def _chunks():
+    time = np.datetime64('2014-01-01T00:00:00', 'us') + np.arange(7) * np.timedelta64(1, 's')
+    bx = np.array([1.5, np.nan, np.inf, -np.inf, 1e-300, -2., 0.1])
+    columns = {'Time': time, 'x': np.arange(7.), 'y': np.zeros(7), 'z': np.ones(7), 'Bx': bx}
+    return [{key: values[:3] for key, values in columns.items()},
+            {key: values[3:] for key, values in columns.items()}], columns
+
+@pytest.mark.parametrize('votable_format', ['tabledata', 'binary', 'binary2'])
+def test_points_stream_votable(impex, votable_format):
+    chunks, columns = _chunks()
+    query = {'OutputFiletype': 'votable', 'votable_format': votable_format}
+    stream = impex.PointsStream(query)
+    stream.write(chunks[0], 'first warning')
+    stream.write(chunks[1], 'second warning')
+    outname = stream.close()
+    vot = votable.parse(outname, pedantic=False)
+    table = vot.get_first_table().array
+    assert np.all(impex.iso2datetime64(table['Date'].data.ravel()) == columns['Time'])
+    assert np.array_equal(table['posx'].data.ravel(), columns['x'])
+    np.testing.assert_array_equal(table['Bx'].data.ravel(), columns['Bx'])
+    assert 'first warning' in vot.resources[0].params[0].description
+    assert 'second warning' in vot.resources[0].params[0].description
+    assert os.listdir(os.path.dirname(outname)) == [os.path.basename(outname)]
+
+def test_points_stream_tabledata_values(impex):
+    columns = _chunks()[1]
+    stream = impex.PointsStream({'OutputFiletype': 'votable', 'votable_format': 'tabledata'})
+    stream.write(columns)
+    text = open(stream.close()).read()
+    for value in ['NaN', '+Inf', '-Inf', '1e-300', '0.1']:
+        assert '<TD>{0}</TD>'.format(value) in text
+    assert 'nan<' not in text and 'inf<' not in text
+
+def test_result_key(impex, make_run, tmpdir):
+    run = make_run('run.hc', lambda x, y, z: {'rho': x})
+    orbit = tmpdir.join('orbit.xml')
+    orbit.write('first')
+    query = {'function': 'getDataPointValue', 'filename': run, 'variables': ['rho'],
+             'url_XYZ': str(orbit), 'OutputFiletype': 'votable'}
+    def key(**changes):
+        impex._fetched.clear()  # as for a new request
+        return impex.result_key(dict(query, **changes))
+    first = key()
+    assert key(hc_warnings='x', _outname='y', timing=True) == first
+    assert key(variables=['rho', 'Bx']) != first
+    orbit.write('second')
+    second = key()
+    assert second != first
+    later = os.stat(run).st_mtime + 10
+    os.utime(run, (later, later))
+    assert key() not in [first, second]
+
+@pytest.mark.skipif(netCDF4 is None, reason='needs netCDF4')
+def test_points2netcdf4_lines(impex, tmpdir):
+    lines = {'line_00': {'x': np.arange(3.), 'y': np.zeros(3), 'z': np.zeros(3), 'Bx': np.ones(3)},
+             'line_01': {'x': np.arange(2.) + 10, 'y': np.ones(2), 'z': np.ones(2)}}
+    filename = str(tmpdir.join('lines.nc'))
+    impex.points2netcdf4(filename, lines, {'function': 'getFieldLine'})
+    f = netCDF4.Dataset(filename)
+    try:
+        assert f.featureType == 'trajectory'
+        assert list(f.variables['line'][:]) == ['line_00', 'line_01']
+        assert list(f.variables['rowSize'][:]) == [3, 2]
+        assert f.variables['rowSize'].sample_dimension == 'obs'
+        assert len(f.dimensions['obs']) == 5
+        assert list(f.variables['posx'][:]) == [0., 1., 2., 10., 11.]
+        bx = np.ma.filled(f.variables['Bx'][:], np.nan)
+        assert list(bx[:3]) == [1., 1., 1.] and np.all(np.isnan(bx[3:]))
+    finally:
+        f.close()
+
+def _seeds(impex, tmpdir, seeds):
+    seeds = np.asarray(seeds, dtype=np.float64)
+    filename = str(tmpdir.join('seeds.xml'))
+    impex.points2vot(filename, {'x': seeds[:, 0], 'y': seeds[:, 1], 'z': seeds[:, 2]}, {})
+    return filename
+
+def _field_line(impex, make_run, tmpdir, **options):
+    run = make_run('circular.hc', lambda x, y, z: {'Bx': -y, 'By': x, 'Bz': np.zeros_like(x)})
+    request = {'function': 'getFieldLine', 'filename': run, 'variables': ['B'],
+               'direction': 'Forward', 'stepsize': 0.05, 'maxsteps': 30, 'stop_radius': 0,
+               'stop_box': None, 'url_XYZ': _seeds(impex, tmpdir, [[2., 0, 0]]),
+               'OutputFiletype': 'votable'}
+    request.update(options)
+    answer = impex.run_request(request)
+    assert answer['error'] == ''
+    table = votable.parse_single_table(os.path.join(impex.impex_cfg.get('fmi', 'diroutput'),
+                                                    answer['out_url']), pedantic=False).array
+    return np.column_stack([table[c].data.ravel() for c in ['posx', 'posy', 'posz']])
+
+def test_field_line_without_maxsteps(impex, make_run, tmpdir):
+    # PHP sends null when MaxSteps is not given
+    line = _field_line(impex, make_run, tmpdir, maxsteps=None)
+    assert len(line) == int(impex._cfg('fieldline_maxsteps', 100)) + 1
+
+def test_field_line_stop_box_from_php(impex, make_run, tmpdir):
+    # StopCondition_Region comes split from a string
+    line = _field_line(impex, make_run, tmpdir, stop_box=['-3', '3', '-3', '1', '-3', '3'],
+                       stop_radius='0')
+    assert 1 < len(line) < 31
+    assert np.all(line[:-1, 1] <= 1)
+
+def test_field_line_method(impex, make_run, tmpdir):
+    run = make_run('circular.hc', lambda x, y, z: {'Bx': -y, 'By': x, 'Bz': np.zeros_like(x)})
+    request = {'function': 'getFieldLine', 'filename': run, 'variables': ['B'],
+               'direction': 'Forward', 'stepsize': 0.05, 'maxsteps': 30, 'stop_radius': 0,
+               'stop_box': None, 'url_XYZ': _seeds(impex, tmpdir, [[2., 0, 0]]),
+               'OutputFiletype': 'votable', 'timing': True}
+    answer = impex.run_request(dict(request, method='euler'))
+    assert answer['error'].startswith('ERROR: Unknown method euler')
+    impex.impex_cfg.set('fmi', 'result_cache', '0')
+    evals = {}
+    for method in ['midpoint', 'rk45']:
+        impex.impex_cfg.set('fmi', 'fieldline_method', method)
+        answer = impex.run_request(request)
+        assert answer['error'] == ''
+        trace, = [stage for stage in answer['timing']['stages'] if stage['stage'] == 'trace']
+        assert trace['scheme'] == method
+        evals[method] = trace['nevals']
+    assert evals['midpoint'] == 2 * 30 and evals['rk45'] > 30
+
+def test_requests_cannot_set_internal_keys(impex, monkeypatch):
+    received = []
+    monkeypatch.setitem(impex.functions, 'getVOTableURL', lambda data: received.append(data) or {})
+    impex.run_request({'function': 'getVOTableURL', '_outname': '/etc/passwd', 'x': 1})
+    impex.run_request({'function': 'getVOTableURL', '_outname': 'job'}, internal=True)
+    assert received == [{'function': 'getVOTableURL', 'x': 1},
+                        {'function': 'getVOTableURL', '_outname': 'job'}]
+
+def test_worker_socket_mode(impex, tmpdir):
+    address = str(tmpdir.join('impex.sock'))
+    server = impex._listen(address)
+    try:
+        assert os.stat(address).st_mode & 0o777 == 0o660
+    finally:
+        server.close()
+
+def test_jobdir_of_others_is_refused(impex, monkeypatch):
+    monkeypatch.setattr(impex, 'async_functions', impex.async_functions + ['getVOTableURL'])
+    os.mkdir(impex._jobdir())
+    os.chmod(impex._jobdir(), 0o777)
+    answer = impex.run_request(_request())
+    assert 'Not a directory of this user only' in answer['error']
+    assert not os.path.exists(impex._jobdir('queued'))
+
+def _particles(impex, tmpdir, n):
+    rng = np.random.RandomState(3)
+    points = {key: rng.uniform(-1, 1, n) for key in ['x', 'y', 'z', 'vx', 'vy', 'vz']}
+    points['mass'] = np.full(n, 1.6726e-27)
+    points['charge'] = np.full(n, 1.6022e-19)
+    filename = str(tmpdir.join('particles{0}.xml'.format(n)))
+    impex.points2vot(filename, points, {})
+    return filename
+
+def _trajectories(impex, tmpdir, n):
+    request = {'function': 'getParticleTrajectory', 'filename': 'run.hc',
+               'properties': {'simul_timestep': 'PT0.01S'}, 'direction': 'Forward',
+               'stepsize': 0.1, 'maxsteps': 5, 'stop_radius': 0, 'stop_box': [-9, 9] * 3,
+               'order': 'linear', 'url_XYZ': _particles(impex, tmpdir, n),
+               'OutputFiletype': 'votable'}
+    answer = impex.run_request(request)
+    if answer['error']:
+        return answer['error']
+    vot = votable.parse(os.path.join(impex.impex_cfg.get('fmi', 'diroutput'), answer['out_url']),
+                        pedantic=False)
+    return [(table.description, table.array['posx'].data.ravel().tolist())
+            for table in vot.iter_tables()]
+
+def test_particle_shards_are_numbered_as_the_input(impex, tmpdir):
+    impex.impex_cfg.set('fmi', 'bindir', os.path.join(os.path.dirname(__file__), 'bench', 'stubs'))
+    impex.impex_cfg.set('fmi', 'result_cache', '0')
+    impex.impex_cfg.set('fmi', 'ion_shards', '1')
+    whole = _trajectories(impex, tmpdir, 7)
+    impex.impex_cfg.set('fmi', 'ion_shards', '3')
+    assert _trajectories(impex, tmpdir, 7) == whole
+    assert len(whole) == 7 and [len(line) for name, line in whole] == [6] * 7
+    assert 'no particles' in _trajectories(impex, tmpdir, 0)
+
+def test_table2dict(impex):
+    table = impex._table2dict('% x y parID\n1 2 3\n\n  \n4.5 -5e3 6\n')
+    assert sorted(table.keys()) == ['parID', 'x', 'y']
+    assert table['x'].tolist() == [1, 4.5] and table['y'].tolist() == [2, -5e3]
+    assert table['parID'].flags['C_CONTIGUOUS']
+    # The last header, lines as a list, values after the variables ignored
+    table = impex._table2dict(['# a b c', '# x y', '1 2', '3 4 99', '5 6'])
+    assert sorted(table.keys()) == ['x', 'y']
+    assert table['x'].tolist() == [1, 3, 5] and table['y'].tolist() == [2, 4, 6]
+    assert impex._table2dict('# x y\n')['x'].tolist() == []
+
+@pytest.mark.parametrize('table', ['# x y\n1 2\n3\n4 5\n', '1 2\n3 4\n'])
+def test_table2dict_errors(impex, table):
+    with pytest.raises(ValueError):
+        impex._table2dict(table)
+
+def test_line_names(impex):
+    assert [impex._line_name(n, 3) for n in [0, 2]] == ['line_00', 'line_02']
+    assert [impex._line_name(n, 100) for n in [0, 99]] == ['line_00', 'line_99']
+    assert [impex._line_name(n, 101) for n in [0, 100]] == ['line_000', 'line_100']
+    names = [impex._line_name(n, 1234) for n in range(1234)]
+    assert sorted(names) == names
+
+def test_group_lines_unsorted(impex):
+    # The rows of the paths mixed: they keep their order within each path
+    lines = impex._group_lines('% x y z parID\n'
+                               '1 0 0 5\n10 0 0 1\n2 0 0 5\n11 0 0 1\n3 0 0 5\n0 0 0 0\n12 0 0 1\n',
+                               prefix='B_')
+    assert sorted(lines.keys()) == ['B_line_00', 'B_line_01']
+    assert lines['B_line_00']['x'].tolist() == [10, 11, 12]  # parID 1
+    assert lines['B_line_01']['x'].tolist() == [1, 2, 3]  # parID 5
+    assert 'parID' not in lines['B_line_00']
+
+def test_group_lines_many(impex):
+    pairs = np.repeat(np.arange(150, 0, -1), 2)
+    lines = impex._group_lines({'x': np.arange(300.), 'y': pairs * 1., 'z': pairs * 0., 'parID': pairs})
+    names = sorted(lines.keys())
+    assert names[:2] == ['line_000', 'line_001'] and names[-1] == 'line_149'
+    # In the order of parID
+    assert [lines[name]['y'][0] for name in names] == list(range(1, 151))
+    assert lines['line_149']['x'].tolist() == [0, 1]
+
+def _votable(filename, fields, columns, description=None, votable_format='tabledata'):
+    '''Writes a VOTable with fields [(name, ucd, unit, datatype, arraysize)]'''
+    from astropy.io.votable.tree import VOTableFile, Resource, Table, Field
+    vot = VOTableFile()
+    vot.description = description
+    resource = Resource()
+    vot.resources.append(resource)
+    table = Table(vot)
+    resource.tables.append(table)
+    table.fields.extend([Field(vot, name=name, ID=name, ucd=ucd, unit=unit, datatype=datatype,
+                               arraysize=arraysize)
+                         for name, ucd, unit, datatype, arraysize in fields])
+    table.create_arrays(len(columns[0]))
+    for (name, ucd, unit, datatype, arraysize), column in zip(fields, columns):
+        table.array[name] = column
+    vot.to_xml(filename, tabledata_format=votable_format)
+    return filename
+
+def _both_readers(impex, filename):
+    whole = impex.vot2points(filename)
+    chunks = list(impex.iter_vot2points(filename, 2))
+    for key in whole:
+        streamed = np.concatenate([chunk[key] for chunk in chunks])
+        assert np.all(streamed == whole[key]) if key == 'Time' else np.allclose(streamed, whole[key])
+    assert sorted(chunks[0].keys()) == sorted(whole.keys())
+    return whole
+
+@pytest.mark.parametrize('votable_format', ['tabledata', 'binary'])
+def test_vot2points_by_ucd(impex, tmpdir, votable_format):
+    # Any names and order: the columns are found by their ucd (the
+    # velocities by their name too) and converted to SI
+    n = 5
+    fields = [('Vel_Z', 'phys.veloc', 'km/s', 'double', None),
+              ('Z', 'pos.cartesian.z', 'km', 'double', None),
+              ('other', 'phys.density', None, 'double', None),
+              ('X', 'pos.cartesian.x', 'km', 'double', None),
+              ('Y', 'pos.cartesian.y', None, 'double', None),
+              ('When', 'time', None, 'char', '*'),
+              ('Vel_X', 'phys.veloc', 'm/s', 'double', None)]
+    values = np.arange(n, dtype=np.float64)
+    columns = [values, values + 1, values * 0, values + 2, values + 3,
+               ['2014-01-01T00:00:0{0}'.format(i) for i in range(n)], values + 4]
+    filename = _votable(str(tmpdir.join('ucd.xml')), fields, columns, votable_format=votable_format)
+    points = _both_readers(impex, filename)
+    assert sorted(points.keys()) == ['Time', 'vx', 'vz', 'x', 'y', 'z']
+    assert np.allclose(points['x'], (values + 2) * 1e3) and np.allclose(points['z'], (values + 1) * 1e3)
+    assert np.allclose(points['y'], values + 3)  # no unit: m
+    assert np.allclose(points['vz'], values * 1e3) and np.allclose(points['vx'], values + 4)
+    assert str(points['Time'][1]) == '2014-01-01T00:00:01.000000'
+
+def test_vot2points_missing_column(impex, tmpdir):
+    fields = [('X', 'pos.cartesian.x', 'm', 'double', None),
+              ('Y', 'pos.cartesian.y', 'm', 'double', None),
+              ('Z', 'phys.density', 'm', 'double', None)]
+    filename = _votable(str(tmpdir.join('noz.xml')), fields, [np.zeros(3)] * 3)
+    assert sorted(_both_readers(impex, filename).keys()) == ['x', 'y']
+    answer = impex.run_request({'function': 'getParticleTrajectory', 'filename': 'run.hc',
+                                'url_XYZ': filename, 'OutputFiletype': 'votable'})
+    assert 'is needed to run this function' in answer['error']
+
+def test_vot2points_amda(impex, tmpdir):
+    fields = [('Time', 'time.epoch', None, 'char', '*'),
+              ('pos', None, 'Rm', 'float', '3')]
+    columns = [['2014-01-01T00:00:00', '2014-01-01T00:00:01', '2014-01-01 00:00:02Z'],
+               np.array([[1, 0, 0], [0, 2, 0], [0, 0, -1.5]], dtype=np.float32)]
+    filename = _votable(str(tmpdir.join('amda.xml')), fields, columns,
+                        description='Generated by CDPP/AMDA')
+    points = _both_readers(impex, filename)
+    assert np.allclose(points['x'], [3396e3, 0, 0]) and np.allclose(points['y'], [0, 2 * 3396e3, 0])
+    assert np.allclose(points['z'], [0, 0, -1.5 * 3396e3])
+    assert str(points['Time'][2]) == '2014-01-01T00:00:02.000000'
+
+def test_iso_times(impex):
+    times = ['2014-01-01T00:00:00', '2014-01-01T00:00:01.5Z', '2014-01-01 00:00:02.25',
+             ' 2014-01-01T00:00:03.000001Z ']
+    converted = impex.iso2datetime64(times)
+    assert converted.dtype == np.dtype('datetime64[us]')
+    assert impex.iso2datetime64(converted) is converted
+    assert list(impex.datetime642iso(converted)) == [
+        '2014-01-01T00:00:00.000000', '2014-01-01T00:00:01.500000',
+        '2014-01-01T00:00:02.250000', '2014-01-01T00:00:03.000001']
+    seconds, start = impex._time2seconds(times)
+    assert np.allclose(seconds, [0, 1.5, 2.25, 3.000001]) and start == '2014-01-01T00:00:00.000000'
+
+def test_netcdf_time_units(impex, tmpdir):
+    from scipy.io import netcdf
+    filename = str(tmpdir.join('points.nc'))
+    impex.points2netcdf(filename, {'x': np.zeros(2), 'Time': ['2014-01-01T00:00:00Z',
+                                                              '2014-01-01 00:00:00.5']}, {})
+    f = netcdf.netcdf_file(filename, 'r', mmap=False)
+    assert f.variables['time'].units == 'seconds since 2014-01-01T00:00:00.000000'
+    assert np.allclose(f.variables['time'][:], [0, 0.5])
+    f.close()
+
+def _surface(impex, run, **cfg):
+    for option, value in cfg.items():
+        impex.impex_cfg.set('fmi', option, str(value))
+    answer = impex.run_request({'function': 'getSurface', 'filename': run, 'variables': ['rho', 'Bx'],
+                                'order': 'linear', 'vector': [0, 1, 2], 'point': [0, 0, 0.5],
+                                'resolution': 0.5, 'box_min': [-4] * 3, 'box_max': [4] * 3,
+                                'OutputFiletype': 'votable'})
+    assert answer['error'] == ''
+    table = votable.parse_single_table(os.path.join(impex.impex_cfg.get('fmi', 'diroutput'),
+                                                    answer['out_url']), pedantic=False).array
+    return {name: np.asarray(table[name]).ravel() for name in table.dtype.names}
+
+def test_surface_tiles(impex, make_run):
+    run = make_run('linear.hc', lambda x, y, z: {'rho': 1 + 2 * x - 3 * y + 0.5 * z, 'Bx': x * y})
+    impex.impex_cfg.set('fmi', 'result_cache', '0')
+    whole = _surface(impex, run, surface_workers=1)
+    # 16 points a row, 2 rows a tile: 8 tiles on 3 processes
+    tiled = _surface(impex, run, surface_workers=3, surface_tile=40)
+    assert sorted(tiled.keys()) == sorted(whole.keys()) and len(whole['posx']) == 16 * 16
+    for name in whole:
+        np.testing.assert_array_equal(tiled[name], whole[name])
+    # In the order of the plane rows
+    plane = impex._surface_plane(np.arange(-4, 4, 0.5), np.arange(-4, 4, 0.5), np.array([0., 1, 2]),
+                                 [0, 1, 2], -1.)
+    assert np.allclose(tiled['posx'], plane['x']) and np.allclose(tiled['posz'], plane['z'])
+
+def test_cache_hits_keep_the_answer(impex, make_run, tmpdir, monkeypatch):
+    run = make_run('linear.hc', lambda x, y, z: {'rho': x + y + z})
+    orbit = str(tmpdir.join('orbit.xml'))
+    impex.points2vot(orbit, {'x': np.array([0., 1, 5, 2, -6]), 'y': np.zeros(5), 'z': np.zeros(5)}, {})
+    request = {'function': 'getDataPointValue_spacecraft', 'filename': run, 'variables': ['rho'],
+               'order': 'linear', 'url_XYZ': orbit, 'OutputFiletype': 'votable'}
+    first = impex.run_request(dict(request))
+    assert first['error'] == '' and first['skipped'] == 2
+    # A hit doesn't read the orbit again
+    monkeypatch.setattr(impex, 'iter_vot2points', None)
+    assert impex.run_request(dict(request)) == first
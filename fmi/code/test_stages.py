@@ -0,0 +1,20 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import json
+import stages
+
+def test_stage_records_the_rss_it_takes(tmpdir):
+    trace = stages.Trace('method')
+    with trace.stage('outer', points=3):
+        with trace.stage('inner') as record:
+            data = bytearray(64 * 1024 * 1024)
+            record['bytes'] = len(data)
+    inner, outer = trace.stages
+    assert inner['stage'] == 'outer/inner' and outer['points'] == 3
+    assert inner['rss_delta_kb'] >= 60 * 1024
+    assert outer['rss_kb'] - outer['rss_delta_kb'] < inner['rss_kb']
+    logfile = str(tmpdir.join('timing.log'))
+    trace.log(logfile, request='r')
+    lines = [json.loads(line) for line in open(logfile)]
+    assert [line['stage'] for line in lines] == ['outer/inner', 'outer', 'total']
@@ -0,0 +1,109 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import threading
+import BaseHTTPServer
+import SocketServer
+import pytest
+import urlfetch
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = 'x' * 100
+    requests = []
+
+    def do_GET(self):
+        etag = '"{0}"'.format(len(self.body))
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True  # the fetchers keep their connections open
+
+@pytest.fixture
+def server():
+    Handler.body = 'x' * 100
+    Handler.requests = []
+    httpd = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}/run.vot'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_revalidates(server, tmpdir):
+    fetcher = urlfetch.Fetcher(str(tmpdir))
+    path, sha1 = fetcher.fetch(server)
+    assert open(path).read() == Handler.body
+    assert fetcher.fetch(server) == (path, sha1)
+    assert Handler.requests == [None, '"100"']
+    # Only the body and the meta are left
+    assert sorted(os.listdir(str(tmpdir))) == sorted([sha1, os.path.basename(fetcher._meta_path(server))])
+
+def test_refetches_a_body_pruned_by_another_worker(server, tmpdir):
+    fetcher = urlfetch.Fetcher(str(tmpdir))
+    path, sha1 = fetcher.fetch(server)
+    # Pruned once the meta is read, so the server answers 304
+    read_meta = fetcher._read_meta
+    def prune_after(meta_path):
+        meta = read_meta(meta_path)
+        os.unlink(path)
+        return meta
+    fetcher._read_meta = prune_after
+    assert fetcher.fetch(server) == (path, sha1)
+    assert open(path).read() == Handler.body
+    assert Handler.requests == [None, '"100"', None]
+
+def test_meta_without_body_is_a_miss(server, tmpdir):
+    fetcher = urlfetch.Fetcher(str(tmpdir))
+    path, sha1 = fetcher.fetch(server)
+    with open(fetcher._meta_path(server), 'w') as f:
+        f.write('{"sha1": "')  # half written by an older version
+    Handler.body = 'y' * 100  # same etag
+    path, sha1 = fetcher.fetch(server)
+    assert open(path).read() == Handler.body
+    assert Handler.requests == [None, None]
+
+def test_prune_removes_the_metas_of_pruned_bodies(server, tmpdir):
+    fetcher = urlfetch.Fetcher(str(tmpdir), max_bytes=0)
+    old, sha1 = fetcher.fetch(server)
+    Handler.body = 'y' * 50
+    new, sha1 = fetcher.fetch(server + '?new')
+    assert os.listdir(str(tmpdir)) != [] and not os.path.exists(old)
+    assert not os.path.exists(fetcher._meta_path(server))
+    assert os.path.exists(new) and os.path.exists(fetcher._meta_path(server + '?new'))
+
+def test_cachedir_of_others_is_refused(server, tmpdir):
+    os.chmod(str(tmpdir), 0o777)
+    with pytest.raises(OSError):
+        urlfetch.Fetcher(str(tmpdir)).fetch(server)
+
+def test_local_files_only_within_local_dir(tmpdir):
+    inputs = tmpdir.mkdir('inputs')
+    inputs.join('orbit.xml').write('x')
+    tmpdir.join('secret').write('y')
+    inputs.join('link').mksymlinkto(tmpdir.join('secret'))
+    orbit = str(inputs.join('orbit.xml'))
+    with pytest.raises(urlfetch.FetchError):
+        urlfetch.Fetcher(str(tmpdir.join('cache'))).fetch(orbit)
+    fetcher = urlfetch.Fetcher(str(tmpdir.join('cache')), local_dir=str(inputs))
+    assert fetcher.fetch(orbit)[0] == orbit
+    assert fetcher.fetch('file://' + orbit)[0] == orbit
+    for url in [str(tmpdir.join('secret')), str(inputs) + '/../secret', str(inputs.join('link')),
+                str(inputs) + 'x/orbit.xml', 'file:///etc/passwd', 'ftp://host/orbit.xml']:
+        with pytest.raises(urlfetch.FetchError):
+            fetcher.fetch(url)
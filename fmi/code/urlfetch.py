@@ -0,0 +1,219 @@
+__authors__ = ["David PS"]
+__email__ = "dps.helio-?-gmail.com"
+
+import os
+import json
+import hashlib
+import httplib
+import urlparse
+import urllib
+import tempfile
+import socket
+import email.utils
+import files
+
+class FetchError(Exception):
+    pass
+
+class Fetcher(object):
+    '''
+    Fetches the input urls into a local cache directory.
+    - http(s) connections are kept open and reused per host,
+    - the responses are streamed to disk (so they are parsed from there)
+      and revalidated with ETag/Last-Modified next time,
+    - the bodies are named after their sha1 and the meta of each url is
+      moved in place, so workers sharing the directory never see a meta
+      that doesn't match its body,
+    - file:// urls and plain paths are used directly, but only those
+      within local_dir (None, the default, refuses them all), so a
+      request can't read the files of the service.
+    fetch returns the local path and the sha1 of the content.
+    '''
+    chunksize = 1024 * 1024
+    max_redirects = 5
+
+    def __init__(self, cachedir, timeout=30, max_bytes=1024 ** 3, local_dir=None):
+        self.cachedir = cachedir
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.local_dir = local_dir
+        self.connections = {}  # (scheme, host, port): connection
+        self.private = False  # whether cachedir was checked (see files.private_dir)
+
+    def fetch(self, url):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme in ('', 'file'):
+            path = self._local_path(url, urllib.url2pathname(parsed.path))
+            return path, self._digest(path)
+        if parsed.scheme not in ('http', 'https'):
+            raise FetchError('Unsupported url: ' + url)
+        return self._fetch_http(url)
+
+    def _local_path(self, url, path):
+        '''The path of a local url, if it's within local_dir (links resolved)'''
+        if self.local_dir:
+            path = os.path.realpath(path)
+            if path.startswith(os.path.join(os.path.realpath(self.local_dir), '')):
+                return path
+        raise FetchError('Local files are not accepted as input: ' + url)
+
+    def _digest(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunksize), ''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _meta_path(self, url):
+        return os.path.join(self.cachedir, hashlib.sha1(url).hexdigest() + '.json')
+
+    def _body_path(self, sha1):
+        # The bodies are named after their content, so a meta always
+        # describes the body it names
+        return os.path.join(self.cachedir, sha1)
+
+    def _read_meta(self, meta_path):
+        '''The meta of the url if its body is in the cache, else {}'''
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not os.path.exists(self._body_path(meta.get('sha1', ''))):
+            return {}
+        return meta
+
+    def _connection(self, parsed, fresh=False):
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        if fresh and key in self.connections:
+            self.connections.pop(key).close()
+        if key not in self.connections:
+            connection = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+            self.connections[key] = connection(parsed.hostname, parsed.port, timeout=self.timeout)
+        return self.connections[key]
+
+    def _request(self, parsed, headers):
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        # A kept alive connection may have been closed by the server: retry once
+        for fresh in (False, True):
+            connection = self._connection(parsed, fresh)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if fresh:
+                    raise
+
+    def _get(self, url, meta):
+        '''GET url (following the redirects), conditional if meta is given'''
+        target = url
+        for redirect in range(self.max_redirects + 1):
+            parsed = urlparse.urlsplit(target)
+            headers = {'Connection': 'keep-alive', 'Accept-Encoding': 'identity'}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            response = self._request(parsed, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                target = urlparse.urljoin(target, response.getheader('location'))
+                continue
+            return response, parsed
+        raise FetchError('Too many redirects fetching ' + url)
+
+    def _fetch_http(self, url):
+        if not self.private:
+            # The metas and bodies found there are trusted
+            files.private_dir(self.cachedir)
+            self.private = True
+        meta_path = self._meta_path(url)
+        meta = self._read_meta(meta_path)
+        response, parsed = self._get(url, meta)
+        if response.status == 304:
+            response.read()
+            body = self._body_path(meta['sha1'])
+            try:
+                os.utime(body, None)  # recently used
+                return body, meta['sha1']
+            except OSError:
+                # pruned by another process meanwhile: fetch it again
+                response, parsed = self._get(url, {})
+        if response.status != 200:
+            response.read()
+            raise FetchError('HTTP error {0} fetching {1}'.format(response.status, url))
+
+        # Stream the body to a temporary file and move it in place
+        sha1 = hashlib.sha1()
+        tmp = tempfile.NamedTemporaryFile(dir=self.cachedir, delete=False)
+        try:
+            for chunk in iter(lambda: response.read(self.chunksize), ''):
+                sha1.update(chunk)
+                tmp.write(chunk)
+            tmp.close()
+            body = self._body_path(sha1.hexdigest())
+            os.rename(tmp.name, body)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        if response.getheader('connection', '').lower() == 'close':
+            self._connection(parsed).close()
+
+        meta = {'url': url, 'sha1': sha1.hexdigest(),
+                'etag': response.getheader('etag'),
+                'last_modified': response.getheader('last-modified'),
+                'fetched': email.utils.formatdate(usegmt=True)}
+        # Also moved in place, so it's never seen half written
+        tmp = tempfile.NamedTemporaryFile(dir=self.cachedir, suffix='.tmp', delete=False)
+        json.dump(meta, tmp)
+        tmp.close()
+        os.rename(tmp.name, meta_path)
+        self.prune(keep=body)
+        return body, meta['sha1']
+
+    def prune(self, keep=None):
+        '''
+        Removes the least recently used bodies over max_bytes (but keep)
+        and the metas of the bodies that are not there
+        '''
+        bodies = []
+        metas = []
+        for name in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, name)
+            if name.endswith('.json'):
+                metas.append(path)
+            elif len(name) == 40 and path != keep:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # removed by another process
+                bodies.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in bodies)
+        for mtime, size, path in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            files.unlink(path)
+            total -= size
+        for path in metas:
+            try:
+                with open(path) as f:
+                    sha1 = json.load(f).get('sha1', '')
+            except (IOError, ValueError):
+                continue
+            if not os.path.exists(self._body_path(sha1)):
+                files.unlink(path)
+
+fetcher = None
+
+def fetch(url):
+    '''
+    Fetches url with the module fetcher (created with the defaults
+    in the temporary directory if it was not set).
+    '''
+    global fetcher
+    if fetcher is None:
+        fetcher = Fetcher(os.path.join(tempfile.gettempdir(), 'impex_urlcache'))
+    return fetcher.fetch(url)
@@ -12,15 +12,77 @@ $dict_functions = array('getDataPointValue' => 'run_getDataPointValue',
 			'getVOTableURL' => 'run_getVOTableURL');
 
 
+/* Unix socket where the impex.py worker daemon listens: worker_socket of
+   fmi/code/fmi.cfg, read from there (as impex.py does, relative to the
+   webservice directory) so both sides use the same.
+   Start it with: python -W ignore fmi/code/impex.py --serve */
+$fmi_cfg = @parse_ini_file('fmi/code/fmi.cfg', TRUE, INI_SCANNER_RAW);
+$fmi_worker_socket = isset($fmi_cfg['fmi']['worker_socket']) ?
+  $fmi_cfg['fmi']['worker_socket'] : '/tmp/impex_fmi.sock';
+/* Seconds to wait for the answer of the worker daemon: as long as the
+   longest request may take running the tools (ft, iontracer...). */
+$fmi_worker_timeout = 600;
+
+
+/**
+ * fmi_worker_error is the JSON answer with the error message.
+ * @param string $message
+ */
+function fmi_worker_error($message){
+  return json_encode(array('out_url' => '', 'error' => 'ERROR: ' . $message));
+}
+
+
+/**
+ * fmi_worker_request sends the JSON data to the impex.py worker daemon
+ *  and returns its JSON answer, or FALSE if the daemon is not reachable.
+ *  Once the request is sent it's not run again: if the daemon does not
+ *  answer (it stopped or took longer than $fmi_worker_timeout) the answer
+ *  is an error.
+ * @param array $data
+ */
+function fmi_worker_request($data){
+  if (!file_exists($GLOBALS['fmi_worker_socket']))
+    return FALSE;
+  $socket = @stream_socket_client('unix://' . $GLOBALS['fmi_worker_socket'], $errno, $errstr, 5);
+  if ($socket === FALSE)
+    return FALSE;
+  stream_set_timeout($socket, $GLOBALS['fmi_worker_timeout']);
+  $request = json_encode($data) . "\n";
+  $written = @fwrite($socket, $request);
+  if ($written === FALSE || $written === 0)
+    {
+      fclose($socket);
+      return FALSE;  // nothing sent, it can run elsewhere
+    }
+  if ($written < strlen($request))
+    {
+      fclose($socket);
+      return fmi_worker_error('The request could not be sent to the FMI worker');
+    }
+  $result = fgets($socket);
+  $meta = stream_get_meta_data($socket);
+  fclose($socket);
+  if ($meta['timed_out'])
+    return fmi_worker_error('The FMI worker did not answer in ' . $GLOBALS['fmi_worker_timeout'] . ' s');
+  if ($result === FALSE || substr($result, -1) != "\n")
+    return fmi_worker_error('The FMI worker stopped while running the request');
+  return $result;
+}
+
+
 /**
  *
  */
 function run_fmi_any($data){
-  // Execute the python script with the JSON data
+  // Send the JSON data to the worker daemon if it's running, otherwise
+  // execute the python script with the JSON data
   // python with "-W ignore" flag to ignore the warning messages that are send to stdout and we then cannot read as json
   // Though it would be nice to report these errors/warnings to the user in any way...
   // TODO: execute this under try/catch to report an error from the python execution
-  $result = shell_exec('python -W ignore fmi/code/impex.py ' . escapeshellarg(json_encode($data))); 
+  $result = fmi_worker_request($data);
+  if ($result === FALSE)
+    $result = shell_exec('python -W ignore fmi/code/impex.py ' . escapeshellarg(json_encode($data)));
 
   // Decode the result  
   $resultData = json_decode($result, true);
@@ -69,6 +131,29 @@ function run_getDataPointValue($ResourceID, $variables,
 
 
 
+/**
+ * run_getDataPointValue_spacecraft is run_getDataPointValue for the
+ *  (time tagged) orbits of the spacecraft, which can be long: they are
+ *  streamed in chunks through hcintpol (spacecraft_chunk in fmi.cfg).
+ */
+function run_getDataPointValue_spacecraft($ResourceID, $variables,
+					  $url_XYZ, $IMFClockAngle,
+					  $InterpolationMethod,
+					  $OutputFiletype, $properties){
+
+  $data2funct = array('function' => 'getDataPointValue_spacecraft',          // string
+		      'ResourceID' => $ResourceID,                           // string
+		      'filename' => $properties['ProductKey'],               // string
+		      'variables' => $variables,                             // list
+		      'url_XYZ' => $url_XYZ,
+		      'order' => $InterpolationMethod,                       // string: 'linear' || 'nearestgridpoint'
+		      'OutputFiletype' => $OutputFiletype);                  // string: 'votable'|| 'netcdf'
+
+  return run_fmi_any($data2funct);
+}
+
+
+
 /**
  *
  */